@@ -4,6 +4,7 @@
 
 import numpy as np
 import catalog
+import geometrycache
 
 #################################
 
@@ -19,6 +20,120 @@ import catalog
 #################################
 
 
+# Binning engine
+#
+# Galaxies are assigned a bin index (-1 if unbinned); per-bin counts, sums
+# and sums of squares are then accumulated in one pass with np.bincount.
+
+def fixedBinIndex(profileCol, binedges):
+    '''Bin index of each galaxy for bins [binedges[i], binedges[i+1]); -1 outside'''
+
+    nbins = len(binedges) - 1
+
+    binindex = np.searchsorted(binedges, profileCol, side = 'right') - 1
+    binindex[binindex >= nbins] = -1
+
+    return binindex
+
+def catalogBinIndex(cat, profileCol, binedges):
+    '''fixedBinIndex of cat's profileCol. If cat carries geometry from the
+    geometry cache, the whole grid is binned once per set of edges, and
+    cat's galaxies pick out their pixels' bins.'''
+
+    entry = None
+    if hasattr(cat, 'geometryid') and profileCol in geometrycache.geometrycolumns:
+        entry = geometrycache.global_geometrycache.get(cat.geometryid)
+
+    if entry is None:
+        return fixedBinIndex(getattr(cat, profileCol), binedges)
+
+    key = (profileCol, tuple(binedges))
+    if key not in entry.binindices:
+        entry.binindices[key] = fixedBinIndex(entry.columns[profileCol], binedges).astype(np.int16)
+
+    return entry.binindices[key][cat.gridpixel]
+
+def equalCountBinIndex(profileCol, ngals, minradii, maxradii):
+    '''Bin index of each galaxy for consecutive bins of ngals galaxies in
+    radius, using galaxies with minradii < profileCol < maxradii. The last
+    bin holds the remainder. Returns (binindex, nbins).'''
+
+    order = np.argsort(profileCol)
+    sortedcol = profileCol[order]
+    inrange = order[np.logical_and(sortedcol > minradii, sortedcol < maxradii)]
+
+    binindex = -np.ones(len(profileCol), dtype=np.int64)
+    binindex[inrange] = np.arange(len(inrange)) // ngals
+
+    nbins = int(np.ceil(len(inrange) / float(ngals)))
+
+    return binindex, nbins
+
+def fixedBinEdges(minradii, maxradii, nbins, binspacing):
+
+    if binspacing == 'linear':
+        return np.linspace(minradii, maxradii, nbins+1)
+    return np.logspace(np.log10(minradii), np.log10(maxradii), nbins+1)
+
+######
+
+class BinnedColumns(object):
+    '''Per-bin counts, sums and sums of squares for a set of columns'''
+
+    def __init__(self, binindex, nbins, **columns):
+
+        self.nbins = nbins
+
+        valid = binindex >= 0
+        self.binindex = binindex[valid]
+        self.counts = np.bincount(self.binindex, minlength = nbins)
+
+        self.columns = {}
+        self.sums = {}
+        self.sumsqs = {}
+        for name, vals in columns.iteritems():
+            vals = np.asarray(vals, dtype=np.float64)[valid]
+            self.columns[name] = vals
+            self.sums[name] = np.bincount(self.binindex, weights = vals, minlength = nbins)
+            self.sumsqs[name] = np.bincount(self.binindex, weights = vals**2, minlength = nbins)
+
+    def mean(self, name):
+
+        return self.sums[name] / np.maximum(self.counts, 1)
+
+    def meansq(self, name):
+
+        return self.sumsqs[name] / np.maximum(self.counts, 1)
+
+    def std(self, name):
+        '''Population standard deviation, as np.std'''
+
+        return np.sqrt(np.maximum(self.meansq(name) - self.mean(name)**2, 0.))
+
+######
+
+def binGalaxies(cat, profileCol, binindex, nbins):
+
+    return BinnedColumns(binindex, nbins,
+                         radius = getattr(cat, profileCol),
+                         ghat = cat.ghat,
+                         beta_s = cat.beta_s)
+
+def buildProfile(profileCol, radii, shear, shearerr, avebeta, avebeta2, ngals):
+
+    profile = catalog.Catalog()
+    setattr(profile, profileCol, np.array(radii))
+    profile.ghat = np.array(shear)
+    profile.sigma_ghat = np.array(shearerr)
+    profile.beta_s = np.array(avebeta)
+    profile.beta_s2 = np.array(avebeta2)
+    profile.ngals = np.array(ngals)
+
+    return profile
+
+#################################
+
+
 class DumbEqualBins(object):
 
     def configure(self, config):
@@ -39,45 +154,127 @@ class DumbEqualBins(object):
 
         profileCol = getattr(cat, self.profileCol)
 
-        sorted_cat = cat.filter(np.argsort(profileCol))
-        sorted_cat = sorted_cat.filter(np.logical_and(sorted_cat[self.profileCol] > self.minradii, 
-                                                      sorted_cat[self.profileCol] < self.maxradii))
-        radii = []
-        shear = []
-        shearerr = []
-        avebeta = []
-        avebeta2 = []
-        ngals = []
-        for i in range(0, len(sorted_cat), self.ngals):
-            maxtake = min(i+self.ngals, len(cat))
-            radii.append(np.mean(sorted_cat[self.profileCol][i:maxtake]))
-            shear.append(np.mean(sorted_cat['ghat'][i:maxtake]))
-            shearerr.append(np.std(sorted_cat['ghat'][i:maxtake])/np.sqrt(maxtake-i))
-            avebeta.append(np.mean(sorted_cat['beta_s'][i:maxtake]))
-            avebeta2.append(np.mean(sorted_cat['beta_s'][i:maxtake]**2))
-            ngals.append(len(sorted_cat[self.profileCol][i:maxtake]))
-
-        profile = catalog.Catalog()
-        setattr(profile, self.profileCol, np.array(radii))
-        profile.ghat = np.array(shear)
-        profile.sigma_ghat = np.array(shearerr)
-        profile.beta_s = np.array(avebeta)
-        profile.beta_s2 = np.array(avebeta2)
-        profile.ngals = np.array(ngals)
-        
+        binindex, nbins = equalCountBinIndex(profileCol, self.ngals, self.minradii, self.maxradii)
+        binned = binGalaxies(cat, self.profileCol, binindex, nbins)
 
-        return profile
+        return buildProfile(self.profileCol,
+                            binned.mean('radius'),
+                            binned.mean('ghat'),
+                            binned.std('ghat')/np.sqrt(binned.counts),
+                            binned.mean('beta_s'),
+                            binned.meansq('beta_s'),
+                            binned.counts)
 
 ############################
+# Bootstrap resampling
+
+def getRandomState(seed = None):
+    '''None -> the np.random module, which draws from numpy's global stream;
+    an int seeds a new RandomState'''
+
+    if seed is None:
+        return np.random
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+def bootstrapBinMeans(values, binindex, nbins, nboot = 1000, randomstate = None, 
+                      method = 'multinomial', maxmemory = 2**24):
+    '''Bootstrap the mean of values in each bin, for all bins at once.
+
+    values      - per galaxy values
+    binindex    - bin of each galaxy, -1 for unbinned
+    method      - 'multinomial' resamples each bin with replacement, as a classic bootstrap;
+                  'poisson' weights each galaxy by a Poisson(1) draw
+    maxmemory   - approximate cap, in bytes, on the working arrays. Resamples are
+                  drawn in chunks sized to respect it.
+
+    Returns the mean and standard deviation of the bootstrapped means per bin.
+    Bins with no galaxies are nan.'''
+
+    randomstate = getRandomState(randomstate)
+
+    valid = binindex >= 0
+    order = np.argsort(binindex[valid], kind = 'mergesort')
+    sortedbins = binindex[valid][order]
+    sortedvals = np.asarray(values, dtype=np.float64)[valid][order]
+
+    counts = np.bincount(sortedbins, minlength = nbins)
+    starts = np.hstack([0, np.cumsum(counts)[:-1]])
+    nonempty = counts > 0
+
+    ngals = len(sortedvals)
+    if ngals == 0:
+        return np.nan*np.ones(nbins), np.nan*np.ones(nbins)
+
+    chunksize = int(max(1, min(nboot, maxmemory // (24*ngals))))
+
+    #for each resampled slot: the first position & size of the bin it is drawn from
+    slotstart = starts[sortedbins]
+    slotcount = counts[sortedbins]
+
+    bootedmeans = np.zeros((nboot, nbins))
+
+    for firstboot in range(0, nboot, chunksize):
+
+        nchunk = min(chunksize, nboot - firstboot)
+
+        if method == 'multinomial':
+            #uniform position within each bin: 31 random bits scaled by the bin size
+            picks = randomstate.randint(0, 2**31, (nchunk, ngals), dtype=np.int32).astype(np.int64)
+            picks *= slotcount
+            picks >>= 31
+            picks += slotstart
+            resampled = sortedvals.take(picks)
+            del picks
+            sums = np.add.reduceat(resampled, starts[nonempty], axis = 1)
+            bootedmeans[firstboot:firstboot+nchunk, nonempty] = sums / counts[nonempty]
+        elif method == 'poisson':
+            weights = randomstate.poisson(1., (nchunk, ngals)).astype(np.float64)
+            sums = np.add.reduceat(weights*sortedvals, starts[nonempty], axis = 1)
+            norms = np.add.reduceat(weights, starts[nonempty], axis = 1)
+            bootedmeans[firstboot:firstboot+nchunk, nonempty] = sums / np.maximum(norms, 1)
+        else:
+            raise ValueError('Unknown bootstrap method: %s' % method)
+
+    bootedmeans[:, np.logical_not(nonempty)] = np.nan
+
+    return np.mean(bootedmeans, axis = 0), np.std(bootedmeans, axis = 0)
+
+def bootstrapmean(distro, nboot=1000, randomstate = None):
+
+    means, errs = bootstrapBinMeans(distro, np.zeros(len(distro), dtype=np.int64), 1, 
+                                    nboot = nboot, randomstate = randomstate)
 
-def bootstrapmean(distro, nboot=1000):
+    return means[0], errs[0]
 
-    bootedmeans = np.zeros(nboot)
-    for i in range(nboot):
-        curboot = np.random.randint(0, len(distro), len(distro))
-        bootedmeans[i] = np.mean(distro[curboot])
+def configureBootstrap(binner, config):
+    '''Common bootstrap options for binners'''
 
-    return np.mean(bootedmeans), np.std(bootedmeans)
+    binner.nboot = 1000
+    binner.bootstrapmethod = 'multinomial'
+    binner.bootstrapmaxmem = 2**24
+    seed = None
+
+    if 'nbootstraps' in config:
+        binner.nboot = config['nbootstraps']
+    if 'bootstrapmethod' in config:
+        binner.bootstrapmethod = config['bootstrapmethod']
+    if 'bootstrapmaxmem' in config:
+        binner.bootstrapmaxmem = config['bootstrapmaxmem']
+    if 'bootstrapseed' in config:
+        seed = config['bootstrapseed']
+
+    #without a seed, resolved on each call, so the global stream is used
+    binner.randomstate = None if seed is None else getRandomState(seed)
+
+def bootstrapBinned(binner, binned, name = 'ghat'):
+
+    return bootstrapBinMeans(binned.columns[name], binned.binindex, binned.nbins,
+                             nboot = binner.nboot,
+                             randomstate = binner.randomstate,
+                             method = binner.bootstrapmethod,
+                             maxmemory = binner.bootstrapmaxmem)
 
 ############################
 
@@ -94,41 +291,26 @@ class BootstrapEqualBins(object):
             self.maxradii = config['profileMax']
             self.minradii = config['profileMin']
             self.profileCol = config['profilecol']
+
+        configureBootstrap(self, config)
         
 
     def __call__(self, cat):
 
         profileCol = getattr(cat, self.profileCol)
 
-        sorted_cat = cat.filter(np.argsort(profileCol))
-        sorted_cat = sorted_cat.filter(np.logical_and(sorted_cat[self.profileCol] > self.minradii, 
-                                                      sorted_cat[self.profileCol] < self.maxradii))
-        radii = []
-        shear = []
-        shearerr = []
-        avebeta = []
-        avebeta2 = []
-        ngals = []
-        for i in range(0, len(sorted_cat), self.ngals):
-            maxtake = min(i+self.ngals, len(cat))
-            radii.append(np.mean(sorted_cat[self.profileCol][i:maxtake]))
-
-            curmean, curerr = bootstrapmean(sorted_cat['ghat'][i:maxtake])
-            shear.append(curmean)
-            shearerr.append(curerr)
-            avebeta.append(np.mean(sorted_cat['beta_s'][i:maxtake]))
-            avebeta2.append(np.mean(sorted_cat['beta_s'][i:maxtake]**2))
-            ngals.append(len(sorted_cat['ghat'][i:maxtake]))
-
-        profile = catalog.Catalog()
-        setattr(profile, self.profileCol, np.array(radii))
-        profile.ghat = np.array(shear)
-        profile.sigma_ghat = np.array(shearerr)
-        profile.beta_s = np.array(avebeta)
-        profile.beta_s2 = np.array(avebeta2)
-        profile.ngals = np.array(ngals)
-
-        return profile
+        binindex, nbins = equalCountBinIndex(profileCol, self.ngals, self.minradii, self.maxradii)
+        binned = binGalaxies(cat, self.profileCol, binindex, nbins)
+
+        shear, shearerr = bootstrapBinned(self, binned)
+
+        return buildProfile(self.profileCol,
+                            binned.mean('radius'),
+                            shear,
+                            shearerr,
+                            binned.mean('beta_s'),
+                            binned.meansq('beta_s'),
+                            binned.counts)
 
             
 
@@ -151,61 +333,30 @@ class BootstrapFixedBins(object):
             self.binspacing = config['binspacing']
             self.nbins = config['nbins']
             self.profileCol = config['profilecol']
+
+        configureBootstrap(self, config)
         
 
     def __call__(self, cat):
 
-        profileCol = getattr(cat, self.profileCol)
+        nbins = int(self.nbins)
+        binedges = fixedBinEdges(self.minradii, self.maxradii, nbins, self.binspacing)
 
-        if self.binspacing == 'linear':
-            binedges = np.linspace(self.minradii, self.maxradii, self.nbins+1)
-        else:
-            binedges = np.logspace(np.log10(self.minradii), np.log10(self.maxradii), self.nbins+1)
-
-        radii = []
-        shear = []
-        shearerr = []
-        avebeta = []
-        avebeta2 = []
-        ngals = []
-        for i in range(self.nbins):
-            mintake = binedges[i]
-            maxtake = binedges[i+1]
-            selected = cat.filter(np.logical_and(profileCol >= mintake,
-                                                     profileCol < maxtake))
+        binned = binGalaxies(cat, self.profileCol, catalogBinIndex(cat, self.profileCol, binedges), nbins)
 
-        
-        
+        shear, shearerr = bootstrapBinned(self, binned)
 
-            if len(selected) < 2:
-                radii.append(-1)
-                shear.append(-1)
-                shearerr.append(-1)
-                avebeta.append(-1)
-                avebeta2.append(-1)
-                ngals.append(-1)
-                continue
-
-            
+        radii = binned.mean('radius')
+        avebeta = binned.mean('beta_s')
+        avebeta2 = binned.meansq('beta_s')
+        ngals = binned.counts.copy()
 
-            radii.append(np.mean(getattr(selected,self.profileCol)))
+        #placeholders for bins with too few galaxies
+        toofew = binned.counts < 2
+        for col in [radii, shear, shearerr, avebeta, avebeta2, ngals]:
+            col[toofew] = -1
 
-            curmean, curerr = bootstrapmean(selected.ghat)
-            shear.append(curmean)
-            shearerr.append(curerr)
-            avebeta.append(np.mean(selected.beta_s))
-            avebeta2.append(np.mean(selected.beta_s**2))
-            ngals.append(len(selected))
-
-        profile = catalog.Catalog()
-        setattr(profile, self.profileCol, np.array(radii))
-        profile.ghat = np.array(shear)
-        profile.sigma_ghat = np.array(shearerr)
-        profile.beta_s = np.array(avebeta)
-        profile.beta_s2 = np.array(avebeta2)
-        profile.ngals = np.array(ngals)
-
-        return profile
+        return buildProfile(self.profileCol, radii, shear, shearerr, avebeta, avebeta2, ngals)
 
       
 
@@ -233,48 +384,21 @@ class GaussianFixedBins(object):
 
     def __call__(self, cat):
 
-        profileCol = getattr(cat, self.profileCol)
+        nbins = int(self.nbins)
+        binedges = fixedBinEdges(self.minradii, self.maxradii, nbins, self.binspacing)
 
-        if self.binspacing == 'linear':
-            binedges = np.linspace(self.minradii, self.maxradii, self.nbins+1)
-        else:
-            binedges = np.logspace(np.log10(self.minradii), np.log10(self.maxradii), self.nbins+1)
+        binned = binGalaxies(cat, self.profileCol, catalogBinIndex(cat, self.profileCol, binedges), nbins)
 
-        radii = []
-        shear = []
-        shearerr = []
-        avebeta = []
-        avebeta2 = []
-        ngals = []
-        for i in range(self.nbins):
-            mintake = binedges[i]
-            maxtake = binedges[i+1]
-            selected = cat.filter(np.logical_and(profileCol >= mintake,
-                                                     profileCol < maxtake))
+        nonempty = binned.counts > 0
+        ngals = binned.counts[nonempty]
 
-            ngal = len(selected)            
-
-            if ngal == 0:
-                continue
-
-            radii.append(np.mean(getattr(selected, self.profileCol)))
-            shear.append(np.mean(selected.ghat))
-            shearerr.append(self.shapenoise / np.sqrt(ngal))
-            avebeta.append(np.mean(selected.beta_s))
-            avebeta2.append(np.mean(selected.beta_s**2))
-            ngals.append(ngal)
-
-
-
-        profile = catalog.Catalog()
-        setattr(profile, self.profileCol, np.array(radii))
-        profile.ghat = np.array(shear)
-        profile.sigma_ghat = np.array(shearerr)
-        profile.beta_s = np.array(avebeta)
-        profile.beta_s2 = np.array(avebeta2)
-        profile.ngals = np.array(ngals)
-
-        return profile
+        return buildProfile(self.profileCol,
+                            binned.mean('radius')[nonempty],
+                            binned.mean('ghat')[nonempty],
+                            self.shapenoise / np.sqrt(ngals),
+                            binned.mean('beta_s')[nonempty],
+                            binned.meansq('beta_s')[nonempty],
+                            ngals)
 
 
 
@@ -282,5 +406,3 @@ class GaussianFixedBins(object):
 
 
 ########################################
-
-
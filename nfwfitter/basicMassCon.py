@@ -4,9 +4,48 @@
 
 import numpy as np
 import nfwutils
-import nfwmodeltools as tools
 
 
+#######################################################
+
+def iterateC200(mc200, m, z, overdensity, tolerance = 0.05):
+    """Vectorized iteration to find c200 for halos specified by M_delta.
+
+    mc200       - function of (m200c, z) returning c200; must accept arrays
+    m           - M_delta, scalar or array
+    z           - redshift, scalar or array matching m
+    overdensity - wrt to the critical density
+
+    Each element is iterated until its concentration changes by less
+    than tolerance; converged elements are held fixed. Returns a scalar
+    for scalar m.
+    """
+
+    isScalar = np.ndim(m) == 0
+    m = np.atleast_1d(np.asarray(m, dtype=np.float64))
+
+    c0 = np.atleast_1d(np.asarray(mc200(m, z), dtype=np.float64)) * np.ones_like(m)
+
+    #per halo redshifts follow their masses through the active subset
+    if np.ndim(z) > 0:
+        z = np.broadcast_to(z, m.shape)
+
+    if overdensity != 200:
+
+        oldC = 100.*np.ones_like(c0)
+        active = np.abs(c0 - oldC)/oldC >= tolerance
+        while np.any(active):
+            oldC[active] = c0[active]
+            m200c = nfwutils.convertMdelta(m[active], c0[active], overdensity, 200.)
+            c0[active] = mc200(m200c, z[active] if np.ndim(z) > 0 else z)
+            active[active] = np.abs(c0[active] - oldC[active])/oldC[active] >= tolerance
+
+    if isScalar:
+        return c0[0]
+    return c0
+
+
+#######################################################
 
 class constant(object):
 
@@ -16,20 +55,15 @@ class constant(object):
 
     def __call__(self, mass, z, overdensity = 200):
 
-        return self.concentration
+        if np.ndim(mass) == 0:
+            return self.concentration
+
+        return self.concentration*np.ones(np.shape(mass))
 
 #######################################################
 
 class OldDuffy(object):
 
-    def ratioResid(self, ratio, conc, deltaRatio):
-        """Helper function for duffyConcentration."""
-        return ratio**3 * deltaRatio \
-            - (np.log(1. + conc * ratio) \
-                   - conc * ratio / (1. + conc * ratio)) \
-                   / (np.log(1. + conc) - conc / (1. + conc))
-
-
     def __call__(self, m, z, overdensity = 200):
 
         """Compute the Duffy et al. mass concentration relation for a halo
@@ -40,7 +74,6 @@ class OldDuffy(object):
 
         Borrowed from J. Dietrich, 2013
         """
-        n = 1e5
         A = 5.71
         B = -0.084
         C = -0.47
@@ -48,22 +81,14 @@ class OldDuffy(object):
         if overdensity != 200:
         # Get a first estimate of the concentration to convert to M200crit
             c0 = A * (m / 2e12)**B * (1. + z)**C
-            delta200c = overdensity / 200.
-            minval = 0.2
-            maxval = 5.
-            ratio = minval + np.arange(n) / n * (maxval - minval)
-            res = self.ratioResid(ratio, c0, delta200c)
-            rRatio = ratio[(res**2).argmin()]
-            mRatio = delta200c * rRatio**3
-            m200c = m / mRatio
+            m200c = nfwutils.convertMdelta(m, c0, overdensity, 200.)
             # Convert input to M200c using the updated concentration
             nIter = 2
             for i in range(nIter):
                 c = A * (m200c / 2e12)**B * (1. + z)**C
-                res = self.ratioResid(ratio, c, delta200c)
-                rRatio = ratio[(res**2).argmin()]
-                mRatio = delta200c * rRatio**3
-                m200c = m / mRatio
+                m200c = nfwutils.convertMdelta(m, c, overdensity, 200.)
+            if np.ndim(m) == 0:
+                m200c = float(m200c)
         else:
             m200c = m
         return A * (m200c / 2e12)**B * (1. + z)**C
@@ -85,27 +110,14 @@ class Duffy(object):
         Inspired by J. Dietrich, 2013
         Heavily optimized by D. Applegate
         """
-        n = 1e5
         A = 5.71
         B = -0.084
         C = -0.47
 
-        rho_crit = nfwutils.global_cosmology.rho_crit(z)
-
-        c0 = A * (m / 2e12)**B * (1. + z)**C
+        def mc200(m200c, z):
+            return A * (m200c / 2e12)**B * (1. + z)**C
 
-        if overdensity == 200:
-            return c0
-
-        oldC = 100.
-        while (np.abs(c0 - oldC)/oldC >= 0.05):
-            oldC = c0
-            rscale = tools.rscaleConstM(m, c0, rho_crit, overdensity)
-            r200 = c0*rscale
-            m200c = 200*rho_crit*(4*np.pi/3)*r200**3
-            c0 = A * (m200c / 2e12)**B * (1. + z)**C
-
-        return c0
+        return iterateC200(mc200, m, z, overdensity)
 
 
 #########
@@ -113,7 +125,7 @@ class Duffy(object):
 
 class Bhattacharya(object):
 
-    def __call__(self, m, z):
+    def c200(self, m, z):
 
         """Compute the Duffy et al. mass concentration relation for a halo
         with
@@ -132,5 +144,9 @@ class Bhattacharya(object):
 
         return c200
 
+    def __call__(self, m, z, overdensity = 200):
+
+        return iterateC200(self.c200, m, z, overdensity)
+
 
 
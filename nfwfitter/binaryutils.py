@@ -20,3 +20,12 @@ def readVal(input, format, endian='@'):
     return struct.unpack(format, input.read(struct.calcsize(format)))[0]
 
 
+
+
+#########################
+
+def memmapArray(filename, format, shape, offset, order='C', endian='<'):
+    '''Read-only memory map of an array stored in a binary file, starting at offset bytes.
+    No data is read until it is accessed.'''
+    dtype = np.dtype('{0}{1}'.format(endian, format))
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=tuple(shape), order=order)
@@ -11,19 +11,91 @@ import numpy as np
 
 class MismatchedLengthException(Exception): pass
 
+################
+
+class _LazyColumn(object):
+    '''A column that has been filtered but not yet read: source[index]'''
+
+    __slots__ = ['source', 'index']
+
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+
+    def materialize(self):
+        return self.source[self.index]
+
+class _ColumnTable(dict):
+    '''Column name -> array. Entries may be _LazyColumns, which are
+    materialized (and stored) the first time they are read.'''
+
+    def __getitem__(self, key):
+        val = dict.__getitem__(self, key)
+        if isinstance(val, _LazyColumn):
+            val = val.materialize()
+            dict.__setitem__(self, key, val)
+        return val
+
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+
+    def rawitems(self):
+        return [(key, dict.__getitem__(self, key)) for key in self.keys()]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        newtable = _ColumnTable()
+        for key, val in self.rawitems():
+            dict.__setitem__(newtable, key, val)
+        return newtable
+
+################
+
 class Catalog(object):
+    '''Columnar catalog. Columns share a length; anything without a length is a header entry.
+
+    filter() does not copy data: columns of the filtered catalog are views
+    (source array, row index) that are only read out when accessed.
+    Filters compose, so chained filters index the original array once.
+    copy() shares the underlying tables until either catalog is assigned
+    to, at which point that catalog takes its own copy of the tables.'''
 
     def __init__(self):
-        super(Catalog, self).__setattr__('table', {})
+        super(Catalog, self).__setattr__('table', _ColumnTable())
         super(Catalog, self).__setattr__('header', {})
         super(Catalog, self).__setattr__('length', -1)
+        super(Catalog, self).__setattr__('_shared', False)
+
+    def _unshare(self):
+
+        if self._shared:
+            super(Catalog, self).__setattr__('table', self.table.copy())
+            super(Catalog, self).__setattr__('header', dict(self.header))
+            super(Catalog, self).__setattr__('_shared', False)
 
     def copy(self):
 
         newcat = Catalog()
-        newcat.header.update(self.header)
-        newcat.table.update(self.table)
+        super(Catalog, newcat).__setattr__('table', self.table)
+        super(Catalog, newcat).__setattr__('header', self.header)
         super(Catalog, newcat).__setattr__('length', self.length)
+        super(Catalog, newcat).__setattr__('_shared', True)
+        super(Catalog, self).__setattr__('_shared', True)
 
         return newcat
 
@@ -39,7 +111,13 @@ class Catalog(object):
         except KeyError:
             raise AttributeError(name)
 
+    def __getitem__(self, name):
+
+        return self.table[name]
+
     def __setattr__(self, name, val):
+
+        self._unshare()
         
         try:
 
@@ -67,8 +145,28 @@ class Catalog(object):
         newcat = Catalog()
         for key, val in self.header.iteritems():
             newcat.__setattr__(key, val)
-        for key, val in self.table.iteritems():
-            newcat.__setattr__(key, val[mask])
+
+        if self.length == -1:
+            return newcat
+
+        index = np.asarray(mask)
+        if index.dtype == np.bool:
+            index = np.flatnonzero(index)
+        elif index.ndim == 0:
+            index = np.arange(self.length)[mask]
+
+        #columns filtered by the same earlier view share one composed index
+        composed = {}
+        for key, val in self.table.rawitems():
+            if isinstance(val, _LazyColumn):
+                if id(val.index) not in composed:
+                    composed[id(val.index)] = val.index[index]
+                val = _LazyColumn(val.source, composed[id(val.index)])
+            else:
+                val = _LazyColumn(val, index)
+            dict.__setitem__(newcat.table, key, val)
+
+        super(Catalog, newcat).__setattr__('length', len(index))
 
         return newcat
 
@@ -144,6 +242,62 @@ class TestCatalog(unittest.TestCase):
         self.assertTrue((newcat.redshifts == 0).all())
         self.assertTrue(newcat.clusterz == 0.3)
         self.assertTrue((newcat.betas == betas).all())
+
+    ###
+
+    def testGetItem(self):
+
+        cat = Catalog()
+        cat.clusterz = 0.5
+        cat.redshifts = np.arange(5)
+
+        self.assertTrue((cat['redshifts'] == np.arange(5)).all())
+        with self.assertRaises(KeyError):
+            cat['clusterz']
+
+    ###
+
+    def testLazyFilter(self):
+
+        redshifts = np.arange(0.0, 1.0, 0.01)
+        betas = np.arange(len(redshifts))
+
+        cat = Catalog()
+        cat.clusterz = 0.5
+        cat.redshifts = redshifts
+        cat.betas = betas
+
+        newcat = cat.filter(np.argsort(-cat.redshifts)).filter(np.arange(10, 60))
+        newcat = newcat.filter(newcat.redshifts < 0.7)
+
+        expected = redshifts[::-1][10:60]
+        expectedbetas = betas[::-1][10:60][expected < 0.7]
+        expected = expected[expected < 0.7]
+        self.assertEqual(len(newcat), len(expected))
+        self.assertTrue((newcat.redshifts == expected).all())
+        self.assertTrue(isinstance(dict.__getitem__(newcat.table, 'betas'), _LazyColumn))
+        self.assertTrue((newcat.betas == expectedbetas).all())
+        self.assertEqual(newcat.clusterz, 0.5)
+
+    ###
+
+    def testCopyOnWrite(self):
+
+        redshifts = np.arange(0.0, 1.0, 0.01)
+
+        cat = Catalog()
+        cat.clusterz = 0.5
+        cat.redshifts = redshifts
+
+        newcat = cat.copy()
+        self.assertTrue(newcat.table is cat.table)
+
+        cat.clusterz = 0.3
+        cat.betas = np.ones_like(redshifts)
+
+        self.assertEqual(newcat.clusterz, 0.5)
+        self.assertFalse('betas' in newcat.table)
+        self.assertTrue(newcat.redshifts is cat.redshifts)
         
 
 
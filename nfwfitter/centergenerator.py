@@ -17,6 +17,9 @@ import nfwutils
 
 
 class NoOffset(object):
+
+    #same center for every sim; profilebuilder caches the geometry of such centers
+    fixedcenter = True
         
     def __call__(self, sim):
         return 0., 0.
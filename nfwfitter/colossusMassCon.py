@@ -2,9 +2,8 @@
 # Defines mass-con relations
 #########
 
-import numpy as np
 import nfwutils
-import nfwmodeltools as tools
+import basicMassCon
 import colossus.cosmology.cosmology as cCosmo
 import colossus.halo.concentration as chc
 
@@ -14,6 +13,7 @@ class IterateC200(object):
     def __call__(self, m, z, overdensity = 200, tolerance = 0.05):
 
         """Iterate to calculate c200 from an M_delta that isn't m200.
+        Accepts scalar or array masses.
 
         m           - in M_sun/h
         z           - redshift
@@ -23,22 +23,7 @@ class IterateC200(object):
         Heavily optimized by D. Applegate
         """
 
-        rho_crit = nfwutils.global_cosmology.rho_crit(z)
-
-        c0 = self.mc(m, z)
-
-        if overdensity == 200:
-            return c0
-
-        oldC = 100.
-        while (np.abs(c0 - oldC)/oldC >= 0.05):
-            oldC = c0
-            rscale = tools.rscaleConstM(m, c0, rho_crit, overdensity)
-            r200 = c0*rscale
-            m200c = 200*rho_crit*(4*np.pi/3)*r200**3
-            c0 = self.mc(m200c,z)
-
-        return c0
+        return basicMassCon.iterateC200(self.mc, m, z, overdensity, tolerance)
 
 
 #########
@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 ############################
 
-import glob, cPickle, sys, os, re
+import glob, cPickle, sys, os, re, multiprocessing
 import numpy as np
-import nfwutils, nfwfit
+import nfwutils, simutils
 
 ###########################
 
@@ -20,58 +20,169 @@ idpatterns = dict(mxxlsnap41 = re.compile('halo_41_(\d+_\d)\.out'),
 
 
 
-def consolidateFits(workdir, simtype, outdir):
+###########################
 
-    failfile = open('{0}/fails'.format(outdir), 'w')
+def loadFit(output):
+    '''Raw fit values from one output file: (m200, m200err, c200, failed),
+    in the fit's own mass units. c200 is nan if the fit did not measure it.'''
 
+    with open(output, 'rb') as input:
+        measured = cPickle.load(input)
 
-    idpattern = idpatterns[simtype]
+    if measured is None:
+        return (0., 0., np.nan, True)
 
-    answers = cPickle.load(open('{0}/{1}_answers.pkl'.format(workdir, simtype), 'rb'))
+    fitvals, fiterrs = measured[0], measured[1]
 
-    outputfiles = glob.glob('%s/*.out' % outdir)
-    nhalos = len(outputfiles)
+    return (fitvals['m200'],
+            np.mean(np.abs(fiterrs['m200'])),
+            fitvals.get('c200', np.nan),
+            False)
 
-    ids = []
-    measured_m200s = np.zeros(nhalos)
-    measured_m200errs = np.zeros(nhalos)
-    measured_m500s = np.zeros(nhalos)
-    measured_m500errs = np.zeros(nhalos)
-    measured_cs = np.zeros(nhalos)
-    measured_rs = np.zeros(nhalos)
+def _loadFitRecord(args):
 
-    true_m200s = np.zeros(nhalos)
-    true_m500s = np.zeros(nhalos)
-    true_cs = np.zeros(nhalos)
-    redshifts = np.zeros(nhalos)
+    output, mtime, size = args
+    return (os.path.basename(output), mtime, size) + loadFit(output)
 
-    results = dict(ids = ids,
-                        measured_m200s = measured_m200s, 
-                        measured_m200errs = measured_m200errs,
-                        measured_m500s = measured_m500s,
-                        measured_m500errss = measured_m500errs,
-                        measured_cs = measured_cs,
-                        measured_rs = measured_rs,
-                        true_m200s = true_m200s,
-                        true_m500s = true_m500s,
-                        true_cs = true_cs,
-                        redshifts = redshifts)
+###########################
+
+fitcolumns = ['files', 'mtimes', 'sizes', 'raw_m200s', 'raw_m200errs', 'raw_cs', 'failed']
+
+def loadFitStore(storefile):
+    '''Columns written by updateFitStore, or None.'''
+
+    if not os.path.exists(storefile):
+        return None
+
+    with np.load(storefile) as store:
+        return dict([(col, store[col]) for col in fitcolumns])
+
+def scanOutputs(outdir, previous):
+    '''The *.out files in outdir, sorted, and their os.stat. Against a previous
+    store (columns files, mtimes & sizes, or None), also the store rows whose
+    file is unchanged, and the indices into the output files of new or changed
+    files. Returns (outputfiles, stats, reuse, toload).'''
+
+    outputfiles = sorted(glob.glob('%s/*.out' % outdir))
+    stats = [os.stat(output) for output in outputfiles]
+
+    known = {}
+    if previous is not None:
+        for i, filebase in enumerate(previous['files']):
+            known[filebase] = i
+
+    reuse = []
+    toload = []
+    for k, (output, stat) in enumerate(zip(outputfiles, stats)):
+        i = known.get(os.path.basename(output))
+        if i is not None and previous['mtimes'][i] == stat.st_mtime and previous['sizes'][i] == stat.st_size:
+            reuse.append(i)
+        else:
+            toload.append(k)
+
+    return outputfiles, stats, reuse, toload
+
+def poolMap(func, args, nprocs = None):
+    '''map(func, args) on a pool of nprocs processes (default: all cores),
+    or serially when there are no more args than processes.'''
+
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+
+    if nprocs > 1 and len(args) > nprocs:
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            return pool.map(func, args, chunksize = max(1, len(args) / (4*nprocs)))
+        finally:
+            pool.close()
+            pool.join()
+
+    return map(func, args)
+
+def updateFitStore(outdir, storefile, nprocs = None):
+    '''Bring the columnar store of raw fit values up to date with the *.out
+    files in outdir. Files whose mtime and size match the store are not
+    reopened; new or changed files are unpickled on a process pool.
+    Returns the store columns, in sorted file order.'''
+
+    previous = loadFitStore(storefile)
+    outputfiles, stats, reuse, toload = scanOutputs(outdir, previous)
+
+    print 'Loading %d new or changed outputs, reusing %d' % (len(toload), len(reuse))
+
+    records = poolMap(_loadFitRecord,
+                      [(outputfiles[k], stats[k].st_mtime, stats[k].st_size) for k in toload],
+                      nprocs)
+
+    columns = {}
+    for k, col in enumerate(fitcolumns):
+        newvals = np.array([record[k] for record in records])
+        if previous is None:
+            columns[col] = newvals
+        elif len(newvals) == 0:
+            columns[col] = previous[col][reuse]
+        else:
+            columns[col] = np.hstack([previous[col][reuse], newvals])
+
+    columns['files'] = columns['files'].astype(str)
+    order = np.argsort(columns['files'])
+    for col in fitcolumns:
+        columns[col] = columns[col][order]
+
+    tmpfile = '%s.tmp.npz' % storefile
+    np.savez(tmpfile, **columns)
+    os.rename(tmpfile, storefile)
+
+    return columns
+
+###########################
 
-    class WeirdException(Exception): pass 
+def convertFits(raw_m200s, raw_cs, redshifts, model, delta = 500):
+    '''Vectorized measured m200 (h units), concentration, r_s and m_delta.
+    Missing concentrations come from the model's mass-concentration relation.'''
 
+    h = nfwutils.global_cosmology.h
+
+    m200s = raw_m200s*model.massScale*h
+
+    cs = np.array(raw_cs, dtype = np.float64)
+    needc = np.logical_not(np.isfinite(cs))
+    #relations take arrays of masses, but not all take arrays of redshifts
+    for z in np.unique(redshifts[needc]):
+        atz = np.logical_and(needc, redshifts == z)
+        cs[atz] = model.massconRelation(np.abs(m200s[atz]), z, model.overdensity)
+
+    rho_c = nfwutils.global_cosmology.rho_crit(redshifts)
+    rdeltas = (3*np.abs(m200s)/(4*model.overdensity*np.pi*rho_c))**(1./3.)
+    rs = rdeltas/nfwutils.xdelta(cs, model.overdensity)
+
+    mdeltas = delta*rho_c*(4*np.pi/3)*(rs*nfwutils.xdelta(cs, delta))**3
+    mdeltas = np.where(m200s < 0, -mdeltas, mdeltas)
+
+    return m200s, cs, rs, mdeltas
+
+###########################
+
+def consolidateFits(workdir, simtype, outdir, nprocs = None):
+
+    idpattern = idpatterns[simtype]
+
+    answers = cPickle.load(open('{0}/{1}_answers.pkl'.format(workdir, simtype), 'rb'))
 
     #load up the environment for cosmology, and mc relation if used
-    config = nfwfit.readConfiguration('{0}/config.sh'.format(outdir))
-    simreader = nfwfit.buildSimReader(config)
+    config = simutils.readConfiguration('{0}/config.py'.format(outdir))
+    simreader = config['simreader']
     nfwutils.global_cosmology.set_cosmology(simreader.getCosmology())
-    fitter = nfwfit.buildFitter(config)
+    model = config['fitter'].model
 
     configname = os.path.basename(outdir)
 
+    store = updateFitStore(outdir, '{0}/consolidated.npz'.format(outdir), nprocs = nprocs)
 
-    for i,output in enumerate(outputfiles):
+    nhalos = len(store['files'])
 
-        filebase = os.path.basename(output)
+    ids = []
+    for filebase in store['files']:
 
         match = idpattern.match(filebase)
 
@@ -83,68 +194,57 @@ def consolidateFits(workdir, simtype, outdir):
         except ValueError:
             haloid = match.group(1)
 
-        try:
-            truth = answers[haloid]
-        except KeyError:
-            print 'Failure at {0}'.format(output)
-            raise
         ids.append(haloid)
-        true_m200s[i] = truth['m200']
-        true_m500s[i] = truth['m500']
-        true_cs[i] = truth['concen']
-        redshifts[i] = truth['redshift']
 
+    try:
+        truths = [answers[haloid] for haloid in ids]
+    except KeyError as e:
+        print 'Failure at {0}'.format(e)
+        raise
 
+    true_m200s = np.array([truth['m200'] for truth in truths], dtype = np.float64)
+    true_m500s = np.array([truth['m500'] for truth in truths], dtype = np.float64)
+    true_cs = np.array([truth['concen'] for truth in truths], dtype = np.float64)
+    redshifts = np.array([truth['redshift'] for truth in truths], dtype = np.float64)
 
-        input = open(output)
-        measured = cPickle.load(input)
-        input.close()
-
-
-        if measured is None:
-            print 'Fail {0} {1}'.format(configname, haloid)
-            failfile.write('Fail {0} {1}\n'.format(configname, haloid))
-            continue
-
-
-        measured_m200s[i] = measured[0]['m200']*fitter.model.massScale*nfwutils.global_cosmology.h
-        measured_m200errs[i] = np.mean(np.abs(measured[1]['m200']))*fitter.model.massScale*nfwutils.global_cosmology.h
-        if 'c200' in measured:
-            measured_cs[i] = measured['c200']
-        else:
-            ## need to dig up the mc relation
-            measured_cs[i] = fitter.model.massconRelation(np.abs(measured_m200s[i]), 
-                                                          redshifts[i], 
-                                                          fitter.model.overdensity)
-
-        #####
-        #calculate m500
-
-        measured_rs[i] = nfwutils.rscaleConstM(np.abs(measured_m200s[i]), measured_cs[i],redshifts[i],
-                                      fitter.model.overdensity)
-        measured_m500s[i] = nfwutils.Mdelta(measured_rs[i],
-                                            measured_cs[i],
-                                            redshifts[i],
-                                            500)
-
-        if measured_m200s[i] < 0:
-            measured_m500s[i] = -measured_m500s[i]
-
-        if not np.isfinite(measured_m500s[i]):
-            print 'NOT FINITE'
-            print haloid
-            print measured
-
-
+    failed = store['failed'].astype(bool)
+    ok = np.logical_not(failed)
 
+    measured_m200s = np.zeros(nhalos)
+    measured_m200errs = np.zeros(nhalos)
+    measured_m500s = np.zeros(nhalos)
+    measured_m500errs = np.zeros(nhalos)
+    measured_cs = np.zeros(nhalos)
+    measured_rs = np.zeros(nhalos)
 
+    measured_m200s[ok], measured_cs[ok], measured_rs[ok], measured_m500s[ok] = \
+        convertFits(store['raw_m200s'][ok], store['raw_cs'][ok], redshifts[ok], model)
+    measured_m200errs[ok] = store['raw_m200errs'][ok]*model.massScale*nfwutils.global_cosmology.h
 
+    with open('{0}/fails'.format(outdir), 'w') as failfile:
+        for i in np.flatnonzero(failed):
+            print 'Fail {0} {1}'.format(configname, ids[i])
+            failfile.write('Fail {0} {1}\n'.format(configname, ids[i]))
 
+    for i in np.flatnonzero(ok & np.logical_not(np.isfinite(measured_m500s))):
+        print 'NOT FINITE'
+        print ids[i]
 
+    results = dict(ids = ids,
+                        measured_m200s = measured_m200s, 
+                        measured_m200errs = measured_m200errs,
+                        measured_m500s = measured_m500s,
+                        measured_m500errss = measured_m500errs,
+                        measured_cs = measured_cs,
+                        measured_rs = measured_rs,
+                        true_m200s = true_m200s,
+                        true_m500s = true_m500s,
+                        true_cs = true_cs,
+                        redshifts = redshifts)
 
     cPickle.dump(results, open('%s/consolidated.pkl' % outdir, 'w'))
 
-    failfile.close()    
+    return results
 
 
 
@@ -154,5 +254,8 @@ if __name__ == '__main__':
     workdir=sys.argv[1]
     simtype=sys.argv[2]
     outdir=sys.argv[3]
+    nprocs = None
+    if len(sys.argv) > 4:
+        nprocs = int(sys.argv[4])
 
-    consolidateFits(workdir, simtype, outdir)
+    consolidateFits(workdir, simtype, outdir, nprocs)
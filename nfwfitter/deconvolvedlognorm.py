@@ -5,7 +5,7 @@
 
 
 
-import glob, cPickle, os, shutil, tempfile, pkg_resources
+import glob, cPickle, os, shutil, tempfile, pkg_resources, fcntl, contextlib
 import numpy as np
 import pymc
 import consolidate_fits
@@ -23,32 +23,79 @@ class BadPDFException(Exception): pass
 
 #######################
 
-def MCMCReader(inputfile, halo, delta, truth, thin=1, cprior = None, burn=500):
-
+def readMCMCSamples(inputfile, delta):
+    '''Raw (mdelta, cdelta, weights) chains for one halo, in the fit's mass units.
+    weights are the importance weights of chains converted from delta = 200
+    (nfwfit.MCMCFitter.transformChain), or None for chains sampled at delta.'''
 
     with open(inputfile, 'rb') as input:
         masschains = cPickle.load(input)
 
+    chain = masschains[delta]
+
+    weights = None
+    if 'weights' in chain:
+        weights = np.array(chain['weights'], dtype = np.float64).ravel()
+
+    return (np.array(chain['mdelta'], dtype = np.float64).ravel(),
+            np.array(chain['cdelta'], dtype = np.float64).ravel(),
+            weights)
+
+def resampleWeighted(weights):
+    '''Indices of an equally weighted resample (systematic, so deterministic)
+    of samples with importance weights. Zero weight samples are never drawn.'''
+
+    cumweights = np.cumsum(weights)
+    nsamples = len(weights)
+    if nsamples == 0 or cumweights[-1] <= 0:
+        return np.zeros(0, dtype = np.int64)
+
+    positions = (np.arange(nsamples) + 0.5)*(cumweights[-1]/nsamples)
+
+    return np.searchsorted(cumweights, positions, side = 'right')
+
+def selectMCMCSamples(halo, msamples, csamples, thin=1, cprior = None, burn=500, weights = None):
+
     # Burns first 500 samples from the chains
-    msamples = np.array(masschains[delta]['mdelta'][burn::thin])*nfwutils.global_cosmology.h
-    csamples = np.array(masschains[delta]['cdelta'][burn::thin])
+    msamples = msamples[burn::thin]*nfwutils.global_cosmology.h
+    csamples = csamples[burn::thin]
+    if weights is not None:
+        weights = weights[burn::thin]
     
     if cprior is not None:
         cfilter = csamples < cprior
 
         msamples = msamples[cfilter]
         csamples = csamples[cfilter]
+        if weights is not None:
+            weights = weights[cfilter]
+
+    #converted chains carry the delta = 200 priors until resampled by weight
+    if weights is not None:
+        resampled = resampleWeighted(weights)
+        msamples = msamples[resampled]
+        csamples = csamples[resampled]
 
     halo['mass_samples'] = msamples
     halo['concentration_samples'] = csamples
 
     return halo
 
+def MCMCReader(inputfile, halo, delta, truth, thin=1, cprior = None, burn=500):
+
+    msamples, csamples, weights = readMCMCSamples(inputfile, delta)
+
+    return selectMCMCSamples(halo, msamples, csamples, thin = thin, cprior = cprior, burn = burn,
+                             weights = weights)
+
 ###
 
 
 
-def PDFReader(pdffile, halo, delta, truth, model=None):
+def readPDF(pdffile, delta, truth, model=None):
+    '''Raw (masses, pdf) for one halo at overdensity delta, in the fit's mass units.'''
+
+    filebase = os.path.basename(pdffile)
 
     with open(pdffile, 'rb') as input:
         masses, pdfs = cPickle.load(input)
@@ -67,27 +114,56 @@ def PDFReader(pdffile, halo, delta, truth, model=None):
     if np.any(np.logical_not(np.isfinite(pdf))):
         raise BadPDFException(filebase)
 
+    return masses, pdf
+
+def selectPDF(halo, masses, pdf):
+
     halo['masses'] = masses*nfwutils.global_cosmology.h
     
     halo['pdf'] = pdf/nfwutils.global_cosmology.h
 
     return halo
 
+def PDFReader(pdffile, halo, delta, truth, model=None):
+
+    masses, pdf = readPDF(pdffile, delta, truth, model = model)
+
+    return selectPDF(halo, masses, pdf)
+
 ###
 
+def parseHaloid(idpattern, filebase):
 
+    match = idpattern.match(filebase)
+
+    try:
+        return int(match.group(1))
+    except AttributeError as e:
+        print filebase
+        raise e
+    except ValueError:
+        return match.group(1)
+
+###
 
 
 def loadPosteriors(pdfdir, simtype, simreader, delta, selector,
-                   reader = MCMCReader, **kwds):
+                   reader = MCMCReader, store = False, **kwds):
+    '''Halo dicts for every halo in pdfdir passing selector(truth).
+    With store=True, the posterior store in pdfdir is brought up to date
+    and queried instead of unpickling every output.'''
 
     mass = 'm%d' % delta
 
     nfwutils.global_cosmology.set_cosmology(simreader.getCosmology())
 
+    if store:
+        storedir = updatePosteriorStore(pdfdir, simtype, delta, reader, model = kwds.pop('model', None))
+        return queryPosteriorStore(storedir, selector, **kwds)
+
     idpattern = consolidate_fits.idpatterns[simtype]
 
-    answers = cPickle.load(pkg_resources.resource_stream('nfwfitter', 'data/{0}_answers.pkl'.format(simtype)))
+    answers = loadAnswers(simtype)
 
         
     halos = []
@@ -98,21 +174,12 @@ def loadPosteriors(pdfdir, simtype, simreader, delta, selector,
 
         filebase = os.path.basename(pdffile)
 
-        match = idpattern.match(filebase)
-        
-
-        try:
-            haloid = int(match.group(1))
-        except AttributeError as e:
-            print filebase
-            raise e
-        except ValueError:
-            haloid = match.group(1)
+        haloid = parseHaloid(idpattern, filebase)
 
         try:
             truth = answers[haloid]
         except KeyError:
-            print 'Failure at {0}'.format(output)
+            print 'Failure at {0}'.format(haloid)
             raise
 
         if not selector(truth):
@@ -134,6 +201,287 @@ def loadPosteriors(pdfdir, simtype, simreader, delta, selector,
                          
     return halos
 
+def loadAnswers(simtype):
+
+    return cPickle.load(pkg_resources.resource_stream('nfwfitter', 'data/{0}_answers.pkl'.format(simtype)))
+
+#######################
+# Posterior store
+#
+# One directory per chain directory, overdensity and output type, holding
+#   index.npz    file names, mtimes and sizes, halo ids, truth columns,
+#                a bad-output flag, and for chains the row offsets
+#   masses.npy   the shared mass grid (pdf)
+#   pdfs.npy     nhalos x nmasses (pdf)
+#   mass_samples.npy, concentration_samples.npy, sample_weights.npy
+#                all halos' chains and their importance weights (1 for
+#                chains sampled at delta), concatenated (mcmc)
+# The .npy files are memory mapped on query, so only selected rows are read.
+# Files are written under unique temporary names and renamed into place,
+# and a lock file keeps updates from overlapping each other or a query.
+# Masses are in the fit's units; h is applied on query, as the readers do.
+#######################
+
+storekinds = {MCMCReader : 'mcmc', PDFReader : 'pdf'}
+
+storearrays = dict(pdf = ['masses', 'pdfs'],
+                   mcmc = ['mass_samples', 'concentration_samples', 'sample_weights'])
+
+def posteriorStoreDir(pdfdir, delta, reader):
+
+    return '{0}/posteriorstore_{1}_{2}'.format(pdfdir, storekinds[reader], delta)
+
+def _loadPosteriorRecord(args):
+
+    pdffile, kind, delta, truth, model = args
+
+    try:
+        if kind == 'pdf':
+            return readPDF(pdffile, delta, truth, model = model)
+        return readMCMCSamples(pdffile, delta)
+    except BadPDFException, e:
+        print e
+        return None
+
+def loadPosteriorIndex(storedir):
+    '''Index columns of a posterior store, or None.'''
+
+    indexfile = '{0}/index.npz'.format(storedir)
+    if not os.path.exists(indexfile):
+        return None
+
+    with np.load(indexfile) as index:
+        return dict([(col, index[col]) for col in index.files])
+
+def _saveStoreFile(storedir, filename, save, data):
+
+    #unique temporary name, renamed into place, so concurrent writers can't collide
+    tmpfile = tempfile.NamedTemporaryFile(dir = storedir, suffix = '.tmp', delete = False)
+    save(tmpfile, data)
+    tmpfile.close()
+    os.rename(tmpfile.name, '{0}/{1}'.format(storedir, filename))
+
+def _saveStoreArray(storedir, name, array):
+
+    _saveStoreFile(storedir, '{0}.npy'.format(name), np.save, array)
+
+@contextlib.contextmanager
+def _storeLock(storedir, exclusive):
+    '''Updates hold the store exclusively, from reading the old index to
+    writing the new one. Queries share it while opening the index & arrays.'''
+
+    with open('{0}/lock'.format(storedir), 'a+') as lockfile:
+        fcntl.lockf(lockfile, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lockfile, fcntl.LOCK_UN)
+
+def updatePosteriorStore(pdfdir, simtype, delta, reader = MCMCReader, model = None, nprocs = None):
+    '''Bring the posterior store for pdfdir up to date with its *.out files.
+    Outputs whose mtime and size match the store are not reopened. Safe to
+    call from concurrent jobs; they take turns. Returns the store directory.'''
+
+    storedir = posteriorStoreDir(pdfdir, delta, reader)
+    try:
+        os.makedirs(storedir)
+    except OSError:
+        if not os.path.isdir(storedir):
+            raise
+
+    with _storeLock(storedir, exclusive = True):
+        _updatePosteriorStore(pdfdir, storedir, simtype, delta, reader, model, nprocs)
+
+    return storedir
+
+def _updatePosteriorStore(pdfdir, storedir, simtype, delta, reader, model, nprocs):
+
+    kind = storekinds[reader]
+
+    previous = loadPosteriorIndex(storedir)
+    if previous is not None and kind == 'mcmc' and \
+            not os.path.exists('{0}/sample_weights.npy'.format(storedir)):
+        previous = None   #written before chains kept their weights; rebuild
+
+    outputfiles, stats, reuse, toload = consolidate_fits.scanOutputs(pdfdir, previous)
+    toload = [outputfiles[k] for k in toload]
+
+    if previous is not None and len(toload) == 0 and len(reuse) == len(previous['files']):
+        return
+
+    print 'Loading %d new or changed posteriors, reusing %d' % (len(toload), len(reuse))
+
+    idpattern = consolidate_fits.idpatterns[simtype]
+    answers = loadAnswers(simtype)
+
+    files = [os.path.basename(output) for output in outputfiles]
+    ids = [parseHaloid(idpattern, filebase) for filebase in files]
+    try:
+        truths = [answers[haloid] for haloid in ids]
+    except KeyError as e:
+        print 'Failure at {0}'.format(e)
+        raise
+
+    truthkeys = sorted(reduce(lambda x,y: x & y, [set(truth.keys()) for truth in truths]))
+
+    newtruths = [truths[files.index(os.path.basename(output))] for output in toload]
+    args = [(output, kind, delta, truth, model) for output, truth in zip(toload, newtruths)]
+
+    records = consolidate_fits.poolMap(_loadPosteriorRecord, args, nprocs)
+
+    #rows in sorted file order: reused rows keep their previous position in
+    # the old store, new rows index into records
+    rows = {}
+    for i in reuse:
+        rows[previous['files'][i]] = ('old', i)
+    for k, output in enumerate(toload):
+        rows[os.path.basename(output)] = ('new', k)
+    rows = [rows[filebase] for filebase in files]
+
+    nhalos = len(files)
+
+    index = dict(files = np.array(files, dtype = str),
+                 mtimes = np.array([stat.st_mtime for stat in stats], dtype = np.float64),
+                 sizes = np.array([stat.st_size for stat in stats], dtype = np.int64),
+                 ids = np.array(map(str, ids), dtype = str),
+                 truthkeys = np.array(truthkeys, dtype = str),
+                 kind = np.array(kind),
+                 delta = np.array(delta),
+                 bad = np.array([(source == 'old' and bool(previous['bad'][i])) or \
+                                     (source == 'new' and records[i] is None) \
+                                     for source, i in rows], dtype = bool))
+    for key in truthkeys:
+        index['truth_%s' % key] = np.array([truth[key] for truth in truths], dtype = np.float64)
+
+    if kind == 'pdf':
+
+        oldmasses = oldpdfs = None
+        if previous is not None and len(reuse) > 0:
+            oldmasses = np.load('{0}/masses.npy'.format(storedir))
+            oldpdfs = np.load('{0}/pdfs.npy'.format(storedir), mmap_mode = 'r')
+
+        masses = oldmasses
+        for record in records:
+            if record is None:
+                continue
+            if masses is None:
+                masses = np.array(record[0], dtype = np.float64)
+            elif len(record[0]) != len(masses) or np.any(record[0] != masses):
+                raise ValueError('Posterior store needs a shared mass grid')
+
+        if masses is None:
+            masses = np.zeros(0)
+
+        pdfs = np.zeros((nhalos, len(masses)))
+        for j, (source, i) in enumerate(rows):
+            if index['bad'][j]:
+                pdfs[j] = np.nan
+            elif source == 'old':
+                pdfs[j] = oldpdfs[i]
+            else:
+                pdfs[j] = records[i][1]
+        del oldpdfs
+
+        _saveStoreArray(storedir, 'masses', masses)
+        _saveStoreArray(storedir, 'pdfs', pdfs)
+
+    else:
+
+        if previous is not None and len(reuse) > 0:
+            oldoffsets = previous['offsets']
+            oldmsamples = np.load('{0}/mass_samples.npy'.format(storedir), mmap_mode = 'r')
+            oldcsamples = np.load('{0}/concentration_samples.npy'.format(storedir), mmap_mode = 'r')
+            oldweights = np.load('{0}/sample_weights.npy'.format(storedir), mmap_mode = 'r')
+
+        msamples = []
+        csamples = []
+        weights = []
+        for j, (source, i) in enumerate(rows):
+            if index['bad'][j]:
+                msamples.append(np.zeros(0))
+                csamples.append(np.zeros(0))
+                weights.append(np.zeros(0))
+            elif source == 'old':
+                msamples.append(oldmsamples[oldoffsets[i]:oldoffsets[i+1]])
+                csamples.append(oldcsamples[oldoffsets[i]:oldoffsets[i+1]])
+                weights.append(oldweights[oldoffsets[i]:oldoffsets[i+1]])
+            else:
+                mrecord, crecord, wrecord = records[i]
+                msamples.append(mrecord)
+                csamples.append(crecord)
+                weights.append(np.ones(len(mrecord)) if wrecord is None else wrecord)
+
+        index['offsets'] = np.hstack([0, np.cumsum([len(x) for x in msamples])]).astype(np.int64)
+
+        _saveStoreArray(storedir, 'mass_samples', np.hstack(msamples).astype(np.float64))
+        _saveStoreArray(storedir, 'concentration_samples', np.hstack(csamples).astype(np.float64))
+        _saveStoreArray(storedir, 'sample_weights', np.hstack(weights).astype(np.float64))
+
+    #index goes last; it marks the store as complete
+    _saveStoreFile(storedir, 'index.npz', lambda output, index: np.savez(output, **index), index)
+
+def queryPosteriorStore(storedir, selector, **kwds):
+    '''Halo dicts, as from loadPosteriors, for stored halos passing
+    selector(truth). Extra keywords go to selectMCMCSamples for chains.'''
+
+    if not os.path.isdir(storedir):
+        raise IOError('No posterior store in {0}'.format(storedir))
+
+    #opened together under the lock, so the arrays always match the index
+    with _storeLock(storedir, exclusive = False):
+        index = loadPosteriorIndex(storedir)
+        if index is None:
+            raise IOError('No posterior store in {0}'.format(storedir))
+        arrays = dict([(name, np.load('{0}/{1}.npy'.format(storedir, name), mmap_mode = 'r')) \
+                           for name in storearrays[str(index['kind'])]])
+
+    mass = 'm%d' % int(index['delta'])
+
+    truthkeys = list(index['truthkeys'])
+    truthcols = [index['truth_%s' % key] for key in truthkeys]
+
+    selected = []
+    for i in range(len(index['files'])):
+        if index['bad'][i]:
+            continue
+        truth = dict(zip(truthkeys, [col[i] for col in truthcols]))
+        if selector(truth):
+            selected.append(i)
+    selected = np.array(selected, dtype = np.int64)
+
+    halos = []
+    for i in selected:
+        try:
+            haloid = int(index['ids'][i])
+        except ValueError:
+            haloid = str(index['ids'][i])
+        halos.append(dict(id = haloid,
+                          true_mass = index['truth_%s' % mass][i]))
+
+    if str(index['kind']) == 'pdf':
+
+        masses = np.array(arrays['masses'])
+        pdfs = arrays['pdfs'][selected]
+        for halo, pdf in zip(halos, pdfs):
+            selectPDF(halo, masses, pdf)
+
+    else:
+
+        offsets = index['offsets']
+        msamples = arrays['mass_samples']
+        csamples = arrays['concentration_samples']
+        weights = arrays['sample_weights']
+        for halo, i in zip(halos, selected):
+            selectMCMCSamples(halo,
+                              np.array(msamples[offsets[i]:offsets[i+1]]),
+                              np.array(csamples[offsets[i]:offsets[i+1]]),
+                              weights = np.array(weights[offsets[i]:offsets[i+1]]),
+                              **kwds)
+
+    print 'Num Halos: ', len(halos)
+
+    return halos
+
 
 
 
@@ -353,7 +701,10 @@ def buildGaussMixture1DModel(halos, ngauss, modeltype='ratio'):
 #####################
 
 
-def buildPDFModel(halos, sigmapriors = None):
+def buildPDFModel(halos, sigmapriors = None, grid = False, dx = 0.005):
+    '''With grid=True, the halo PDFs are first resampled onto a shared
+    ln(M_lens/M_true) grid (see logRatioPDFs), so each likelihood call is one
+    kernel evaluation and a matrix-vector product instead of a per-halo integral.'''
 
     parts = {}
 
@@ -371,6 +722,19 @@ def buildPDFModel(halos, sigmapriors = None):
     
     parts['sigma'] = sigma
 
+    if grid:
+
+        xs, xpdfs = logRatioPDFs(halos, dx = dx)
+
+        @pymc.observed
+        def data(value = 0., xs = xs, xpdfs = xpdfs,
+                 logmu = parts['logmu'], sigma = parts['sigma']):
+
+            return pdfgridloglinearlike(xs, xpdfs, logmu, sigma)
+        parts['data'] = data
+
+        return parts
+
     masses = halos[0]['masses']
     posmasses = masses[masses > 0]
     nmasses = len(posmasses)
@@ -407,6 +771,112 @@ def buildPDFModel(halos, sigmapriors = None):
 
     return parts
 
+def buildPDFGridModel(halos, sigmapriors = None):
+
+    return buildPDFModel(halos, sigmapriors = sigmapriors, grid = True)
+
+###
+
+def logRatioPDFs(halos, dx = 0.005, tol = 1e-12):
+    '''Each halo's normalized PDF, resampled as a function of
+    x = ln(M_lens/M_true) on a grid shared by all halos.
+    Returns (xs, pdfs); xs is uniform with spacing dx, trimmed to where
+    any halo has more than tol of its peak density.'''
+
+    masses = halos[0]['masses']
+    posmasses = masses[masses > 0]
+
+    nclusters = len(halos)
+    truemasses = np.array([halo['true_mass'] for halo in halos], dtype = np.float64)
+
+    xmin = np.log(posmasses[0]/np.max(truemasses))
+    xmax = np.log(posmasses[-1]/np.min(truemasses))
+    xs = dx*np.arange(np.floor(xmin/dx), np.ceil(xmax/dx) + 1)
+
+    pdfs = np.zeros((nclusters, len(xs)))
+    for i in range(nclusters):
+
+        rawpdf = halos[i]['pdf'][masses>0]
+        rawpdf = rawpdf / scipy.integrate.trapz(rawpdf, posmasses)
+        if not (rawpdf > 0).any():
+            print 'WARNING: Halo {} has zero probability'.format(halos[i]['id'])
+
+        #the lognormal's 1/M_lens cancels dM_lens/dx, so the likelihood
+        # is integrated against a normal in x as is
+        pdfs[i,:] = np.interp(truemasses[i]*np.exp(xs), posmasses, rawpdf, left = 0., right = 0.)
+
+    support = np.flatnonzero(np.any(pdfs > tol*np.max(pdfs, axis=1)[:,None], axis=0))
+    if len(support) > 0:
+        xs = xs[support[0]:support[-1]+1]
+        pdfs = pdfs[:,support[0]:support[-1]+1]
+
+    return xs, np.ascontiguousarray(pdfs)
+
+###
+
+def lognormKernel(xs, logmus, sigma):
+    '''Quadrature weights for integrating a function on the uniform grid xs
+    against a normal in x with mean logmu and width sigma. Shape (len(xs), len(logmus)).'''
+
+    dx = xs[1] - xs[0]
+    return np.exp(-0.5*((xs[:,None] - np.atleast_1d(logmus)[None,:])/sigma)**2)*(dx/(sigma*np.sqrt(2*np.pi)))
+
+def pdfgridloglinearlike(xs, pdfs, logmu, sigma):
+    '''Same likelihood as dlntools.pdfloglinearlike, for PDFs from logRatioPDFs.'''
+
+    probs = np.dot(pdfs, lognormKernel(xs, logmu, sigma)[:,0])
+
+    return np.sum(np.log(probs))
+
+###
+
+def pdfGridPosterior(halos, logmus = None, logsigmas = None, sigmapriors = None, dx = 0.005):
+    '''Log posterior of the buildPDFModel parameters evaluated directly on a
+    dense (logsigma, logmu) grid, as an alternative to sampling.
+    Defaults span the buildPDFModel priors.
+    Returns (logmus, logsigmas, logpost), with logpost of shape
+    (len(logsigmas), len(logmus)) and shifted so its maximum is 0.'''
+
+    if logmus is None:
+        logmus = np.linspace(-1., 1., 201)
+    if logsigmas is None:
+        logsigmas = np.linspace(np.log(0.05), np.log(10), 151)
+
+    xs, pdfs = logRatioPDFs(halos, dx = dx)
+
+    logpost = np.zeros((len(logsigmas), len(logmus)))
+
+    with np.errstate(divide = 'ignore'):
+        for i, logsigma in enumerate(logsigmas):
+
+            probs = np.dot(pdfs, lognormKernel(xs, logmus, np.exp(logsigma)))
+            logpost[i,:] = np.sum(np.log(probs), axis=0)
+
+    if sigmapriors is not None:
+        logpost += scipy.stats.norm.logpdf(logsigmas, sigmapriors[0], sigmapriors[1])[:,None]
+
+    logpost -= np.max(logpost)
+
+    return logmus, logsigmas, logpost
+
+def sampleGridPosterior(logmus, logsigmas, logpost, nsamples = 10000):
+    '''Draw samples from a gridded posterior from pdfGridPosterior, in the
+    same chain format as sample(). Samples are uniform within each grid cell.'''
+
+    mucells = np.gradient(logmus) if len(logmus) > 1 else np.ones(1)
+    sigmacells = np.gradient(logsigmas) if len(logsigmas) > 1 else np.ones(1)
+
+    weights = np.exp(logpost)*sigmacells[:,None]*mucells[None,:]
+    weights = weights.ravel()/np.sum(weights)
+
+    cells = np.random.choice(len(weights), size = nsamples, p = weights)
+    sigmaindex, muindex = np.unravel_index(cells, logpost.shape)
+
+    logmu = logmus[muindex] + mucells[muindex]*np.random.uniform(-0.5, 0.5, nsamples)
+    logsigma = logsigmas[sigmaindex] + sigmacells[sigmaindex]*np.random.uniform(-0.5, 0.5, nsamples)
+
+    return dict(logmu = logmu, logsigma = logsigma, sigma = np.exp(logsigma))
+
 
         
                                                                                    
@@ -579,8 +1049,10 @@ def runFit(parts):
 
 #######################################
 
-def sample(parts, outputfile, samples, adaptevery = 100, adaptafter = 100, singlecore = False, tempoutputdir=None, init_with_MAP=True):
-    '''This function saves to disk the samples from the chain as they're drawn. '''
+def sample(parts, outputfile, samples, adaptevery = 100, adaptafter = 100, singlecore = False, tempoutputdir=None, init_with_MAP=True, stopping = None, chainformat = 'npy'):
+    '''This function saves to disk the samples from the chain as they're drawn.
+    stopping is an optional mymc.ConvergenceStopping; samples is then the maximum chain length.
+    chainformat is 'npy' or 'text'; load_chains.loadChains reads either. '''
     del_tempoutdir = False
     if tempoutputdir is None :
         tempoutputdir = tempfile.mkdtemp()
@@ -594,6 +1066,9 @@ def sample(parts, outputfile, samples, adaptevery = 100, adaptafter = 100, singl
     options.adapt_every = adaptevery
     options.adapt_after = adaptafter
     options.restore=True
+    options.chainformat = chainformat
+    if stopping is not None:
+        options.stopping = stopping
 
     manager = varcontainer.VarContainer()
     manager.options = options
@@ -628,8 +1103,9 @@ def sample(parts, outputfile, samples, adaptevery = 100, adaptafter = 100, singl
 
 ##############################
 
-def memsample(model, samples, adaptevery = 100, adaptafter = 100, outputFile = None):
-    '''This function keeps the samples in memory before saving to disk. '''
+def memsample(model, samples, adaptevery = 100, adaptafter = 100, outputFile = None, stopping = None):
+    '''This function keeps the samples in memory before saving to disk.
+    stopping is an optional mymc.ConvergenceStopping; samples is then the maximum chain length. '''
     options = varcontainer.VarContainer()
     options.singlecore = True
     options.nsamples = samples
@@ -637,6 +1113,8 @@ def memsample(model, samples, adaptevery = 100, adaptafter = 100, outputFile = N
     options.adapt_after = adaptafter
     if outputFile:
         options.outputFile = outputFile
+    if stopping is not None:
+        options.stopping = stopping
 
     manager = varcontainer.VarContainer()
     manager.options = options
@@ -0,0 +1,292 @@
+'''
+Radii & shear rotation angles of simulation grids about a fixed center,
+cached across the configs and sims that share a grid.
+'''
+
+#############
+
+import os, hashlib, collections, tempfile, shutil, unittest
+import numpy as np
+
+import nfwutils
+import catalog
+
+#############
+
+geometrycolumns = ['r_arcmin', 'r_mpc', 'cos2phi', 'sin2phi']
+
+def contentId(*parts):
+    '''Integer id for a tuple of simple values, stable across processes.
+    Readers set sim.gridid = contentId(...) from whatever defines their grid.'''
+
+    return int(hashlib.md5(repr(parts)).hexdigest()[:15], 16)
+
+#############
+
+class GridGeometry(object):
+    '''Geometry columns over a whole grid, with the pixel number of each row,
+    and fixed bin indices of its radii (filled in by the binners).'''
+
+    def __init__(self, geometryid, columns):
+
+        self.geometryid = geometryid
+        self.columns = columns
+        self.gridpixel = np.arange(len(columns['r_arcmin']))
+        self.gridpixel.setflags(write = False)
+        self.binindices = {}
+
+def computeGeometry(x_arcmin, y_arcmin, centerx, centery, dL, dtype = np.float64):
+    '''Same arithmetic as profiletools.tangentialshear. Radii are stored as
+    dtype, as tangentialshear outputs them; the angles stay float64, as the
+    shear rotation uses them.'''
+
+    delta_x = x_arcmin - centerx
+    delta_y = y_arcmin - centery
+    r2 = delta_x**2 + delta_y**2
+    r = np.sqrt(r2)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        columns = dict(r_arcmin = r,
+                       r_mpc = r*(dL*np.pi/(180.*60)),
+                       cos2phi = (delta_x**2 - delta_y**2)/r2,
+                       sin2phi = 2*delta_x*delta_y/r2)
+
+    for name in ['r_arcmin', 'r_mpc']:
+        columns[name] = columns[name].astype(dtype)
+    for name in geometrycolumns:
+        columns[name].setflags(write = False)
+
+    return columns
+
+#############
+
+class GeometryCache(object):
+    '''LRU cache of GridGeometrys, keyed on (grid, zlens, center, dtype).
+    With a cachedir, computed geometries are also saved there as .npy, and
+    later misses (in any process) memory map them back in.'''
+
+    def __init__(self, maxentries = 4, cachedir = None):
+
+        self.maxentries = maxentries
+        self.cachedir = cachedir
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config):
+
+        if 'geometrycachesize' in config:
+            self.maxentries = config['geometrycachesize']
+        if 'geometrycachedir' in config:
+            self.cachedir = config['geometrycachedir']
+
+    def checkConfig(self, config):
+        '''Warn if config asks for cache settings other than those in use'''
+
+        for key, current in [('geometrycachesize', self.maxentries), ('geometrycachedir', self.cachedir)]:
+            if key in config and config[key] != current:
+                print 'WARNING: ignoring {0} = {1!r}; the geometry cache uses {2!r} for this job'.format(key, config[key], current)
+
+    def clear(self):
+
+        self._entries.clear()
+
+    ####
+
+    def geometryId(self, sim, centerx, centery, dtype = np.float64):
+        '''None if sim has no gridid'''
+
+        if not hasattr(sim, 'gridid'):
+            return None
+
+        angulardist = nfwutils.global_cosmology.angulardist
+
+        return contentId(sim.gridid, len(sim), float(sim.zlens),
+                         float(angulardist(sim.zcluster)), float(angulardist(sim.zlens)),
+                         float(centerx), float(centery), np.dtype(dtype).str)
+
+    def get(self, geometryid):
+        '''The cached GridGeometry, or None'''
+
+        entry = self._entries.pop(geometryid, None)
+        if entry is not None:
+            self._entries[geometryid] = entry
+        return entry
+
+    def geometry(self, sim, centerx, centery, dtype = np.float64):
+        '''GridGeometry of sim's grid, which must be whole (not filtered)'''
+
+        geometryid = self.geometryId(sim, centerx, centery, dtype)
+
+        entry = self.get(geometryid)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+
+        columns = self._load(geometryid)
+        if columns is None:
+            dL = nfwutils.global_cosmology.angulardist(sim.zlens)
+            columns = computeGeometry(sim.x_arcmin, sim.y_arcmin, centerx, centery, dL, dtype)
+            self._save(geometryid, columns)
+
+        entry = GridGeometry(geometryid, columns)
+        self._entries[geometryid] = entry
+        while len(self._entries) > self.maxentries:
+            self._entries.popitem(last = False)
+
+        return entry
+
+    ####
+
+    def _filename(self, geometryid, name):
+
+        return '{0}/geometry_{1:015x}_{2}.npy'.format(self.cachedir, geometryid, name)
+
+    def _load(self, geometryid):
+
+        if self.cachedir is None:
+            return None
+
+        filenames = dict([(name, self._filename(geometryid, name)) for name in geometrycolumns])
+        if not all([os.path.exists(x) for x in filenames.itervalues()]):
+            return None
+
+        return dict([(name, np.load(filename, mmap_mode = 'r')) for name, filename in filenames.iteritems()])
+
+    def _save(self, geometryid, columns):
+
+        if self.cachedir is None:
+            return
+
+        if not os.path.exists(self.cachedir):
+            try:
+                os.makedirs(self.cachedir)
+            except OSError:
+                pass  #made by another process
+
+        #written under a unique name, then renamed, so readers never see a partial file
+        for name in geometrycolumns:
+            tmpfile = tempfile.NamedTemporaryFile(dir = self.cachedir, suffix = '.npy', delete = False)
+            np.save(tmpfile, columns[name])
+            tmpfile.close()
+            os.rename(tmpfile.name, self._filename(geometryid, name))
+
+    ####
+
+    def attach(self, sim, centerx, centery, dtype = np.float64):
+        '''Copy of sim with the cached geometry columns, gridpixel & geometryid.
+        The columns are read only, and are shared with every other sim on the grid.
+        sim is returned as is if it has no gridid.'''
+
+        if not hasattr(sim, 'gridid'):
+            return sim
+
+        entry = self.geometry(sim, centerx, centery, dtype)
+
+        newsim = sim.copy()
+        for name in geometrycolumns:
+            setattr(newsim, name, entry.columns[name])
+        newsim.gridpixel = entry.gridpixel
+        newsim.geometryid = entry.geometryid
+
+        return newsim
+
+
+global_geometrycache = GeometryCache()
+
+
+#########################
+
+
+class TestGeometryCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.cachedir = tempfile.mkdtemp()
+
+        x, y = np.meshgrid(np.arange(-10, 10, 0.5) + 0.25, np.arange(-10, 10, 0.5) + 0.25)
+
+        self.sim = catalog.Catalog()
+        self.sim.zcluster = 0.5
+        self.sim.zlens = 0.5
+        self.sim.gridid = contentId('test', 40)
+        self.sim.x_arcmin = x.ravel()
+        self.sim.y_arcmin = y.ravel()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.cachedir)
+
+    def testMatchesTangentialShear(self):
+
+        import profiletools
+
+        sim = GeometryCache().attach(self.sim, 0.3, -0.2)
+
+        g1 = np.random.normal(0, 0.1, len(sim))
+        g2 = np.random.normal(0, 0.1, len(sim))
+        dL = nfwutils.global_cosmology.angulardist(0.5)
+        r_arcmin, r_mpc, ghat, gcross = profiletools.tangentialshear(sim.x_arcmin, sim.y_arcmin,
+                                                                     g1, g2, 0.3, -0.2, dL)
+
+        self.assertTrue(np.allclose(sim.r_arcmin, r_arcmin, rtol = 1e-14))
+        self.assertTrue(np.allclose(sim.r_mpc, r_mpc, rtol = 1e-14))
+        self.assertTrue(np.allclose(-(g1*sim.cos2phi + g2*sim.sin2phi), ghat, rtol = 1e-12))
+
+        #single precision: only the radii are rounded, so the rotated shear matches
+        single = GeometryCache().attach(self.sim, 0.3, -0.2, np.float32)
+        expected = profiletools.tangentialshear(sim.x_arcmin, sim.y_arcmin,
+                                                g1, g2, 0.3, -0.2, dL, single = True)
+        self.assertEqual(single.cos2phi.dtype, np.float64)
+        self.assertTrue((single.r_arcmin == expected[0]).all())
+        self.assertTrue((single.r_mpc == expected[1]).all())
+        rotated = profiletools.rotateshear(g1, g2, single.cos2phi, single.sin2phi, single = True)
+        self.assertTrue((rotated[0] == expected[2]).all())
+        self.assertTrue((rotated[1] == expected[3]).all())
+
+        #follows the rows through filters
+        keep = np.flatnonzero(np.random.random(len(sim)) < 0.5)
+        filtered = sim.filter(keep)
+        self.assertTrue((filtered.gridpixel == keep).all())
+        self.assertTrue((filtered.r_mpc == r_mpc[keep]).all())
+
+    def testLRU(self):
+
+        cache = GeometryCache(maxentries = 2)
+
+        first = cache.geometry(self.sim, 0., 0.)
+        cache.geometry(self.sim, 1., 0.)
+        self.assertTrue(cache.geometry(self.sim, 0., 0.) is first)
+        cache.geometry(self.sim, 2., 0.)   #evicts (1, 0)
+
+        self.assertEqual(cache.hits, 1)
+        self.assertTrue(cache.get(first.geometryid) is first)
+        self.assertEqual(cache.get(cache.geometryId(self.sim, 1., 0.)), None)
+
+    def testDiskCache(self):
+
+        first = GeometryCache(cachedir = self.cachedir).geometry(self.sim, 0.3, 0.)
+
+        cache = GeometryCache(cachedir = self.cachedir)
+        second = cache.geometry(self.sim, 0.3, 0.)
+
+        self.assertTrue(isinstance(second.columns['r_mpc'], np.memmap))
+        for name in geometrycolumns:
+            self.assertTrue(np.array_equal(first.columns[name], second.columns[name]))
+
+        #a different lens redshift is a different geometry
+        rescaled = self.sim.copy()
+        rescaled.zlens = 0.7
+        self.assertNotEqual(cache.geometryId(rescaled, 0.3, 0.), second.geometryid)
+
+#####
+
+def runtests():
+
+    unittest.main()
+
+if __name__ == '__main__':
+
+    runtests()
@@ -5,8 +5,19 @@
 import readtxtfile
 import numpy as np
 
+def chainFormat(chainfilename):
+    '''npy for chains written by mymc.npyBackend, text otherwise'''
+
+    with open(chainfilename, 'rb') as input:
+        if input.read(6) == np.lib.format.MAGIC_PREFIX:
+            return 'npy'
+    return 'text'
+
 def loadChains(chainfilenames, trim=False):
 
+    if all([chainFormat(x) == 'npy' for x in chainfilenames]):
+        return loadNpyChains(chainfilenames, trim)
+
     chainfiles = [readtxtfile.readtxtfile(x) for x in chainfilenames]
     print [chainfile[0] for chainfile in chainfiles]
     takelength = len(chainfiles[0])
@@ -24,5 +35,30 @@ def loadChains(chainfilenames, trim=False):
 
     return chain
 
+def loadNpyChains(chainfilenames, trim=False):
+    '''Same output as loadChains, for mymc.npyBackend files. The files are
+    memory mapped, so only the requested rows are read.'''
+
+    chainfiles = [np.load(x, mmap_mode='r') for x in chainfilenames]
+    takelength = len(chainfiles[0])
+    if trim is True:
+        takelength = np.min(np.array([len(chainfile) for chainfile in chainfiles]))
+
+    columns = chainfiles[0].dtype.names
+
+    chain = {}
+
+    for col in columns:
+        chain[col] = np.row_stack([x[col][:takelength] for x in chainfiles])
+
+    return chain
+
+def loadLastRow(chainfilename):
+    '''Dict of the last sampled value of each column, for restarting a chain.'''
 
+    if chainFormat(chainfilename) == 'npy':
+        lastrow = np.load(chainfilename, mmap_mode='r')[-1]
+        return dict([(col, float(lastrow[col])) for col in lastrow.dtype.names])
 
+    chain = loadChains([chainfilename])
+    return dict([(col, chain[col][0,-1]) for col in chain])
@@ -8,6 +8,7 @@ import numpy as np
 import nfwfit
 import nfwutils
 import nfwmodeltools as tools
+import basicBinning
 import scipy.integrate
 import scipy.optimize
 
@@ -32,45 +33,26 @@ def avekappa(r1, r2, rscale, concentration, rho_c_over_sigma_c):
 
 #########
 
-def logbinning(catalog, gamma, minradii, maxradii, nbins):
+def logbinning(catalog, gamma, minradii, maxradii, nbins, nboot = 500, randomstate = None):
 
     binedges = np.logspace(np.log10(minradii), np.log10(maxradii), nbins+1)
 
-    radii = []
-    shear = []
-    shearerr = []
-    avebeta = []
-    avebeta2 = []
-    ngals = []
-    for i in range(nbins):
-        mintake = binedges[i]
-        maxtake = binedges[i+1]
-        selected = np.logical_and(catalog['r_mpc'] >= mintake,
-                                  catalog['r_mpc'] < maxtake)
-
-        ngal = len(gamma[selected])            
-
-        if ngal == 0:
-            continue
-
-        radii.append(np.mean(catalog['r_mpc'][selected]))
-
-        bootedmeans = np.zeros(500)
-        for curboot in range(500):
-            bootedmeans[curboot] = np.mean(gamma[selected][np.random.randint(0, ngal, ngal)])
-
-        shear.append(np.mean(bootedmeans))
-        shearerr.append(np.std(bootedmeans))
-        avebeta.append(np.mean(catalog['beta_s'][selected]))
-        avebeta2.append(np.mean(catalog['beta_s'][selected]**2))
-        ngals.append(ngal)
-        
-    radii = np.array(radii)
-    shear = np.array(shear)
-    shearerr = np.array(shearerr)
-    avebeta = np.array(avebeta)
-    avebeta2 = np.array(avebeta2)
-    ngals  = np.array(ngals)
+    binindex = basicBinning.fixedBinIndex(catalog['r_mpc'], binedges)
+    binned = basicBinning.BinnedColumns(binindex, nbins,
+                                        radius = catalog['r_mpc'],
+                                        beta_s = catalog['beta_s'])
+
+    shear, shearerr = basicBinning.bootstrapBinMeans(gamma, binindex, nbins, 
+                                                     nboot = nboot, randomstate = randomstate)
+
+    nonempty = binned.counts > 0
+
+    radii = binned.mean('radius')[nonempty]
+    shear = shear[nonempty]
+    shearerr = shearerr[nonempty]
+    avebeta = binned.mean('beta_s')[nonempty]
+    avebeta2 = binned.meansq('beta_s')[nonempty]
+    ngals  = binned.counts[nonempty]
 
     return radii, shear, shearerr, avebeta, avebeta2, ngals
 
@@ -4,12 +4,161 @@
 #  and runs multiple nfwfits, saving the results in different locations
 ######################
 
-import sys, json, os, shutil, glob
+import sys, json, os, shutil, glob, hashlib, cPickle, collections
 import nfwfit
 import simutils
+import geometrycache
 
 
-def runMultiConfigs(jobparams, jobname=''):
+########################
+# Stage sharing
+#
+# Each config's pipeline is broken into stages (sim loading, the profile
+# builder's stages, the fitter). Stages are identified by a content hash
+# of their configured objects, and a stage's key chains in the key of
+# everything upstream of it. Configs with the same prefix of stage keys
+# share those intermediate results, which are computed once.
+#
+# Note that stochastic stages (galaxy picking, shape noise, miscentering)
+# that are shared also share their random realization.
+
+def stageSignature(*configured):
+    '''Content hash of the objects that configure a stage.
+    Objects that can not be pickled are only equal to themselves.'''
+
+    hasher = hashlib.md5()
+    for obj in configured:
+        try:
+            if hasattr(obj, '__dict__'):
+                state = (type(obj).__module__.split('.')[-1], type(obj).__name__, 
+                         sorted(obj.__dict__.items()))
+            else:
+                state = obj
+            hasher.update(cPickle.dumps(state, 2))
+        except Exception:
+            hasher.update('id:%d' % id(obj))
+
+    return hasher.hexdigest()
+
+class StageNode(object):
+
+    def __init__(self, name, step):
+
+        self.name = name
+        self.step = step
+        self.children = collections.OrderedDict()
+        self.outputs = []   #(config, outputname) for configs ending here
+
+def configStages(config):
+    '''Stages after sim loading for one config, as (name, signature, step)'''
+
+    profilebuilder = config['profilebuilder']
+    fitter = config['fitter']
+
+    stages = []
+    if hasattr(profilebuilder, 'stages'):
+        for name, configured, step in profilebuilder.stages():
+            stages.append((name, stageSignature(*configured), step))
+    else:
+        stages.append(('profilebuilder', stageSignature(profilebuilder), profilebuilder))
+
+    stages.append(('fitter', stageSignature(fitter), fitter))
+
+    return stages
+
+def buildStageDAG(configs):
+    '''Prefix tree of stages over a list of (config, outputname)'''
+
+    root = StageNode('load', None)
+
+    for config, outputname in configs:
+        node = root
+        for name, signature, step in configStages(config):
+            key = (name, signature)
+            if key not in node.children:
+                node.children[key] = StageNode(name, step)
+            node = node.children[key]
+        node.outputs.append((config, outputname))
+
+    return root
+
+def countStages(node):
+
+    return 1 + sum([countStages(child) for child in node.children.itervalues()])
+
+def outputsBelow(node):
+
+    outputs = list(node.outputs)
+    for child in node.children.itervalues():
+        outputs.extend(outputsBelow(child))
+    return outputs
+
+def runStageDAG(root, sim, capturefailures = False, fatalexceptions = ()):
+    '''Depth first, so only one chain of intermediates is held at a time.
+    Each stage gets its own copy of its input, so stages that modify
+    their input in place can not affect siblings.
+
+    With capturefailures, a stage that raises dumps (sim, last intermediate, fitvals)
+    to the .err.pkl of every config below it, as nfwfit.dump, and the remaining
+    branches still run. Exceptions in fatalexceptions are re-raised after dumping.
+    Returns a list of (outputname, exception) for failed configs.'''
+
+    failures = []
+
+    def fail(node, intermediate, fitvals, e, outputs = None):
+
+        if not capturefailures:
+            raise
+
+        if outputs is None:
+            outputs = outputsBelow(node)
+
+        for config, outputname in outputs:
+            #verifyfit has already dumped its intermediates
+            if not isinstance(e, nfwfit.FailedFitException):
+                nfwfit.dump(sim, intermediate, fitvals, outputname)
+            failures.append((outputname, e))
+
+        if isinstance(e, fatalexceptions):
+            raise
+
+    def run(node, cat):
+
+        if node.name == 'fitter':
+            try:
+                fitvals = node.step(cat)
+            except Exception, e:
+                fail(node, cat, None, e)
+                return
+            for config, outputname in node.outputs:
+                try:
+                    config['fitter'].verifyfit(sim, cat, fitvals, outputname)
+                    nfwfit.savefit(fitvals, outputname)
+                except Exception, e:
+                    fail(node, cat, fitvals, e, outputs = [(config, outputname)])
+            return
+
+        for child in node.children.itervalues():
+            if child.name == 'fitter':
+                run(child, cat.copy())
+                continue
+            try:
+                result = child.step(cat.copy())
+            except Exception, e:
+                fail(child, cat, None, e)
+                continue
+            run(child, result)
+
+    run(root, sim)
+
+    return failures
+
+
+
+def runMultiConfigs(jobparams, jobname='', sharestages = True, capturefailures = False, fatalexceptions = ()):
+    '''Returns a list of (outputname, exception) for configs that failed.
+    capturefailures and fatalexceptions are passed to runStageDAG. Without
+    sharestages, each config runs as a DAG of its own.'''
 
     inputfiles = jobparams['inputfiles']
     outputExt = jobparams['outputExt']
@@ -43,35 +192,57 @@ def runMultiConfigs(jobparams, jobname=''):
 
         
 
-    simreader = None
+    #the scratch copy goes even if a config raises (e.g. a job timeout)
+    try:
 
+        simreader = None
 
+        failures = []
+        configs = []
+        configmodules = []
 
-    for configfile in jobparams['configurations']:
+        for configfile in jobparams['configurations']:
 
-        outdir = os.path.dirname(configfile)
+            outdir = os.path.dirname(configfile)
 
-        outputname = '{0}/{1}{2}'.format(outdir, outbasename, outputExt)
+            outputname = '{0}/{1}{2}'.format(outdir, outbasename, outputExt)
 
-        print configfile, outputname
+            print configfile, outputname
 
-        if simreader is None:
+            if simreader is None:
 
-            config, simreader = nfwfit.preloadNFWFit(configfile)
+                config, simreader = nfwfit.preloadNFWFit(configfile)
 
-        else:
+            else:
 
-            config = simutils.readConfiguration(configfile)
+                config = simutils.readConfiguration(configfile)
+                geometrycache.global_geometrycache.checkConfig(config)
 
-        nfwfit.runNFWFit_Preloaded(simreader, inputname, config, outputname)
+            if not sharestages:
+                dag = buildStageDAG([(config, outputname)])
+                failures.extend(runStageDAG(dag, simreader.load(inputname), capturefailures, fatalexceptions))
+                continue
 
+            #python clears a module's namespace when the module is released,
+            #so hold on to each config module until the DAG has run
+            configmodules.append(sys.modules['currentconfig'])
+            configs.append((config, outputname))
 
 
+        if sharestages:
 
+            dag = buildStageDAG(configs)
+            print 'Running %d configs with %d unique stages' % (len(configs), countStages(dag) - 1)
 
-    if doTransfer:
-        
-        shutil.rmtree(workdir)
+            sim = simreader.load(inputname)
+            failures = runStageDAG(dag, sim, capturefailures, fatalexceptions)
+
+    finally:
+
+        if doTransfer:
+            shutil.rmtree(workdir)
+
+    return failures
 
 ########
 
@@ -87,7 +258,7 @@ def loadJobfile(jobfile):
 def runAll(jobfile):
 
     jobparams = loadJobfile(jobfile)
-    runMultiConfigs(jobparams)
+    runMultiConfigs(jobparams, sharestages = jobparams.get('sharestages', True))
 
 #########
 
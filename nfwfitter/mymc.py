@@ -8,6 +8,7 @@ import cPickle as pickle
 import glob
 import numpy as np
 import sys
+import time
 try:
     from mpi4py import MPI
 except ImportError:
@@ -796,6 +797,13 @@ class Step:
     """
     def __init__(self):
         self.updater = None
+        self.ncalls = 0
+        self.nevaluations = 0
+    def counters(self):
+        """
+        Dictionary of proposal statistics accumulated since construction.
+        """
+        return dict(calls=self.ncalls, evaluations=self.nevaluations)
 
 class Slice(Step):
     """
@@ -812,7 +820,14 @@ class Slice(Step):
         self.quiet = quiet
         self.obnoxious = obnoxious
         Step.__init__(self)
+        self.nexpanded = 0
+        self.nshrunk = 0
+    def counters(self):
+        c = Step.counters(self)
+        c.update(expanded=self.nexpanded, shrunk=self.nshrunk)
+        return c
     def __call__(self, struct):
+        self.ncalls += 1
         if self.updater.engine.current_logP is None:
             self.updater.engine.current_logP = self.updater.space.log_posterior(struct)
         z = self.updater.engine.current_logP - np.random.exponential() # log level of slice
@@ -826,12 +841,14 @@ class Slice(Step):
         for i in range(self.maxiter):
             self.updater.move(L)
             lnew = self.updater.space.log_posterior(struct)
+            self.nevaluations += 1
             if self.obnoxious:
                 print 'Slice: params:', [(p.name, p()) for p in self.updater.space]
                 print 'Slice:', L, lnew
             if lnew <= z:
                 break
             L -= self.width_fac;
+            self.nexpanded += 1
         else:
             if not self.quiet:
                 print "Slice(): warning -- exhausted stepping out (left) loop"
@@ -841,12 +858,14 @@ class Slice(Step):
         for i in range(self.maxiter):
             self.updater.move(R)
             lnew = self.updater.space.log_posterior(struct)
+            self.nevaluations += 1
             if self.obnoxious:
                 print 'Slice: params:', [(p.name, p()) for p in self.updater.space]
                 print 'Slice:', R, lnew
             if lnew <= z:
                 break
             R += self.width_fac;
+            self.nexpanded += 1
         else:
             if not self.quiet:
                 print "Slice(): warning -- exhausted stepping out (right) loop"
@@ -856,10 +875,12 @@ class Slice(Step):
             x1 = L + (R - L) *  np.random.random_sample()
             self.updater.move(x1)
             self.updater.engine.current_logP = self.updater.space.log_posterior(struct)
+            self.nevaluations += 1
             if self.obnoxious:
                 print 'Slice: params:', [(p.name, p()) for p in self.updater.space]
                 print 'Slice:', x1, self.updater.engine.current_logP
             if self.updater.engine.current_logP < z:
+                self.nshrunk += 1
                 if x1 < 0:
                     L = x1
                 else:
@@ -883,16 +904,24 @@ class Metropolis(Step):
         self.width_fac = width_factor
         self.multiplicity = 0
         Step.__init__(self)
+        self.naccepted = 0
+    def counters(self):
+        c = Step.counters(self)
+        c.update(accepted=self.naccepted)
+        return c
     def __call__(self, struct):
+        self.ncalls += 1
         if self.updater.engine.current_logP is None:
             self.updater.engine.current_logP = self.updater.space.log_posterior(struct)
         self.updater.move( self.width_fac * self.length() )
         trial_logP = self.updater.space.log_posterior(struct)
+        self.nevaluations += 1
         delta_logP = trial_logP - self.updater.engine.current_logP
         r = np.log(np.random.random_sample())
         if delta_logP > 0.0 or r < delta_logP:
             self.updater.engine.current_logP = trial_logP
             self.multiplicity = 1
+            self.naccepted += 1
         else:
             self.updater.move(0.0)
             self.multiplicity += 1
@@ -946,6 +975,8 @@ class Backend:
     """
     def __call__(self, space):
         pass
+    def flush(self):
+        pass
 
 class textBackend(Backend):
     """
@@ -1027,6 +1058,75 @@ class headerTextBackend(Backend):
             db[key] = np.array(db[key])
         return db
 
+class npyBackend(Backend):
+    """
+    Class to store a chain as a 1-d record array (one float64 field per Parameter) in a .npy file, which np.load can memory map.
+    Constructor arguments:
+     1. filename.
+     2. the ParameterSpace to be stored.
+     3. whether to append to an existing file written by this class, rather than start a new one.
+     4. number of rows buffered in memory between writes.
+    Rows are written in blocks, and the row count in the header is only updated after a block is on disk, so an interrupted run leaves a readable file. Call close() to write the final partial block.
+    """
+    def __init__(self, filename, space, append=False, blocksize=1000):
+        self.fields = [p.name for p in space]
+        self.dtype = np.dtype([(name, '<f8') for name in self.fields])
+        self.buffer = np.zeros(blocksize, dtype=self.dtype)
+        self.nbuffered = 0
+        if append:
+            self.file = open(filename, 'r+b')
+            dtype, self.count, offset = npyBackend.readHeader(self.file)
+            if dtype.names != self.dtype.names:
+                raise ValueError('npyBackend: fields of ' + filename + ' do not match the parameter space')
+            self.offset = offset
+            self.file.truncate(self.offset + self.count * self.dtype.itemsize)  # drop any partial block
+        else:
+            self.file = open(filename, 'w+b')
+            self.count = 0
+            self.offset = 64 * ((len(self.headerString(10**18)) + 11) // 64 + 1)
+            self.writeHeader()
+        self.file.seek(0, 2)
+    def __call__(self, space):
+        row = self.buffer[self.nbuffered]
+        for i, p in enumerate(space):
+            row[i] = p()
+        self.nbuffered += 1
+        if self.nbuffered == len(self.buffer):
+            self.flush()
+    def headerString(self, count):
+        return "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(self.dtype), count)
+    def writeHeader(self):
+        header = self.headerString(self.count)
+        prefix = np.lib.format.magic(1, 0) + np.array([self.offset - 10], dtype='<u2').tostring()
+        padding = self.offset - len(prefix) - len(header) - 1
+        self.file.seek(0)
+        self.file.write(prefix + header + ' '*padding + '\n')
+    def flush(self):
+        if self.nbuffered == 0:
+            return
+        self.file.seek(self.offset + self.count * self.dtype.itemsize)
+        self.file.write(self.buffer[:self.nbuffered].tostring())
+        self.file.flush()
+        self.count += self.nbuffered
+        self.nbuffered = 0
+        self.writeHeader()
+        self.file.flush()
+        self.file.seek(0, 2)
+    def close(self):
+        self.flush()
+        self.file.close()
+    @staticmethod
+    def readHeader(file):
+        file.seek(0)
+        if np.lib.format.read_magic(file) != (1, 0):
+            raise ValueError('npyBackend: unexpected .npy version')
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        return dtype, shape[0], file.tell()
+    @classmethod
+    def readToDict(cls, filename, quiet=True):
+        chain = np.load(filename, mmap_mode='r')
+        return dict([(name, chain[name]) for name in chain.dtype.names])
+
 class stdoutBackend(textBackend):
     """
     Class to simply print a chain to the terminal without storing it.
@@ -1036,22 +1136,229 @@ class stdoutBackend(textBackend):
 
 class dictBackend(dict, Backend):
     """
-    Class to store a chain in a dictionary (inherits dict). If a Parameter has a non-empty string-type name attribute, the corresponding key is that name, otherise it is a reference to the Parameter object itself.
+    Class to store a chain in a dictionary (inherits dict) of numpy arrays, one per Parameter. If a Parameter has a non-empty string-type name attribute, the corresponding key is that name, otherise it is a reference to the Parameter object itself.
+    Constructor arguments:
+     1. initial array length; arrays double in length when full.
+     2. number of steps buffered before they are copied into the arrays.
+     3. an optional dictionary of key: numpy dtype (default float64).
+    Entries are views of the steps recorded so far; every read (including keys, len and pickling) first copies in any buffered steps. Pickles as a plain dict.
     """
+    def __init__(self, size=1000, blocksize=100, dtypes=None):
+        dict.__init__(self)
+        self.size = size
+        self.blocksize = blocksize
+        self.dtypes = {} if dtypes is None else dtypes
+        self.keylist = None
+        self.rows = []
+        self.count = 0
+        self.columns = {}
     def __call__(self, space):
-        for p in space:
-            key = p
-            try:
-                if p.name != '':
-                    key = p.name
-            except:
-                pass
-            try:
-                self[key].append(p())
-            except KeyError:
-                self[key] = []
-                self[key].append(p())
+        if self.keylist is None:
+            self.keylist = []
+            for p in space:
+                key = p
+                try:
+                    if p.name != '':
+                        key = p.name
+                except:
+                    pass
+                self.keylist.append(key)
+        self.rows.append([p() for p in space])
+        if len(self.rows) >= self.blocksize:
+            self.flush()
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        n = len(self.rows)
+        for i, key in enumerate(self.keylist):
+            if key not in self.columns:
+                shape = np.shape(self.rows[0][i])
+                self.columns[key] = np.zeros((max(self.size, n),) + shape, dtype=self.dtypes.get(key, np.float64))
+            column = self.columns[key]
+            if self.count + n > len(column):
+                newcolumn = np.zeros((max(2*len(column), self.count + n),) + column.shape[1:], dtype=column.dtype)
+                newcolumn[:self.count] = column[:self.count]
+                self.columns[key] = newcolumn
+                column = newcolumn
+            column[self.count:self.count+n] = [row[i] for row in self.rows]
+            # the dict itself holds views of the filled part only
+            dict.__setitem__(self, key, column[:self.count+n])
+        self.count += n
+        self.rows = []
+    def __getitem__(self, key):
+        self.flush()
+        return dict.__getitem__(self, key)
+    def keys(self):
+        self.flush()
+        return dict.keys(self)
+    def __iter__(self):
+        return iter(self.keys())
+    def __contains__(self, key):
+        self.flush()
+        return dict.__contains__(self, key)
+    def has_key(self, key):
+        return key in self
+    def __len__(self):
+        self.flush()
+        return dict.__len__(self)
+    def __reduce__(self):
+        self.flush()
+        return (dict, (dict.items(self),))
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+    def itervalues(self):
+        for key in self.keys():
+            yield self[key]
+    def items(self):
+        return list(self.iteritems())
+    def values(self):
+        return list(self.itervalues())
+
+
+
+def autocorrelation(x):
+    """
+    Normalized autocorrelation function of a 1-d chain, computed by FFT.
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    d = x - np.mean(x)
+    nfft = 1
+    while nfft < 2*n:
+        nfft *= 2
+    f = np.fft.rfft(d, nfft)
+    acf = np.fft.irfft(f * np.conjugate(f), nfft)[:n]
+    if acf[0] <= 0.0:
+        return np.ones(n)
+    return acf / acf[0]
+
+def autocorrelation_time(x):
+    """
+    Integrated autocorrelation time of a 1-d chain, using Geyer's initial positive sequence to truncate the sum.
+    """
+    rho = autocorrelation(x)
+    tau = -1.0
+    for k in range(0, len(rho)-1, 2):
+        pair = rho[k] + rho[k+1]
+        if pair <= 0.0:
+            break
+        tau += 2.0 * pair
+    return max(tau, 1.0)
+
+def effective_sample_size(x):
+    """
+    Effective number of independent samples in a 1-d chain.
+    """
+    return len(x) / autocorrelation_time(x)
 
+def split_rhat(x):
+    """
+    Gelman-Rubin statistic for a single 1-d chain, treating its first and second halves as separate chains.
+    """
+    n = len(x) // 2
+    halves = np.array([x[:n], x[len(x)-n:]], dtype=float)
+    W = np.mean(np.var(halves, axis=1, ddof=1))
+    B = n * np.var(np.mean(halves, axis=1), ddof=1)
+    if W <= 0.0:
+        return np.inf
+    return np.sqrt( ((n-1.0)/n * W + B/n) / W )
+
+
+class ConvergenceStopping:
+    """
+    Stopping policy for an Engine, based on effective sample size and split-Rhat of the parameters of its adaptive Updaters.
+    Constructor arguments:
+     1. minimum effective sample size required of every parameter.
+     2. maximum split-Rhat allowed for every parameter. If Updaters have a parallel Gelman-Rubin R, that must pass too.
+     3. fraction of the chain discarded as burn-in before computing the diagnostics.
+     4. minimum number of Engine iterations before stopping is considered.
+     5. number of iterations between checks; by default, the smallest adapt_every of the adaptive Updaters.
+     6. checks are also at least this factor apart in iteration count, so the diagnostics cost stays proportional to the chain length.
+    After the run, the attributes ess, tau and rhat hold the last diagnostics (dictionaries keyed by parameter name), burn the number of iterations to discard, and stop_count the iteration at which the chain was stopped (None if it ran to the end).
+    """
+    def __init__(self, min_ess=400, max_rhat=1.01, burn_fraction=0.5, min_count=1000, check_every=None, check_growth=1.1):
+        self.min_ess = min_ess
+        self.max_rhat = max_rhat
+        self.burn_fraction = burn_fraction
+        self.min_count = min_count
+        self.check_every = check_every
+        self.check_growth = check_growth
+        self.next_check = min_count
+        self.space = None
+        # recorded states, in a buffer that doubles when full
+        self._history = np.zeros((0, 0))
+        self.nhistory = 0
+        self.ess = {}
+        self.tau = {}
+        self.rhat = {}
+        self.burn = 0
+        self.stop_count = None
+    def attach(self, engine):
+        self.space = []
+        every = []
+        for updater in engine:
+            if updater.adapt:
+                every.append(updater.adapt_every)
+                for p in updater.space:
+                    if p not in self.space:
+                        self.space.append(p)
+        if self.check_every is None:
+            self.check_every = min(every) if len(every) > 0 else 100
+        self._history = np.zeros((max(self.min_count, 1024), len(self.space)))
+    @property
+    def history(self):
+        return self._history[:self.nhistory]
+    def record(self):
+        if self.nhistory == len(self._history):
+            self._history = np.concatenate([self._history, np.zeros_like(self._history)])
+        for i, p in enumerate(self.space):
+            self._history[self.nhistory, i] = p()
+        self.nhistory += 1
+    def diagnose(self):
+        self.burn = int(self.burn_fraction * self.nhistory)
+        chain = self.history[self.burn:]
+        for i, p in enumerate(self.space):
+            self.tau[p.name] = autocorrelation_time(chain[:,i])
+            self.ess[p.name] = len(chain) / self.tau[p.name]
+            self.rhat[p.name] = split_rhat(chain[:,i])
+    def converged(self, engine):
+        for updater in engine:
+            if updater.adapt and updater.R is not None and np.any(updater.R > self.max_rhat):
+                return False
+        return min(self.ess.values()) >= self.min_ess and max(self.rhat.values()) <= self.max_rhat
+    def __call__(self, engine):
+        """
+        Records the current state, and returns True if the chain should stop.
+        """
+        if self.space is None:
+            self.attach(engine)
+        if len(self.space) == 0:
+            return False
+        self.record()
+        if engine.count < self.next_check or engine.count % self.check_every != 0:
+            return False
+        self.next_check = max(self.min_count, int(np.ceil(self.check_growth * engine.count)))
+        self.diagnose()
+        if self.converged(engine):
+            self.stop_count = engine.count
+            return True
+        return False
+    def summary(self):
+        """
+        Diagnostics as a flat dictionary: worst-case ess, tau and rhat over parameters, plus burn and the stopping iteration.
+        """
+        if self.stop_count is None and self.space is not None and len(self.space) > 0 and self.nhistory > 3:
+            self.diagnose()
+        return dict(ess = min(self.ess.values()) if len(self.ess) > 0 else 0.0,
+                    tau = max(self.tau.values()) if len(self.tau) > 0 else np.inf,
+                    rhat = max(self.rhat.values()) if len(self.rhat) > 0 else np.inf,
+                    burn = self.burn,
+                    stop_count = self.stop_count if self.stop_count is not None else self.nhistory)
 
 
 class Engine(list):
@@ -1061,43 +1368,116 @@ class Engine(list):
      1. sequence of Updater objects. If Updaters are added any other way, the register_updater( ) method must be used.
      2. a ParameterSpace of Parameters whose values are to be stored at each step. This need not be the same as the ParameterSpace(s) referred to by the Updaters.
      3. a function of one argument to be called after each step (i.e. each time that each Updater has been called).
+     4. an optional stopping policy, called with the Engine after each step; the chain ends early when it returns True. See ConvergenceStopping.
+     5. a progress monitor, called with the Engine after each step. The default is a ProgressMonitor, which prints to the terminal at most once a minute.
+    The time spent in each Updater is accumulated in the updater_time list.
     To run a chain, use the () method. Arguments:
      1. number of iterations (every Updater is called for a single iteration).
      2. an object that is passed to the log_posterior, Updater.on_adapt, and on_step functions.
      3. a sequence of Backend objects where the chain is to be stored.
     """
     # todo: make sure directly assigned Updaters get registered
-    def __init__(self, updaterList=[], parameterspace_to_track=None, on_step=None):
+    def __init__(self, updaterList=[], parameterspace_to_track=None, on_step=None, stopping=None, monitor=None):
         list.__init__(self, updaterList)
+        self.updater_time = [0.0] * len(self)
         for i, updater in enumerate(self):
             self.register_updater(updater, i)
         self.space = parameterspace_to_track
         self.onStep = on_step
+        self.stopping = stopping
+        if monitor is None:
+            monitor = ProgressMonitor()
+        self.monitor = monitor
         self.count = 0
         self.current_logP = None
     def __setitem__(self, key, value):
         self[key] = value
         self.register_updater(value, key)
     def __call__(self, number=1, struct=None, backends=[stdoutBackend()]):
+        self.monitor.start(self, number)
         try:
             for i in range(number):
-                #if i % 1000 == 0:
-                print 'At Iteration %d' % i
-                for updater in self:
+                for k, updater in enumerate(self):
+                    t0 = time.time()
                     for j in range(updater.rate):
                         updater(struct)
+                    self.updater_time[k] += time.time() - t0
                 self.count += 1
                 if not self.onStep is None:
                     self.onStep(struct)
                 if not self.space is None:
                     for backend in backends:
                         backend(self.space)
+                self.monitor(self)
+                if not self.stopping is None and self.stopping(self):
+                    break
         except KeyboardInterrupt:
             print "Interrupted by keyboard with count = " + str(self.count)
+        for backend in backends:
+            backend.flush()
+        self.monitor.finish(self)
     def register_updater(self, updater, index):
         updater.engine = self
         updater.index = index
         updater.uind = '_' + str(index)
+        while len(self.updater_time) <= index:
+            self.updater_time.append(0.0)
+
+
+class ProgressMonitor:
+    """
+    Progress/metrics hook for Engine. Records the run's iteration rate, the time spent in each Updater, and the counters of each Updater's Step (calls, posterior evaluations, slice expansions and contractions, Metropolis acceptances).
+    Constructor arguments:
+     1. minimum number of seconds between progress lines printed to the terminal (None for no output).
+     2. file object for the progress lines (default sys.stdout).
+    metrics() returns the record as a dictionary.
+    """
+    def __init__(self, interval=60.0, stream=None):
+        self.interval = interval
+        self.stream = stream
+        self.engine = None
+        self.printed = False
+    def start(self, engine, number):
+        self.engine = engine
+        self.number = number
+        self.start_count = engine.count
+        self.start_time = time.time()
+        self.last_print = self.start_time
+        self.elapsed = 0.0
+    def write(self, line):
+        stream = sys.stdout if self.stream is None else self.stream
+        stream.write(line + '\n')
+        stream.flush()
+        self.printed = True
+    def __call__(self, engine):
+        if self.interval is None:
+            return
+        now = time.time()
+        if now - self.last_print >= self.interval:
+            self.last_print = now
+            self.elapsed = now - self.start_time
+            self.write('At Iteration %d of %d (%.1f it/s)' % (engine.count - self.start_count, self.number, self.rate()))
+    def finish(self, engine):
+        self.elapsed = time.time() - self.start_time
+        if self.printed:
+            self.write('Finished %d iterations in %.1f s (%.1f it/s)' % (engine.count - self.start_count, self.elapsed, self.rate()))
+    def rate(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return (self.engine.count - self.start_count) / self.elapsed
+    def metrics(self):
+        updaters = {}
+        for k, updater in enumerate(self.engine):
+            record = dict(time=self.engine.updater_time[k])
+            try:
+                record.update(updater.step.counters())
+            except AttributeError:
+                pass
+            updaters[k] = record
+        return dict(iterations=self.engine.count - self.start_count,
+                    elapsed=self.elapsed,
+                    rate=self.rate(),
+                    updaters=updaters)
 
 
 
@@ -5,7 +5,7 @@
 # Options to explore radial fit range, mass-concentration relation, and binning scheme in fits.
 ########################
 
-import cPickle, sys, os
+import cPickle, sys, os, unittest
 import numpy as np
 import astropy.io.fits as pyfits
 import nfwutils, bashreader, ldac
@@ -13,9 +13,91 @@ import nfwmodeltools as tools
 import varcontainer
 import pymc
 import pymc_mymcmc_adapter as pma
+import mymc
 import scipy.integrate
 import profilebuilder
 import simutils
+import geometrycache
+
+
+#######################
+
+class NativeNFWModel(object):
+    '''Posterior in (mass parameter, cdelta) as a function of a plain float
+    vector, for pma.wrapNative. Skips the pymc node graph.'''
+
+    tracenames = ['mdelta', 'cdelta', 'likelihood']
+
+    def __init__(self, posterior, massname):
+
+        self.posterior = posterior
+        self.names = [massname, 'cdelta']
+        self.limits = [(posterior.plow, posterior.phigh), (posterior.clow, posterior.chigh)]
+        self.last = None
+
+    def logpost(self, x):
+
+        mparam, cdelta = x[0], x[1]
+        logprior = self.posterior.logprior(mparam, cdelta)
+        likelihood = -np.inf
+        if np.isfinite(logprior):
+            likelihood = self.posterior.loglike(self.posterior.mdelta(mparam), cdelta)
+        self.last = ((mparam, cdelta), logprior + likelihood, likelihood)
+        return logprior + likelihood
+
+    def derived(self, x):
+
+        if self.last is None or self.last[0] != (x[0], x[1]):
+            self.logpost(x)
+        (mparam, cdelta), posterior, likelihood = self.last
+        return dict(mdelta = self.posterior.mdelta(mparam),
+                    cdelta = cdelta,
+                    likelihood = likelihood,
+                    posterior = posterior)
+
+##############
+
+class NativeNFWMCModel(NativeNFWModel):
+    '''Posterior in the m200 parameter alone, with c200 from a mass-concentration
+    relation. mdelta and cdelta are traced at the requested overdensity.'''
+
+    def __init__(self, posterior, massname, concentration, delta = 200):
+
+        self.posterior = posterior
+        self.concentration = concentration
+        self.delta = delta
+        self.names = [massname]
+        self.limits = [(posterior.plow, posterior.phigh)]
+        self.last = None
+
+    def logpost(self, x):
+
+        mparam = x[0]
+        logprior = self.posterior.logprior(mparam, 1.)
+        c200 = np.nan
+        likelihood = -np.inf
+        if np.isfinite(logprior):
+            c200 = self.concentration(self.posterior.mdelta(mparam))
+            logprior = self.posterior.logprior(mparam, c200)
+        if np.isfinite(logprior):
+            likelihood = self.posterior.loglike(self.posterior.mdelta(mparam), c200)
+        self.last = ((mparam,), logprior + likelihood, likelihood, c200)
+        return logprior + likelihood
+
+    def derived(self, x):
+
+        if self.last is None or self.last[0] != (x[0],):
+            self.logpost(x)
+        (mparam,), posterior, likelihood, c200 = self.last
+        m200 = self.posterior.mdelta(mparam)
+        mdelta, cdelta = m200, c200
+        if self.delta != 200 and np.isfinite(c200):
+            mdelta = nfwutils.convertMdelta(m200, c200, 200., targetdelta = self.delta)
+            cdelta = nfwutils.xdelta(c200, self.delta)
+        return dict(mdelta = mdelta,
+                    cdelta = cdelta,
+                    likelihood = likelihood,
+                    posterior = posterior)
 
 
 #######################
@@ -140,6 +222,52 @@ class NFW_Model(object):
         parts['data'] = data
 
         return pymc.Model(parts)
+
+
+    def makeNativeModel(self, profile, delta = 200):
+
+        self.setData(profile.beta_s, profile.beta_s2, profile.zcluster, zlens = profile.zlens)
+
+        posterior = tools.ShearProfilePosterior(profile.r_mpc, profile.ghat, profile.sigma_ghat,
+                                                profile.beta_s, profile.beta_s2,
+                                                self.rho_c, self.rho_c_over_sigma_c, delta,
+                                                self.m200_low, self.m200_high,
+                                                self.c200_low, self.c200_high,
+                                                logmass = self.massprior == 'log',
+                                                massScale = self.massScale)
+
+        massname = 'logMdelta' if self.massprior == 'log' else 'scaledmdelta'
+
+        return NativeNFWModel(posterior, massname)
+
+
+    def convertChain(self, m200, c200, delta):
+        '''Maps (m200, c200) samples drawn with the delta = 200 priors to delta.
+        Returns mdelta, cdelta and importance weights (mean 1) that swap the
+        200 priors for the ones makeMCMCModel(delta = delta) uses: the prior
+        box at delta times the Jacobian of the map in the sampled (linear or
+        log mass, c) coordinates. Parts of the delta box whose preimage lies
+        outside the 200 box are not sampled.'''
+
+        m200 = np.asarray(m200, dtype=np.float64)
+        c200 = np.asarray(c200, dtype=np.float64)
+
+        if delta == 200:
+            return m200, c200, np.ones_like(m200)
+
+        cdelta = nfwutils.delta_conversion(c200, delta)
+        mdelta = m200*(delta/200.)*(cdelta/c200)**3
+
+        jacobian = np.abs(nfwutils.dxdelta_dc200(c200, delta))
+        if self.massprior == 'linear':
+            jacobian = jacobian*(mdelta/m200)
+
+        inprior = (mdelta >= self.m200_low) & (mdelta <= self.m200_high) & \
+            (cdelta >= self.c200_low) & (cdelta <= self.c200_high)
+
+        weights = np.where(inprior, jacobian, 0.)
+
+        return mdelta, cdelta, weights/np.mean(weights)
             
 
 
@@ -217,7 +345,7 @@ class NFW_MC_Model(NFW_Model):
             parts['m200'] = m200
 
         @pymc.deterministic
-        def c200(m200 = parts['m200'], zcluster = zcluster):
+        def c200(m200 = parts['m200']):
             
             return self.massconRelation(m200*nfwutils.global_cosmology.h, self.zcluster, self.overdensity)        
         parts['c200'] = c200
@@ -256,7 +384,8 @@ class NFW_MC_Model(NFW_Model):
                                           beta_s,
                                           beta_s2,
                                           rho_c,
-                                          rho_c_over_sigma_c)
+                                          rho_c_over_sigma_c,
+                                          200.)
 
 
             if not np.isfinite(logprob):
@@ -268,6 +397,43 @@ class NFW_MC_Model(NFW_Model):
         return pymc.Model(parts)
 
 
+    def makeNativeModel(self, profile, delta = 200):
+
+        self.setData(profile.beta_s, profile.beta_s2, profile.zcluster, zlens = profile.zlens)
+
+        posterior = tools.ShearProfilePosterior(profile.r_mpc, profile.ghat, profile.sigma_ghat,
+                                                profile.beta_s, profile.beta_s2,
+                                                self.rho_c, self.rho_c_over_sigma_c, 200.,
+                                                self.m200_low, self.m200_high,
+                                                logmass = self.massprior == 'log',
+                                                massScale = self.massScale,
+                                                concprior = False)
+
+        massname = 'logM200' if self.massprior == 'log' else 'scaledm200'
+
+        h = nfwutils.global_cosmology.h
+        def concentration(m200):
+            return self.massconRelation(m200*h, self.zcluster, self.overdensity)
+
+        return NativeNFWMCModel(posterior, massname, concentration, delta)
+
+
+    def convertChain(self, m200, c200, delta):
+        '''The prior is on m200 at every delta, so the conversion is exact and
+        the weights are all 1.'''
+
+        m200 = np.asarray(m200, dtype=np.float64)
+        c200 = np.asarray(c200, dtype=np.float64)
+
+        if delta == 200:
+            return m200, c200, np.ones_like(m200)
+
+        mdelta = nfwutils.convertMdelta(m200, c200, 200., targetdelta = delta)
+        cdelta = nfwutils.xdelta(c200, delta)
+
+        return mdelta, cdelta, np.ones_like(m200)
+
+
 
     def __call__(self, x, m200):
 
@@ -291,6 +457,26 @@ class MCMCFitter(object):
         if 'nsamples' in config:
             self.nsamples = config['nsamples']
 
+        #'native' evaluates the posterior in compiled code on a float vector,
+        #'pymc' goes through the pymc model graph
+        self.posterior = 'native'
+        if 'mcmcposterior' in config:
+            self.posterior = config['mcmcposterior']
+
+        #sample at 200 only, and convert the chain to the other deltas
+        self.transformdeltas = False
+        if 'mcmctransformdeltas' in config:
+            self.transformdeltas = config['mcmctransformdeltas']
+
+        #stop chains once every parameter reaches this effective sample size;
+        # nsamples is then the maximum chain length
+        self.minESS = None
+        if 'mcmcminess' in config:
+            self.minESS = config['mcmcminess']
+        self.maxRhat = 1.01
+        if 'mcmcmaxrhat' in config:
+            self.maxRhat = config['mcmcmaxrhat']
+
     def verifyfit(self, sim, profile, fitvals, outputname, raiseException = True):
         '''Not implemented yet for MCMCs - see PDFScanner for the version in 1-d'''
 
@@ -299,51 +485,141 @@ class MCMCFitter(object):
         
 
 
-    def __call__(self, profile):
+    def makeModel(self, profile, delta):
+
+        if self.posterior == 'native':
+            return self.model.makeNativeModel(profile, delta = delta)
+
+        mcmc_model = None
+        for i in range(20):
+            try:
+                mcmc_model = self.model.makeMCMCModel(profile, delta = delta)
+                break
+            except pymc.ZeroProbability:
+                pass
+        if mcmc_model is None:
+            raise pymc.ZeroProbability
+
+        return mcmc_model
+
+
+    def sampleChain(self, profile, delta):
+
+        mcmc_model = self.makeModel(profile, delta)
+        # This sets up Adam Mantz's version of an MCMC sampler for production code calculations.
+        # This is stored in mymcmc_adapter.py (converts to talk with other MCMC code)
+        # Imported as pma above.
+
+        manager = varcontainer.VarContainer()
+        options = varcontainer.VarContainer()
+        manager.options = options
+
+        options.singlecore = True
+        options.adapt_every = 100
+        options.adapt_after = 100
+        options.nsamples = self.nsamples
+        manager.model = mcmc_model
+        manager.native = self.posterior == 'native'
+
+        burn = 5000
+        if self.minESS is not None:
+            options.stopping = mymc.ConvergenceStopping(min_ess = self.minESS, max_rhat = self.maxRhat)
+
+        runner = pma.MyMCMemRunner()
+        runner.run(manager)
+        runner.finalize(manager)
+
+        if self.minESS is not None:
+            diagnostics = options.stopping.summary()
+            burn = diagnostics['burn']
+
+        reducedchain = dict(cdelta = manager.chain['cdelta'][burn::2].astype(np.float32),
+                            mdelta = manager.chain['mdelta'][burn::2].astype(np.float32),
+                            likelihood = manager.chain['likelihood'][burn::2].astype(np.float32))
+
+        reducedchain['metrics'] = manager.metrics
+
+        if self.minESS is not None:
+            reducedchain.update(ess = diagnostics['ess'],
+                                tau = diagnostics['tau'],
+                                rhat = diagnostics['rhat'],
+                                nsteps = diagnostics['stop_count'])
+
+        return reducedchain
+
+
+    def transformChain(self, chain200):
+        '''Chains at all deltas from one delta = 200 chain. Each carries
+        importance weights for the priors of a chain sampled at that delta.'''
 
         chains = {}
 
         for delta in self.deltas:
 
-            mcmc_model = None
-            for i in range(20):
-                try:
-                    mcmc_model = self.model.makeMCMCModel(profile, delta = delta)
-                    break
-                except pymc.ZeroProbability:
-                    pass
-            if mcmc_model is None:
-                raise pymc.ZeroProbability
-            # This sets up Adam Mantz's version of an MCMC sampler for production code calculations.
-            # This is stored in mymcmc_adapter.py (converts to talk with other MCMC code)
-            # Imported as pma above.
-            
-            manager = varcontainer.VarContainer()
-            options = varcontainer.VarContainer()
-            manager.options = options
+            mdelta, cdelta, weights = self.model.convertChain(chain200['mdelta'], chain200['cdelta'], delta)
 
-            options.singlecore = True
-            options.adapt_every = 100
-            options.adapt_after = 100
-            options.nsamples = self.nsamples
-            manager.model = mcmc_model
+            chains[delta] = dict(cdelta = cdelta.astype(np.float32),
+                                 mdelta = mdelta.astype(np.float32),
+                                 likelihood = np.copy(chain200['likelihood']),
+                                 weights = weights.astype(np.float32))
 
-            runner = pma.MyMCMemRunner()
-            runner.run(manager)
-            runner.finalize(manager)
+            for key in ['ess', 'tau', 'rhat', 'nsteps', 'metrics']:
+                if key in chain200:
+                    chains[delta][key] = chain200[key]
 
-            reducedchain = dict(cdelta = np.hstack(manager.chain['cdelta'][5000::2]).astype(np.float32),
-                                mdelta = np.hstack(manager.chain['mdelta'][5000::2]).astype(np.float32),
-                                likelihood = np.hstack(manager.chain['likelihood'][5000::2]).astype(np.float32))
+        return chains
+
+
+    def __call__(self, profile):
 
-            chains[delta] = reducedchain
+        if self.transformdeltas:
+            return self.transformChain(self.sampleChain(profile, 200))
+
+        chains = {}
+
+        for delta in self.deltas:
 
+            chains[delta] = self.sampleChain(profile, delta)
 
         return chains
 
 
 ##########
 
+def benchmarkMCMCPosterior(model, profile, nsamples = 2000, delta = 200):
+    '''Times MCMC steps per second through the pymc model graph and
+    through the native posterior, for one profile. Prints and returns a dict.'''
+
+    import time
+
+    timings = {}
+
+    for posterior in ['pymc', 'native']:
+
+        fitter = MCMCFitter()
+        fitter.configure(dict(model = model, mcmcposterior = posterior))
+
+        manager = varcontainer.VarContainer()
+        options = varcontainer.VarContainer()
+        manager.options = options
+        options.singlecore = True
+        options.adapt_every = 100
+        options.adapt_after = 100
+        options.nsamples = nsamples
+        manager.model = fitter.makeModel(profile, delta)
+        manager.native = posterior == 'native'
+
+        start = time.time()
+        runner = pma.MyMCMemRunner()
+        runner.run(manager)
+        runner.finalize(manager)
+        timings[posterior] = nsamples / (time.time() - start)
+
+    for posterior in ['pymc', 'native']:
+        print '%s: %.0f steps/sec' % (posterior, timings[posterior])
+    print 'speedup: %.1fx' % (timings['native'] / timings['pymc'])
+
+    return timings
 
 
 #######
@@ -386,6 +662,15 @@ class PDFScanner(object):
 
             
 
+    def concentrations(self, masses, zcluster, delta):
+        '''c200 for each M_delta in masses, as given by the model's mass-concentration relation'''
+
+        h = nfwutils.global_cosmology.h
+
+        return self.model.massconRelation(np.abs(masses)*h, zcluster, delta)
+
+    #######
+
     def __call__(self, profile):
 
 
@@ -399,44 +684,31 @@ class PDFScanner(object):
 
         masses = self.masses
 
+        r_mpc = np.ascontiguousarray(profile.r_mpc, dtype=np.float64)
+        ghat = np.ascontiguousarray(profile.ghat, dtype=np.float64)
+        sigma_ghat = np.ascontiguousarray(profile.sigma_ghat, dtype=np.float64)
+        beta_s = np.ascontiguousarray(self.model.beta_s, dtype=np.float64)
+        beta_s2 = np.ascontiguousarray(self.model.beta_s2, dtype=np.float64)
+
         for delta in self.deltas:
 
-            logprob = np.zeros(len(masses))
+            c200s = self.concentrations(masses, profile.zcluster, float(delta))
 
             if delta == 200:
                 workingmasses = masses
-                c200s = np.array([self.model.massconRelation(np.abs(curm)*nfwutils.global_cosmology.h, 
-                                                      profile.zcluster, float(delta)) for curm in workingmasses])
-            elif delta != 200:
-                workingmasses = np.zeros_like(masses)
-                c200s = np.zeros_like(masses)
-                for i, curm in enumerate(masses):
-                    c200 = self.model.massconRelation(np.abs(curm)*nfwutils.global_cosmology.h, 
-                                                      profile.zcluster, float(delta))
-                    rscale = nfwutils.rscaleConstM(np.abs(curm), c200, profile.zcluster, float(delta))
-                    m200 = nfwutils.Mdelta(rscale, c200, profile.zcluster, 200)
-                    if curm < 0:
-                        m200 = -m200
-                    workingmasses[i] = m200
-                    c200s[i] = c200
-
-            for i in range(len(workingmasses)):
-                mass = workingmasses[i]
-                c200 = c200s[i]
-
-                logprob[i] = tools.shearprofile_like(mass, c200,
-                                                    profile.r_mpc,
-                                                    profile.ghat,
-                                                    profile.sigma_ghat,
-                                                    self.model.beta_s,
-                                                    self.model.beta_s2,
-                                                    self.model.rho_c,
-                                                    self.model.rho_c_over_sigma_c,
-                                                    200.)
-
-
-
-
+            else:
+                workingmasses = nfwutils.convertMdelta(masses, c200s, float(delta), 200.)
+
+            logprob = tools.shearprofile_like_grid(np.ascontiguousarray(workingmasses, dtype=np.float64),
+                                                   np.ascontiguousarray(c200s, dtype=np.float64),
+                                                   r_mpc,
+                                                   ghat,
+                                                   sigma_ghat,
+                                                   beta_s,
+                                                   beta_s2,
+                                                   self.model.rho_c,
+                                                   self.model.rho_c_over_sigma_c,
+                                                   200.)
 
             pdf = np.exp(logprob - np.max(logprob))
             pdf = pdf/scipy.integrate.trapz(pdf, masses)
@@ -453,16 +725,9 @@ def convertLikelihoodScan(model, delta, masses, pdf200, zcluster):
 
     #treats input pdf as a likelihood scan & rescales axis. Does not transform like a PDF!!!
 
-    targetmasses = np.zeros_like(masses)
-    for i, curm in enumerate(masses):
-        c200 = model.massconRelation(np.abs(curm)*nfwutils.global_cosmology.h, 
-                                     zcluster, 200.)
-        r200 = nfwutils.rdeltaConstM(np.abs(curm), zcluster, 200.)
-        rscale = r200/c200
-        m_target = nfwutils.Mdelta(rscale, c200, zcluster, delta)
-        if curm < 0:
-            m_target = -m_target
-        targetmasses[i] = m_target
+    c200s = model.massconRelation(np.abs(masses)*nfwutils.global_cosmology.h, 
+                                  zcluster, 200.)
+    targetmasses = nfwutils.convertMdelta(masses, c200s, 200., float(delta))
     
 
     targetpdf = np.interp(masses, targetmasses, pdf200)
@@ -527,6 +792,9 @@ def preloadNFWFit(configname):
 
     nfwutils.global_cosmology.set_cosmology(simreader.getCosmology())
 
+    #the cache is shared by every config of a job, so the first config sets it up
+    geometrycache.global_geometrycache.configure(config)
+
     return config, simreader
 
 ###########################
@@ -554,6 +822,188 @@ def runNFWFit_Preloaded(simreader, catalogname, config, outputname):
 class FailedCreationException(Exception): pass
 
 
+############################
+
+class TestMCMCTransform(unittest.TestCase):
+
+    def makeProfile(self, model):
+
+        profile = varcontainer.VarContainer()
+        profile.zcluster = 0.3
+        profile.zlens = 0.3
+        profile.r_mpc = np.linspace(0.25, 3.0, 15)
+        profile.beta_s = 0.5*np.ones(15)
+        profile.beta_s2 = 0.3*np.ones(15)
+        profile.sigma_ghat = 0.005*np.ones(15)
+
+        model.setData(profile.beta_s, profile.beta_s2, profile.zcluster)
+        profile.ghat = model(profile.r_mpc, 5., 4.)
+
+        return profile
+
+    def compareChains(self, model, nsamples = 25000):
+
+        profile = self.makeProfile(model)
+
+        fitter = MCMCFitter()
+        fitter.configure(dict(model = model, nsamples = nsamples))
+
+        stdout = sys.stdout
+        try:
+            sys.stdout = open(os.devnull, 'w')
+            np.random.seed(11)
+            direct = fitter(profile)
+            np.random.seed(12)
+            fitter.transformdeltas = True
+            converted = fitter(profile)
+        finally:
+            sys.stdout = stdout
+
+        for delta in fitter.deltas:
+
+            weights = converted[delta]['weights']
+            self.assertTrue(np.all(weights >= 0))
+            self.assertAlmostEqual(np.mean(weights), 1., places = 4)
+
+            for key in ['mdelta', 'cdelta']:
+
+                samples = np.log(direct[delta][key])
+                mean, std = np.mean(samples), np.std(samples)
+
+                convsamples = np.log(converted[delta][key])
+                convmean = np.average(convsamples, weights = weights)
+                convstd = np.sqrt(np.average((convsamples - convmean)**2, weights = weights))
+
+                self.assertTrue(np.abs(convmean - mean) < 0.25*std, (delta, key, mean, convmean, std))
+                self.assertTrue(np.abs(convstd/std - 1) < 0.25, (delta, key, std, convstd))
+
+    def testNFWModel(self):
+
+        for massprior in ['linear', 'log']:
+            model = NFW_Model()
+            model.configure(dict(massprior = massprior))
+            self.compareChains(model)
+
+    def testConvertChain(self):
+
+        model = NFW_Model()
+        model.configure(dict(massprior = 'log'))
+
+        m200 = np.array([1e14, 5e14, 1e15])
+        c200 = np.array([2., 4., 8.])
+
+        for delta in [500, 2500]:
+
+            mdelta, cdelta, weights = model.convertChain(m200, c200, delta)
+            self.assertTrue(np.allclose(mdelta, nfwutils.convertMdelta(m200, c200, 200., targetdelta = delta), rtol = 1e-8))
+            self.assertTrue(np.allclose(cdelta, nfwutils.xdelta(c200, delta), rtol = 1e-8))
+
+            #log mass: weights are dcdelta/dc200 only
+            h = 1e-5*c200
+            dcdc = (nfwutils.xdelta(c200 + h, delta) - nfwutils.xdelta(c200 - h, delta))/(2*h)
+            self.assertTrue(np.allclose(weights, dcdc/np.mean(dcdc), rtol = 1e-6))
+
+
+class TestProfileBatch(unittest.TestCase):
+
+    def testBatchMatchesSingle(self):
+
+        model = NFW_Model()
+        model.configure({})
+
+        np.random.seed(5)
+        nprofiles = 7
+        nbins = np.random.randint(3, 20, size = nprofiles)
+        offsets = np.hstack([0, np.cumsum(nbins)]).astype(np.int64)
+
+        zclusters = np.random.uniform(0.2, 1.0, size = nprofiles)
+        r_mpc = np.hstack([np.linspace(0.25, 3.0, n) for n in nbins])
+        ghat = np.random.normal(0.03, 0.01, offsets[-1])
+        sigma_ghat = 0.01*np.ones(offsets[-1])
+        beta_s = 0.5*np.ones(offsets[-1])
+        beta_s2 = 0.3*np.ones(offsets[-1])
+
+        rho_c = np.zeros(nprofiles)
+        rho_c_over_sigma_c = np.zeros(nprofiles)
+        for i in range(nprofiles):
+            model.setData(0.5, 0.3, zclusters[i])
+            rho_c[i] = model.rho_c
+            rho_c_over_sigma_c[i] = model.rho_c_over_sigma_c
+
+        mdeltas = np.random.uniform(-2e14, 2e15, size = (nprofiles, 11))
+        cdeltas = np.random.uniform(1., 10., size = (nprofiles, 11))
+
+        for delta in [200, 500]:
+            for nthreads in [1, 3]:
+                logprobs = tools.shearprofile_like_batch(offsets, r_mpc, ghat, sigma_ghat,
+                                                         beta_s, beta_s2, rho_c, rho_c_over_sigma_c,
+                                                         mdeltas, cdeltas, float(delta),
+                                                         nthreads = nthreads)
+                for i in range(nprofiles):
+                    bins = slice(offsets[i], offsets[i+1])
+                    for j in range(11):
+                        logp = tools.shearprofile_like(mdeltas[i,j], cdeltas[i,j],
+                                                       r_mpc[bins], ghat[bins], sigma_ghat[bins],
+                                                       beta_s[bins], beta_s2[bins],
+                                                       rho_c[i], rho_c_over_sigma_c[i], delta)
+                        self.assertEqual(logprobs[i,j], logp)
+
+
+class TestShearProfileLike(unittest.TestCase):
+
+    def testMatchesShearKappa(self):
+
+        model = NFW_Model()
+        model.configure({})
+        model.setData(0.5, 0.3, 0.4)
+
+        np.random.seed(7)
+        r_mpc = np.linspace(0.1, 5.0, 40)
+        ghat = np.random.normal(0.03, 0.01, 40)
+        sigma_ghat = np.random.uniform(0.005, 0.02, 40)
+        beta_s = np.random.uniform(0.3, 0.7, 40)
+        beta_s2 = beta_s**2*np.random.uniform(1.0, 1.2, 40)
+
+        for delta in [200., 500.]:
+            for mdelta in [5e14, 2e15, -3e14, 0.]:
+                for cdelta in [2., 4., 9.]:
+
+                    gamma_inf = np.zeros(40)
+                    kappa_inf = np.zeros(40)
+                    if mdelta != 0:
+                        rdelta = (3*abs(mdelta)/(4*delta*np.pi*model.rho_c))**(1./3.)
+                        rscale = rdelta/cdelta
+                        gamma_inf = tools.NFWShear(r_mpc, cdelta, rscale, model.rho_c_over_sigma_c, delta = delta)
+                        kappa_inf = tools.NFWKappa(r_mpc, cdelta, rscale, model.rho_c_over_sigma_c, delta = delta)
+                    if mdelta < 0:
+                        gamma_inf = -gamma_inf
+
+                    modelg = beta_s*gamma_inf/(1 - (beta_s2/beta_s)*kappa_inf)
+                    expected = np.sum(-0.5*((ghat - modelg)/sigma_ghat)**2 \
+                                          - np.log(np.sqrt(2*np.pi)) - np.log(sigma_ghat))
+
+                    logp = tools.shearprofile_like(mdelta, cdelta, r_mpc, ghat, sigma_ghat,
+                                                   beta_s, beta_s2,
+                                                   model.rho_c, model.rho_c_over_sigma_c, delta)
+                    self.assertTrue(np.allclose(logp, expected, rtol = 1e-11, atol = 0))
+
+    def testEmptyProfile(self):
+
+        empty = np.zeros(0)
+        self.assertEqual(tools.shearprofile_like(1e15, 4., empty, empty, empty, empty, empty,
+                                                 1., 1., 200.), 0.)
+
+        logprobs = tools.shearprofile_like_grid(np.array([1e14, 1e15]), np.array([4., 4.]),
+                                                empty, empty, empty, empty, empty,
+                                                1., 1., 200.)
+        self.assertTrue((logprobs == 0.).all())
+
+
+def runtests():
+
+    unittest.main(argv = sys.argv[:1])
+
+
 if __name__ == '__main__':
 
 
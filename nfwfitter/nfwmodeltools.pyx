@@ -8,20 +8,24 @@
 
 # cython: profile=False
 
+import os, multiprocessing
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange
 
 import scipy.optimize
 
 import nfwutils
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     double exp(double)
     double log(double)
     double atanh(double)
     double sqrt(double)
     double atan(double)
+    double fabs(double)
+    double M_PI
 
 
 
@@ -43,11 +47,44 @@ ctypedef np.double_t DTYPE_T
 # NFW Profile
 ############################
 
-cdef double deltaC(double c, double delta = 200.):
+cdef double deltaC(double c, double delta = 200.) nogil:
     return (delta/3.) * c**3 / (log(1+c) - c/(1+c))
 
 ##############
 
+# Dimensionless shear and convergence at x = r/rs, without amplitudes.
+# Both share the atanh/atan and sqrt(|1-x^2|) terms, so they are
+# computed together for the fused likelihood below.
+
+@cython.cdivision(True)
+cdef inline void _nfwshearkappa_x(double x, double *gamma, double *kappa) nogil:
+
+    cdef double a, b, c, x2, logterm
+
+    x2 = x*x
+
+    if x < 1:
+        a = atanh(sqrt((1-x)/(1+x)))
+        b = sqrt(1-x2)
+        c = x2 - 1
+        logterm = 4*log(x/2)/x2
+        gamma[0] = 8*a/(b*x2) + logterm - 2/c + 4*a/(b*c)
+        kappa[0] = (1 - 2.*a/b)/c
+
+    elif x > 1:
+        a = atan(sqrt((x-1)/(1+x)))
+        b = sqrt(x2-1)
+        c = x2 - 1
+        logterm = 4*log(x/2)/x2
+        gamma[0] = 8*a/(b*x2) + logterm - 2/(b*b) + 4*a/(b*b*b)
+        kappa[0] = (1 - 2.*a/b)/c
+
+    else:
+        gamma[0] = 10./3 + 4*log(.5)
+        kappa[0] = 1./3.
+
+##############
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -187,15 +224,11 @@ def rdelta2rs(double rdelta,
               double c200, 
               double delta):
 
-    cdef double delta_c = deltaC(c200)
-    
-    # x = r_delta / rs
-    def f(x):
-        
-        return 3*delta_c*(log(1+x) - (x/(1+x)))/x**3 - delta
+    # x = r_delta / rs, from the tabulated solution in nfwutils
+    cdef double x0 = nfwutils.xdelta(c200, delta)
 
-    
-    x0 = scipy.optimize.brenth(f, 0.1, 20)
+    if x0 != x0:
+        raise ValueError('No r_delta/r_s solution in [0.1, 20] for c200 = %s, delta = %s' % (c200, delta))
 
     cdef double rs = rdelta / x0
 
@@ -248,8 +281,8 @@ def shearprofile_like(double mdelta,
                       np.ndarray[np.double_t, ndim=1, mode='c'] bin_r_mpc not None,
                       np.ndarray[np.double_t, ndim=1, mode='c'] bin_shear not None,
                       np.ndarray[np.double_t, ndim=1, mode='c'] bin_shearerr not None,
-                      np.ndarray[np.double_t, ndim=1, mode='c'] avebeta,
-                      np.ndarray[np.double_t, ndim=1, mode='c'] avebeta2,
+                      np.ndarray[np.double_t, ndim=1, mode='c'] avebeta not None,
+                      np.ndarray[np.double_t, ndim=1, mode='c'] avebeta2 not None,
                       double rho_c,
                       double rho_c_over_sigma_c,
                       double massdelta):
@@ -261,54 +294,305 @@ for lensing
     Note: whatever we set massdelta to be, c will be the corresponding overdensity
     '''
 
-    cdef Py_ssize_t nbins = bin_r_mpc.shape[0]
+    assert(bin_shear.shape[0] == bin_r_mpc.shape[0] and bin_shearerr.shape[0] == bin_r_mpc.shape[0])
+    assert(avebeta.shape[0] == bin_r_mpc.shape[0] and avebeta2.shape[0] == bin_r_mpc.shape[0])
 
-    cdef np.ndarray[DTYPE_T, ndim=1, mode='c'] gamma_inf
-    cdef np.ndarray[DTYPE_T, ndim=1, mode='c'] kappa_inf
-    cdef double rscale
+    if bin_r_mpc.shape[0] == 0:
+        return 0.
 
-    if mdelta == 0:
-        gamma_inf = np.zeros(nbins)
-        kappa_inf = np.zeros(nbins)
-    else:
+    return _shearprofile_logp(mdelta, cdelta,
+                              &bin_r_mpc[0], &bin_shear[0], &bin_shearerr[0],
+                              &avebeta[0], &avebeta2[0], bin_r_mpc.shape[0],
+                              rho_c, rho_c_over_sigma_c, massdelta)
+    
+    
+                      
 
-        rdelta = (3*abs(mdelta)/(4*massdelta*np.pi*rho_c))**(1./3.)
-        rscale = rdelta / cdelta
-        # Expected gamma for source at infinite redshift
-        gamma_inf = NFWShear(bin_r_mpc, cdelta, rscale, rho_c_over_sigma_c, delta = massdelta)
-        kappa_inf = NFWKappa(bin_r_mpc, cdelta, rscale, rho_c_over_sigma_c, delta = massdelta)
 
-    if mdelta < 0.:
-        gamma_inf = -gamma_inf
+#######################
 
+cdef double _logsqrt2pi = log(sqrt(2*M_PI))
 
-    cdef int curbin = 0
-    cdef double gtilde = 0.
-    cdef double delta = 0.
-    cdef double modelg = 0.
-    cdef modsig = 0.
+@cython.cdivision(True)
+cdef double _shearprofile_logp(double mdelta, double cdelta,
+                               double *bin_r_mpc, double *bin_shear, double *bin_shearerr,
+                               double *avebeta, double *avebeta2, Py_ssize_t nbins,
+                               double rho_c, double rho_c_over_sigma_c, double massdelta) nogil:
 
-    cdef Py_ssize_t i, j, s
-    cdef DTYPE_T logProb = 0.
+    # shearprofile_like for one (mdelta, cdelta): shear, convergence,
+    # reduced shear and the gaussian log likelihood in one pass
 
-    cdef double betaratio
+    cdef Py_ssize_t i
+    cdef double rdelta, rscale, delta_c, shearamp, kappaamp
+    cdef double gamma_x, kappa_x, gamma_inf, kappa_inf, modelg, delta, modsig
+    cdef double logProb
+    cdef double threshtrd = 1./3.
 
-        
-    # calculate logprob, which we want to maximize (same as minimizing chi squared)
+    shearamp = 0.
+    kappaamp = 0.
+    rscale = 1.
+    if mdelta != 0:
+        rdelta = (3*fabs(mdelta)/(4*massdelta*M_PI*rho_c))**threshtrd
+        rscale = rdelta / cdelta
+        delta_c = deltaC(cdelta, massdelta)
+        shearamp = rscale*delta_c*rho_c_over_sigma_c
+        kappaamp = 2*shearamp
+        if mdelta < 0.:
+            shearamp = -shearamp
+
+    logProb = 0.
     for i from nbins > i >= 0:
 
-        betaratio = avebeta2[i]/avebeta[i]
-        # Model prediction of shear
-        modelg = (avebeta[i]*gamma_inf[i] / (1 - betaratio*kappa_inf[i]))
+        if mdelta != 0:
+            _nfwshearkappa_x(bin_r_mpc[i]/rscale, &gamma_x, &kappa_x)
+            gamma_inf = shearamp*gamma_x
+            kappa_inf = kappaamp*kappa_x
+        else:
+            gamma_inf = 0.
+            kappa_inf = 0.
+
+        # Model prediction of shear, for sources at avebeta
+        modelg = (avebeta[i]*gamma_inf / (1 - (avebeta2[i]/avebeta[i])*kappa_inf))
 
         delta = bin_shear[i] - modelg
 
         modsig = bin_shearerr[i]
-        # Log of a gaussian prob: Chi squared term plus normalization term
-        logProb = logProb -.5*(delta/modsig)**2  - logsqrt2pi - log(modsig)
+        logProb = logProb -.5*(delta/modsig)**2  - _logsqrt2pi - log(modsig)
 
-        
     return logProb
-    
-    
-                      
+
+#######################
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def shearprofile_like_grid(np.ndarray[np.double_t, ndim=1, mode='c'] mdeltas not None,
+                           np.ndarray[np.double_t, ndim=1, mode='c'] cdeltas not None,
+                           np.ndarray[np.double_t, ndim=1, mode='c'] bin_r_mpc not None,
+                           np.ndarray[np.double_t, ndim=1, mode='c'] bin_shear not None,
+                           np.ndarray[np.double_t, ndim=1, mode='c'] bin_shearerr not None,
+                           np.ndarray[np.double_t, ndim=1, mode='c'] avebeta not None,
+                           np.ndarray[np.double_t, ndim=1, mode='c'] avebeta2 not None,
+                           double rho_c,
+                           double rho_c_over_sigma_c,
+                           double massdelta):
+
+    '''Batched version of shearprofile_like. Evaluates the log likelihood
+    for each (mdeltas[k], cdeltas[k]) pair in one compiled loop, with the
+    GIL released.
+
+    Returns an array of log likelihoods, one per mass.'''
+
+    cdef Py_ssize_t nmasses = mdeltas.shape[0]
+    cdef Py_ssize_t nbins = bin_r_mpc.shape[0]
+
+    assert(cdeltas.shape[0] == nmasses)
+    assert(bin_shear.shape[0] == nbins and bin_shearerr.shape[0] == nbins)
+    assert(avebeta.shape[0] == nbins and avebeta2.shape[0] == nbins)
+
+    cdef np.ndarray[DTYPE_T, ndim=1, mode='c'] logprobs = np.zeros(nmasses, dtype=np.float64)
+
+    cdef double *mdeltas_p = &mdeltas[0] if nmasses > 0 else NULL
+    cdef double *cdeltas_p = &cdeltas[0] if nmasses > 0 else NULL
+    cdef double *logprobs_p = &logprobs[0] if nmasses > 0 else NULL
+    cdef double *r_p = &bin_r_mpc[0] if nbins > 0 else NULL
+    cdef double *shear_p = &bin_shear[0] if nbins > 0 else NULL
+    cdef double *shearerr_p = &bin_shearerr[0] if nbins > 0 else NULL
+    cdef double *beta_p = &avebeta[0] if nbins > 0 else NULL
+    cdef double *beta2_p = &avebeta2[0] if nbins > 0 else NULL
+
+    cdef Py_ssize_t k
+
+    with nogil:
+        for k from 0 <= k < nmasses:
+
+            logprobs_p[k] = _shearprofile_logp(mdeltas_p[k], cdeltas_p[k],
+                                               r_p, shear_p, shearerr_p,
+                                               beta_p, beta2_p, nbins,
+                                               rho_c, rho_c_over_sigma_c, massdelta)
+
+    return logprobs
+
+
+#######################
+
+def _defaultThreads():
+
+    if 'OMP_NUM_THREADS' in os.environ:
+        return int(os.environ['OMP_NUM_THREADS'])
+    return multiprocessing.cpu_count()
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def shearprofile_like_batch(np.ndarray[np.int64_t, ndim=1, mode='c'] offsets not None,
+                            np.ndarray[np.double_t, ndim=1, mode='c'] bin_r_mpc not None,
+                            np.ndarray[np.double_t, ndim=1, mode='c'] bin_shear not None,
+                            np.ndarray[np.double_t, ndim=1, mode='c'] bin_shearerr not None,
+                            np.ndarray[np.double_t, ndim=1, mode='c'] avebeta not None,
+                            np.ndarray[np.double_t, ndim=1, mode='c'] avebeta2 not None,
+                            np.ndarray[np.double_t, ndim=1, mode='c'] rho_c not None,
+                            np.ndarray[np.double_t, ndim=1, mode='c'] rho_c_over_sigma_c not None,
+                            np.ndarray[np.double_t, ndim=2, mode='c'] mdeltas not None,
+                            np.ndarray[np.double_t, ndim=2, mode='c'] cdeltas not None,
+                            double massdelta,
+                            nthreads = None):
+
+    '''shearprofile_like for many profiles and many parameters per profile,
+    evaluated on nthreads OpenMP threads with the GIL released (serially
+    if the module was built without OpenMP).
+
+    Profile i is bins offsets[i]:offsets[i+1] of the concatenated bin
+    arrays, with rho_c[i] and rho_c_over_sigma_c[i]. mdeltas and cdeltas
+    are (nprofiles, npoints). nthreads defaults to $OMP_NUM_THREADS, else
+    the number of cores.
+
+    Returns an (nprofiles, npoints) array of log likelihoods.'''
+
+    cdef Py_ssize_t nprofiles = offsets.shape[0] - 1
+    cdef Py_ssize_t nbins = bin_r_mpc.shape[0]
+
+    assert(nprofiles >= 0)
+    assert(bin_shear.shape[0] == nbins and bin_shearerr.shape[0] == nbins)
+    assert(avebeta.shape[0] == nbins and avebeta2.shape[0] == nbins)
+    assert(rho_c.shape[0] == nprofiles and rho_c_over_sigma_c.shape[0] == nprofiles)
+    assert(mdeltas.shape[0] == nprofiles and cdeltas.shape[0] == nprofiles)
+    assert(mdeltas.shape[1] == cdeltas.shape[1])
+    if nprofiles > 0:
+        assert(offsets[0] == 0 and offsets[nprofiles] == nbins)
+        assert(np.all(np.diff(offsets) >= 0))
+
+    cdef Py_ssize_t npoints = mdeltas.shape[1]
+
+    cdef np.ndarray[DTYPE_T, ndim=2, mode='c'] logprobs = np.zeros((nprofiles, npoints), dtype=np.float64)
+
+    if nprofiles == 0 or npoints == 0:
+        return logprobs
+
+    if nthreads is None:
+        nthreads = _defaultThreads()
+    cdef int cnthreads = max(1, nthreads)
+
+    cdef np.int64_t *offsets_p = &offsets[0]
+    cdef double *r_p = &bin_r_mpc[0] if nbins > 0 else NULL
+    cdef double *shear_p = &bin_shear[0] if nbins > 0 else NULL
+    cdef double *shearerr_p = &bin_shearerr[0] if nbins > 0 else NULL
+    cdef double *beta_p = &avebeta[0] if nbins > 0 else NULL
+    cdef double *beta2_p = &avebeta2[0] if nbins > 0 else NULL
+    cdef double *rho_c_p = &rho_c[0]
+    cdef double *rho_c_over_sigma_c_p = &rho_c_over_sigma_c[0]
+    cdef double *mdeltas_p = &mdeltas[0,0]
+    cdef double *cdeltas_p = &cdeltas[0,0]
+    cdef double *logprobs_p = &logprobs[0,0]
+
+    cdef Py_ssize_t k, i, start
+
+    # one work item per (profile, point), so uneven profiles still balance
+    for k in prange(nprofiles*npoints, nogil=True, schedule='guided', num_threads=cnthreads):
+
+        i = k / npoints
+        start = offsets_p[i]
+
+        logprobs_p[k] = _shearprofile_logp(mdeltas_p[k], cdeltas_p[k],
+                                           r_p + start, shear_p + start, shearerr_p + start,
+                                           beta_p + start, beta2_p + start,
+                                           offsets_p[i+1] - start,
+                                           rho_c_p[i], rho_c_over_sigma_c_p[i], massdelta)
+
+    return logprobs
+
+
+#######################
+
+cdef double _neginf = -np.inf
+
+cdef class ShearProfilePosterior:
+
+    '''Log posterior for one shear profile, for samplers that hand over
+    plain floats instead of pymc nodes.
+
+    The mass parameter is mdelta/massScale with a uniform prior on
+    [mlow, mhigh], or log(mdelta) with a uniform prior on [log mlow,
+    log mhigh] if logmass is set. If concprior is set, cdelta has a
+    uniform prior on [clow, chigh]; otherwise only a finite, positive
+    cdelta is required. Priors are normalized as in pymc.Uniform.'''
+
+    cdef double[::1] bin_r_mpc, bin_shear, bin_shearerr, avebeta, avebeta2
+    cdef Py_ssize_t nbins
+    cdef public double rho_c, rho_c_over_sigma_c, massdelta, massScale
+    cdef public double plow, phigh, clow, chigh
+    cdef public bint logmass, concprior
+    cdef double norm
+
+    def __init__(self, bin_r_mpc, bin_shear, bin_shearerr, avebeta, avebeta2,
+                 double rho_c, double rho_c_over_sigma_c, double massdelta,
+                 double mlow, double mhigh, double clow = 0.1, double chigh = 30.,
+                 bint logmass = False, double massScale = 1e14, bint concprior = True):
+
+        self.bin_r_mpc = np.ascontiguousarray(bin_r_mpc, dtype=np.float64)
+        self.bin_shear = np.ascontiguousarray(bin_shear, dtype=np.float64)
+        self.bin_shearerr = np.ascontiguousarray(bin_shearerr, dtype=np.float64)
+        self.avebeta = np.ascontiguousarray(avebeta, dtype=np.float64)
+        self.avebeta2 = np.ascontiguousarray(avebeta2, dtype=np.float64)
+        self.nbins = self.bin_r_mpc.shape[0]
+
+        self.rho_c = rho_c
+        self.rho_c_over_sigma_c = rho_c_over_sigma_c
+        self.massdelta = massdelta
+        self.massScale = massScale
+        self.logmass = logmass
+        self.concprior = concprior
+        self.clow = clow
+        self.chigh = chigh
+
+        if logmass:
+            self.plow = log(mlow)
+            self.phigh = log(mhigh)
+        else:
+            self.plow = mlow/massScale
+            self.phigh = mhigh/massScale
+
+        self.norm = -log(self.phigh - self.plow)
+        if concprior:
+            self.norm -= log(chigh - clow)
+
+    cpdef double mdelta(self, double mparam):
+
+        if self.logmass:
+            return exp(mparam)
+        return self.massScale*mparam
+
+    cpdef double logprior(self, double mparam, double cdelta):
+
+        if not (self.plow <= mparam <= self.phigh):
+            return _neginf
+        if self.concprior:
+            if not (self.clow <= cdelta <= self.chigh):
+                return _neginf
+        elif not (0. < cdelta < -_neginf):
+            return _neginf
+        return self.norm
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef double loglike(self, double mdelta, double cdelta):
+
+        cdef double logp = _shearprofile_logp(mdelta, cdelta,
+                                              &self.bin_r_mpc[0], &self.bin_shear[0], &self.bin_shearerr[0],
+                                              &self.avebeta[0], &self.avebeta2[0], self.nbins,
+                                              self.rho_c, self.rho_c_over_sigma_c, self.massdelta)
+        if logp != logp:
+            return _neginf
+        return logp
+
+    cpdef double logpost(self, double mparam, double cdelta):
+
+        cdef double logp = self.logprior(mparam, cdelta)
+        if logp == _neginf:
+            return logp
+        return logp + self.loglike(self.mdelta(mparam), cdelta)
+
+    def __call__(self, x):
+        '''x = (mass parameter, cdelta)'''
+
+        return self.logpost(x[0], x[1])
@@ -7,7 +7,10 @@ from scipy.integrate import quad
 import numpy as np
 import varcontainer as vc
 import scipy.optimize
+import scipy.interpolate
 import copy
+import collections
+import unittest
 
 #############################
 
@@ -17,29 +20,100 @@ v_c = 299792.458 #km/s
 #############################
 
 class ComovingDistMemoization(object):
+    '''Comoving distance for a cosmology, in Mpc.
 
-    def __init__(self, cosmology, memotable = None):
+    Redshifts up to zmax are answered from a cubic spline through a
+    table built on first use (Gauss-Legendre integration per grid
+    interval). Redshifts beyond the table fall back to quad, memoized
+    in a bounded LRU cache. Accepts scalars or arrays.
+
+    The table is rebuilt if the cosmological parameters change, or
+    explicitly via invalidate().'''
+
+    def __init__(self, cosmology, memotable = None, zmax = 10., nz = 2000, maxsize = 10000):
 
         if memotable is None:
-            memotable = {}
+            memotable = collections.OrderedDict()
 
         self.memotable = memotable
         self.cosmology = cosmology
-    def __call__(self, z):
+        self.zmax = zmax
+        self.nz = nz
+        self.maxsize = maxsize
 
+        self.spline = None
+        self.tablekey = None
 
-        if z in self.memotable:
-            return self.memotable[z]
+    def _cosmokey(self):
 
-        def integrand(z):
+        c = self.cosmology
+        return (c.omega_m, c.omega_l, c.omega_r, c.h, c.w, c.v_c)
+
+    def invalidate(self):
+
+        self.spline = None
+        self.tablekey = None
+        self.memotable.clear()
+
+    def _integrand(self, z):
 
-            return 1./np.sqrt(self.cosmology.hubble2(z))
+        return 1./np.sqrt(self.cosmology.hubble2(z))
+
+    def _buildTable(self):
+
+        zgrid = np.linspace(0., self.zmax, self.nz)
+
+        nodes, weights = np.polynomial.legendre.leggauss(10)
+        lo = zgrid[:-1, np.newaxis]
+        halfwidth = 0.5*(zgrid[1:] - zgrid[:-1])[:, np.newaxis]
+        zs = lo + halfwidth*(nodes + 1)
+        pieces = np.sum(halfwidth*weights*self._integrand(zs), axis=1)
+
+        dist = self.cosmology.v_c*np.hstack([0., np.cumsum(pieces)])
+
+        self.spline = scipy.interpolate.InterpolatedUnivariateSpline(zgrid, dist, k = 3)
+        self.tablekey = self._cosmokey()
+
+    def _quad(self, z):
+
+        if z in self.memotable:
+            dist = self.memotable.pop(z)
+            self.memotable[z] = dist
+            return dist
 
-        y, err = quad(integrand, 0, z)
+        y, err = quad(self._integrand, 0, z)
     
         dist = self.cosmology.v_c * y  #to get proper units, ie to put in the hubble length
 
         self.memotable[z] = dist
+        if len(self.memotable) > self.maxsize:
+            self.memotable.popitem(last = False)
+
+        return dist
+
+    def __call__(self, z):
+
+        if self.tablekey != self._cosmokey():
+            self.invalidate()
+            self._buildTable()
+
+        if np.ndim(z) == 0:
+            z = float(z)
+            if 0 <= z <= self.zmax:
+                return float(self.spline(z))
+            return self._quad(z)
+
+        z = np.asarray(z, dtype=np.float64)
+
+        intable = np.logical_and(z >= 0, z <= self.zmax)
+
+        dist = np.empty(z.shape)
+        dist[intable] = self.spline(z[intable])
+
+        if not np.all(intable):
+            outside = np.logical_not(intable)
+            uniquez, inverse = np.unique(z[outside], return_inverse = True)
+            dist[outside] = np.array([self._quad(curz) for curz in uniquez])[inverse]
 
         return dist
 
@@ -59,6 +133,11 @@ class Cosmology(object):
 
         self.comovingdist = ComovingDistMemoization(self)
 
+    def invalidate(self):
+        '''Drop tabulated distances, eg after changing parameters in place'''
+
+        self.comovingdist.invalidate()
+
     def __copy__(self):
 
         return Cosmology(omega_m = self.omega_m, omega_l = self.omega_l, h = self.h, w = self.w, omega_r = self.omega_r, G = self.G)
@@ -125,10 +204,12 @@ class Cosmology(object):
 
     def beta(self, z, zcluster):
 
-        Ds = array([self.angulardist(zi) for zi in z])
-        Dls = array([self.angulardist(zcluster, zi) for zi in z])
+        z = np.asarray(z, dtype=np.float64)
 
-        Dls_over_Ds = zeros_like(Dls)
+        Ds = self.angulardist(z)
+        Dls = self.angulardist(zcluster, z)
+
+        Dls_over_Ds = np.zeros_like(Dls)
         Dls_over_Ds[Ds > 0] = Dls[Ds > 0] / Ds[Ds > 0]
         Dls_over_Ds[Dls <= 0] = 0
 
@@ -160,7 +241,7 @@ class CosmologySingleton(object):
         else:
             self._cosmology = copy.copy(startCosmology)
 
-        self.comovingdist = ComovingDistMemoization(self._cosmology)
+        self.comovingdist = self._cosmology.comovingdist
 
     def get_cosmology(self):
         return copy.copy(self._cosmology)
@@ -168,8 +249,9 @@ class CosmologySingleton(object):
     def set_cosmology(self, newcosmo):
         if not self.isMutable:
             raise CosmologyFixedException
+        self._cosmology.invalidate()
         self._cosmology = copy.copy(newcosmo)
-        self.comovingdist = ComovingDistMemoization(self._cosmology)
+        self.comovingdist = self._cosmology.comovingdist
 
     cosmology = property(get_cosmology, set_cosmology)
 
@@ -273,18 +355,145 @@ def massInsideR_amp(rs, amp, z, R, cosmology = global_cosmology):
     return (np.log(1+x) - (x/(1+x)))*deltac_rhoc_rs3_4pi
 
 ###################################
+# NFW overdensity conversions
+###################################
 
-def rdelta2rs(rdelta, c, delta):
+# For an NFW halo with concentration c200, x = r_delta / r_s solves
+#   g(x) = (delta/200) g(c200),  g(y) = (ln(1+y) - y/(1+y))/y^3
+# so one table inverting g answers every (c200, delta) combination.
 
-    delta_c = deltaC(c)
-    
-    # x = r_delta / rs
-    def f(x):
-        
-        return 3*delta_c*(np.log(1+x) - (x/(1+x)))/x**3 - delta
+def _nfw_g(y):
+
+    return (np.log1p(y) - (y/(1+y)))/y**3
+
+def _nfw_dg(y):
+
+    return 1./(y*(1+y))**2 - 3*(np.log1p(y) - (y/(1+y)))/y**4
+
+
+class DeltaConversionTable(object):
+    '''Tabulated inverse of g(y), used to convert between overdensities
+    without root finding. Lookups are linear interpolation in log-log space
+    followed by Newton polishing against the exact g, iterated until the
+    relative correction falls below tol.'''
+
+    def __init__(self, xmin = 1e-2, xmax = 1e2, npoints = 4000, tol = 1e-10, maxiter = 5):
+
+        self.tol = tol
+        self.maxiter = maxiter
+
+        self.logx = np.linspace(np.log(xmin), np.log(xmax), npoints)
+        self.logg = np.log(_nfw_g(np.exp(self.logx)))
+
+        self._buildLookup()
+
+    def _buildLookup(self):
+
+        #np.interp wants increasing abscissa; g is decreasing
+        self._loggs = self.logg[::-1]
+        self._logxs = self.logx[::-1]
+        self.xmin = np.exp(self.logx[0])
+        self.xmax = np.exp(self.logx[-1])
+
+    def save(self, filename):
+
+        np.savez(filename, logx = self.logx, logg = self.logg, 
+                 tol = self.tol, maxiter = self.maxiter)
+
+    @classmethod
+    def load(cls, filename):
+
+        data = np.load(filename)
+
+        table = cls.__new__(cls)
+        table.logx = data['logx']
+        table.logg = data['logg']
+        table.tol = float(data['tol'])
+        table.maxiter = int(data['maxiter'])
+        table._buildLookup()
+
+        return table
+
+    def invert(self, target):
+        '''Returns y with g(y) = target, to relative precision tol.
+        Targets outside the table are nan.'''
+
+        target = np.asarray(target, dtype=np.float64)
+        shape = target.shape
+        target = np.atleast_1d(target)
+
+        logtarget = np.log(target)
+        intable = np.logical_and(logtarget >= self._loggs[0], logtarget <= self._loggs[-1])
+
+        x = np.exp(np.interp(logtarget, self._loggs, self._logxs))
+
+        unconverged = intable
+        for i in range(self.maxiter):
+            step = (_nfw_g(x) - target)/_nfw_dg(x)
+            x = x - step
+            unconverged = np.logical_and(intable, np.logical_not(np.abs(step) <= self.tol*x))
+            if not np.any(unconverged):
+                break
+
+        #Newton did not settle within maxiter; bracket those targets instead
+        for i in np.flatnonzero(unconverged):
+            x[i] = scipy.optimize.brenth(lambda y: _nfw_g(y) - target[i], self.xmin, self.xmax,
+                                         xtol = self.tol*self.xmin, rtol = self.tol)
+
+        return np.where(intable, x, np.nan).reshape(shape)
+
+    def __call__(self, c200, delta):
+        '''x = r_delta / r_s for an NFW halo with the given c200'''
+
+        c200 = np.asarray(c200, dtype=np.float64)
+
+        return self.invert((delta/200.)*_nfw_g(c200))
 
-    
-    x0 = scipy.optimize.brenth(f, 0.1, 20)
+
+delta_conversion = DeltaConversionTable()
+
+def loadDeltaConversionTable(filename):
+    '''Replace the module lookup table with one saved by DeltaConversionTable.save'''
+
+    global delta_conversion
+    delta_conversion = DeltaConversionTable.load(filename)
+
+    return delta_conversion
+
+###################################
+
+def xdelta(c200, delta, xmin = 0.1, xmax = 20.):
+    '''Vectorized version of the root find in rdelta2rs.
+    Returns x = r_delta / r_s for an array of c200s. Roots outside
+    [xmin, xmax], the bracket previously handed to brenth, are nan.'''
+
+    c200 = np.asarray(c200, dtype=np.float64)
+
+    if delta == 200.:
+        return np.copy(c200)
+
+    x0 = delta_conversion(c200, delta)
+
+    inbracket = np.logical_and(x0 >= xmin, x0 <= xmax)
+
+    return np.where(inbracket, x0, np.nan)
+
+def _xdelta_checked(c200, delta):
+
+    x0 = xdelta(c200, delta)
+
+    if np.any(np.isnan(x0)):
+        raise ValueError('No r_delta/r_s solution in [0.1, 20] for c200 = %s, delta = %s' % (c200, delta))
+
+    if np.ndim(x0) == 0:
+        return float(x0)
+    return x0
+
+###################################
+
+def rdelta2rs(rdelta, c, delta):
+
+    x0 = _xdelta_checked(c, float(delta))
 
     return rdelta / x0
 
@@ -293,34 +502,42 @@ def rdelta2rs(rdelta, c, delta):
 
 def rdelta(rs, c, delta):
 
-    delta_c = deltaC(c)
-    
-    # x = r_delta / rs
-    def f(x):
-        
-        return 3*delta_c*(np.log(1+x) - (x/(1+x)))/x**3 - delta
-
-    
-    x0 = scipy.optimize.brenth(f, 0.1, 20)
+    x0 = _xdelta_checked(c, float(delta))
 
     return x0*rs
 
+###################################
+def convertMdelta(mdelta, c200, delta, targetdelta = 200.):
+    '''Vectorized conversion of M_delta to M_targetdelta for NFW halos
+    described by c200. Equivalent to rscaleConstM followed by Mdelta,
+    but independent of redshift & cosmology. Preserves sign of mdelta.'''
+
+    mdelta = np.asarray(mdelta, dtype=np.float64)
+
+    x_in = xdelta(c200, float(delta))
+    x_out = xdelta(c200, float(targetdelta))
+
+    return mdelta*(float(targetdelta)/delta)*(x_out/x_in)**3
+
+def dxdelta_dc200(c200, delta):
+    '''d(r_delta/r_s)/dc200, from differentiating g(x) = (delta/200) g(c200).
+    Unbracketed, unlike xdelta.'''
+
+    c200 = np.asarray(c200, dtype=np.float64)
+
+    x = delta_conversion(c200, float(delta))
+
+    return (delta/200.)*_nfw_dg(c200)/_nfw_dg(x)
+
 ####
 
 def rdelta_m(rs, c, z, delta):
 
-    delta_c = deltaC(c)
     rho_crit = global_cosmology.rho_crit(z)
     rho_m = global_cosmology.rho_m(z)
     
-    # x = r_delta / rs
-    def f(x):
-        
-        return 3*delta_c*rho_crit*(np.log(1+x) - (x/(1+x)))/x**3 - delta*rho_m
-
-
-    
-    x0 = scipy.optimize.brenth(f, 0.1, 20)
+    # x = r_delta / rs, with delta wrt the mean density
+    x0 = _xdelta_checked(c, delta*rho_m/rho_crit)
 
     return x0*rs
 
@@ -362,12 +579,80 @@ def rscaleConstM(mdelta, c200, z, delta, cosmology = global_cosmology):
 
     return rdelta2rs(rdelta, c200, delta)
 
+###############################
+
+def benchmarkDeltaConversion(nsamples = 2000, deltas = (500., 2500.), cmin = 1., cmax = 15., seed = 1234):
+    '''Compare the delta conversion table against the brenth root finder
+    for speed and accuracy. Returns a dict keyed by delta.'''
+
+    import time
+
+    c200s = np.random.RandomState(seed).uniform(cmin, cmax, size=nsamples)
+
+    results = {}
+    for delta in deltas:
 
+        start = time.time()
+        brenth_x = np.zeros(nsamples)
+        for i, c200 in enumerate(c200s):
+            delta_c = deltaC(c200)
+            def f(x):
+                return 3*delta_c*(np.log(1+x) - (x/(1+x)))/x**3 - delta
+            brenth_x[i] = scipy.optimize.brenth(f, 0.1, 20)
+        brenth_time = time.time() - start
+
+        start = time.time()
+        table_x = xdelta(c200s, delta)
+        table_time = time.time() - start
+
+        maxrelerr = np.max(np.abs(table_x/brenth_x - 1))
+
+        print 'delta %d: brenth %.3g s, table %.3g s (x%.1f), max rel err %.2g' % \
+            (delta, brenth_time, table_time, brenth_time/table_time, maxrelerr)
+
+        results[delta] = dict(brenth_time = brenth_time, table_time = table_time, maxrelerr = maxrelerr)
+
+    return results
 
 ###############################
 
 
+class TestDeltaConversion(unittest.TestCase):
+
+    def brenthX(self, c200, delta):
+
+        delta_c = deltaC(c200)
+        def f(x):
+            return 3*delta_c*(np.log(1+x) - (x/(1+x)))/x**3 - delta
+        return scipy.optimize.brenth(f, 0.1, 20, xtol = 1e-14, rtol = 1e-14)
+
+    def testMatchesBrenth(self):
+
+        c200s = np.random.RandomState(1234).uniform(1., 15., size = 200)
+
+        for delta in [500., 2500., 100.]:
+            expected = np.array([self.brenthX(c200, delta) for c200 in c200s])
+            self.assertTrue(np.allclose(delta_conversion(c200s, delta), expected, rtol = 1e-9, atol = 0))
+
+    def testInvert(self):
+
+        y = np.logspace(-1.5, 1.5, 50)
+        targets = _nfw_g(y)
+
+        self.assertTrue(np.allclose(delta_conversion.invert(targets), y, rtol = 1e-9, atol = 0))
+        self.assertTrue(np.isnan(delta_conversion.invert(_nfw_g(1e3))))
+        self.assertEqual(np.shape(delta_conversion.invert(targets[0])), ())
+
+        #without Newton steps, every target is bracketed
+        bracketed = DeltaConversionTable(npoints = 50, maxiter = 0)
+        self.assertTrue(np.allclose(bracketed.invert(targets), y, rtol = 1e-9, atol = 0))
+
+######
 
+def runtests():
 
+    unittest.main()
 
+if __name__ == '__main__':
 
+    runtests()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+######################
+# Runs many multiconfig_nfwfit job files on a pool of worker processes.
+# Workers are started once, so imports, compiled modules and cosmology
+# tables stay warm between jobs.
+######################
+
+import sys, os, glob, time, signal, argparse, traceback, math
+import multiprocessing
+
+import multiconfig_nfwfit
+
+######################
+
+class JobTimeoutException(Exception): pass
+
+def _alarmHandler(signum, frame):
+    raise JobTimeoutException
+
+def initWorker():
+
+    #load the heavy modules before the first job arrives
+    import nfwfit, pymc, scipy.optimize
+
+    signal.signal(signal.SIGALRM, _alarmHandler)
+
+######################
+
+def runJob(args):
+    '''Run one job file, with stdout/stderr going to {jobbase}.stdout/.stderr.
+    Returns (jobfile, status, elapsed seconds, failures), with status one of
+    'ok', 'failed', 'timeout' or 'error'.'''
+
+    jobfile, timeout = args
+
+    jobbase, jobext = os.path.splitext(jobfile)
+
+    oldstdout, oldstderr = sys.stdout, sys.stderr
+    stdout = open('{}.stdout'.format(jobbase), 'w')
+    stderr = open('{}.stderr'.format(jobbase), 'w')
+    sys.stdout, sys.stderr = stdout, stderr
+
+    start = time.time()
+    status = 'ok'
+    failures = []
+
+    try:
+
+        if timeout is not None:
+            signal.alarm(max(1, int(math.ceil(timeout))))
+
+        jobparams = multiconfig_nfwfit.loadJobfile(jobfile)
+        failures = multiconfig_nfwfit.runMultiConfigs(jobparams,
+                                                      sharestages = jobparams.get('sharestages', True),
+                                                      capturefailures = True,
+                                                      fatalexceptions = (JobTimeoutException,))
+
+        if len(failures) > 0:
+            status = 'failed'
+
+    except JobTimeoutException:
+        status = 'timeout'
+        traceback.print_exc()
+
+    except Exception:
+        status = 'error'
+        traceback.print_exc()
+
+    finally:
+        signal.alarm(0)
+        sys.stdout, sys.stderr = oldstdout, oldstderr
+        stdout.close()
+        stderr.close()
+
+    failures = [(outputname, repr(e)) for outputname, e in failures]
+
+    return jobfile, status, time.time() - start, failures
+
+######################
+
+def findJobfiles(paths, joblists = ()):
+    '''Job files from a mix of job files and directories of *.job files,
+    plus text files listing one job file per line.'''
+
+    jobfiles = []
+
+    for joblist in joblists:
+        with open(joblist) as input:
+            jobfiles.extend([line.strip() for line in input if line.strip() != ''])
+
+    for path in paths:
+        if os.path.isdir(path):
+            jobfiles.extend(sorted(glob.glob('{}/*.job'.format(path))))
+        else:
+            jobfiles.append(path)
+
+    return jobfiles
+
+######################
+
+def runJobs(jobfiles, nworkers = None, timeout = None):
+    '''Returns a list of runJob results, in order of completion.'''
+
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+
+    pool = multiprocessing.Pool(nworkers, initializer = initWorker)
+
+    results = []
+    try:
+        for result in pool.imap_unordered(runJob, [(jobfile, timeout) for jobfile in jobfiles]):
+            jobfile, status, elapsed, failures = result
+            print '%s %s %.1fs' % (jobfile, status, elapsed)
+            for outputname, e in failures:
+                print '    %s: %s' % (outputname, e)
+            sys.stdout.flush()
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+######################
+
+def main(argv = sys.argv[1:]):
+
+    parser = argparse.ArgumentParser(description = 'Run multiconfig_nfwfit job files on a process pool')
+    parser.add_argument('jobs', nargs = '*', help = 'job files, or directories of *.job files')
+    parser.add_argument('-l', '--joblist', action = 'append', default = [],
+                        help = 'file listing job files, one per line')
+    parser.add_argument('-n', '--nworkers', type = int, default = None)
+    parser.add_argument('-t', '--timeout', type = float, default = None,
+                        help = 'per job timeout, in seconds')
+
+    args = parser.parse_args(argv)
+
+    jobfiles = findJobfiles(args.jobs, args.joblist)
+
+    results = runJobs(jobfiles, args.nworkers, args.timeout)
+
+    nbad = len([result for result in results if result[1] != 'ok'])
+    print '%d of %d jobs completed cleanly' % (len(results) - nbad, len(results))
+
+    return nbad
+
+######################
+
+if __name__ == '__main__':
+
+    sys.exit(main() != 0)
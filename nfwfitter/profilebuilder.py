@@ -4,15 +4,12 @@
 import numpy as np
 
 import nfwutils
+import profiletools
+import shearnoiser
+import geometrycache
 
 #########################
 
-def verifyShear(cat, col = 'gamma1_inf', thresh = 5.):
-
-    assert(np.max(np.abs(cat.table[col])) < thresh)
-
-#####
-
 
 class ProfileBuilder(object):
 
@@ -26,88 +23,153 @@ class ProfileBuilder(object):
         self.binner = config['binner']
         self.binnoiser = config['binnoiser']
 
+        #radii and shears of individual galaxies as float32
+        self.singleprecision = 'profileprecision' in config and config['profileprecision'] == 'single'
 
-    def __call__(self, sim):
+        #geometry about a fixed center is shared by every sim on the same grid
+        self.cachegeometry = getattr(self.centergenerator, 'fixedcenter', False) and \
+            ('cachegeometry' not in config or config['cachegeometry'])
 
-        rescaledsim = self.rescalecluster(sim)
 
-        galaxies = self.galaxypicker(rescaledsim)
+    def stages(self):
+        '''The profile building pipeline as an ordered list of (name, configured objects, step).
+        Each step maps a catalog to a new catalog. The configured objects determine
+        the step's output, and are used to recognize identical steps across configs.
+        Without shape noise, reduced shear and geometry run as one fused step.
+        With a fixed center, the grid geometry is looked up right after rescaling.'''
 
+        if isinstance(self.shearnoiser, shearnoiser.NoNoise):
+            shearstages = [('shearprofile', (self.shearnoiser, self.centergenerator, self.singleprecision),
+                            self.shearprofile)]
+        else:
+            shearstages = [('reducedshear', (), reducedShear),
+                           ('shearnoiser', (self.shearnoiser,), self.shearnoiser),
+                           ('geometry', (self.centergenerator, self.singleprecision), self.geometry)]
 
-        galaxies3d = self.betacalcer(galaxies)
+        gridstages = []
+        if self.cachegeometry:
+            gridstages = [('gridgeometry', (self.centergenerator, self.singleprecision), self.gridgeometry)]
 
+        return [('rescalecluster', (self.rescalecluster,), self.rescalecluster)] + \
+                gridstages + \
+                [('galaxypicker', (self.galaxypicker,), self.galaxypicker),
+                ('betacalcer', (self.betacalcer,), self.betacalcer)] + \
+                shearstages + \
+                [('binner', (self.binner,), self.binprofile),
+                 ('binnoiser', (self.binnoiser,), self.binnoiser)]
 
 
-        
-        betas = galaxies3d.beta_s
-        kappa = betas*galaxies3d.kappa_inf
-        galaxies3d.g1 = betas*galaxies3d.gamma1_inf/(1 - kappa)
-        galaxies3d.g2 = betas*galaxies3d.gamma2_inf/(1 - kappa)
-        g = np.sqrt(galaxies3d.g1**2 + galaxies3d.g2**2)
-        no_arcs = np.abs(g) < 5
-        galaxies_noarcs = galaxies3d.filter(no_arcs)
+    def __call__(self, sim):
 
-        verifyShear(galaxies_noarcs, 'g1')
-        verifyShear(galaxies_noarcs, 'g2')
+        cat = sim
+        for name, configured, step in self.stages():
+            cat = step(cat)
 
-        
-        noisygalaxies = self.shearnoiser(galaxies_noarcs)
+        return cat
 
+    ####
 
-        centeroffsetx, centeroffsety = self.centergenerator(noisygalaxies)
-        print 'Center Offset:', centeroffsetx, centeroffsety
-
-        delta_x = noisygalaxies.x_arcmin - centeroffsetx
-        delta_y = noisygalaxies.y_arcmin - centeroffsety
-        r_arcmin = np.sqrt(delta_x**2 + delta_y**2)
+    def gridgeometry(self, sim):
+        '''Cached radii & rotation angles about the (fixed) center, for sims on a grid'''
 
+        centeroffsetx, centeroffsety = self.centergenerator(sim)
+        print 'Center Offset:', centeroffsetx, centeroffsety
+        dtype = np.float32 if self.singleprecision else np.float64
 
-        dL = nfwutils.global_cosmology.angulardist(noisygalaxies.zlens)    
+        return geometrycache.global_geometrycache.attach(sim, centeroffsetx, centeroffsety, dtype)
 
-        deltax_mpc = (delta_x * dL * np.pi)/(180.*60)
-        deltay_mpc = (delta_y * dL * np.pi)/(180.*60)
-        r_mpc = np.sqrt(deltax_mpc**2 + deltay_mpc**2)
+    ####
 
-        # Convert gamma1 and gamma2 to tangential and cross shear terms
-        cosphi = deltax_mpc / r_mpc
-        sinphi = deltay_mpc / r_mpc
-        sin2phi = 2.0*sinphi*cosphi
-        cos2phi = 2.0*cosphi*cosphi-1.0
+    def geometry(self, noisygalaxies):
+        '''Radii from the (offset) center & tangential/cross shear'''
 
-        e1 = noisygalaxies.g1
-        e2 = noisygalaxies.g2
+        if hasattr(noisygalaxies, 'geometryid'):
+            #radii were attached by gridgeometry; only the shear needs rotating
+            ghat, gcross = profiletools.rotateshear(noisygalaxies.g1, noisygalaxies.g2,
+                                                    noisygalaxies.cos2phi, noisygalaxies.sin2phi,
+                                                    single = self.singleprecision)
+            noisygalaxies.ghat = ghat
+            noisygalaxies.gcross = gcross
+            return noisygalaxies
 
-        E = -(e1*cos2phi+e2*sin2phi)
+        centeroffsetx, centeroffsety = self.centergenerator(noisygalaxies)
+        print 'Center Offset:', centeroffsetx, centeroffsety
 
-        b1 =  e2
-        b2 = -e1
-        B = -(b1*cos2phi+b2*sin2phi)
+        dL = nfwutils.global_cosmology.angulardist(noisygalaxies.zlens)    
 
+        r_arcmin, r_mpc, ghat, gcross = profiletools.tangentialshear(noisygalaxies.x_arcmin,
+                                                                     noisygalaxies.y_arcmin,
+                                                                     noisygalaxies.g1,
+                                                                     noisygalaxies.g2,
+                                                                     centeroffsetx, centeroffsety, dL,
+                                                                     single = self.singleprecision)
         
         noisygalaxies.r_arcmin = r_arcmin
         noisygalaxies.r_mpc = r_mpc
-        noisygalaxies.ghat = E
-        noisygalaxies.gcross = B
+        noisygalaxies.ghat = ghat
+        noisygalaxies.gcross = gcross
 
-        
-        
-        profile = self.binner(noisygalaxies)
+        return noisygalaxies
+
+    ####
+
+    def shearprofile(self, galaxies3d):
+        '''reducedShear, then geometry, in one pass over the galaxies'''
+
+        if hasattr(galaxies3d, 'geometryid'):
+            return self.geometry(reducedShear(galaxies3d))
+
+        centeroffsetx, centeroffsety = self.centergenerator(galaxies3d)
+        print 'Center Offset:', centeroffsetx, centeroffsety
 
+        dL = nfwutils.global_cosmology.angulardist(galaxies3d.zlens)    
 
+        keep, g1, g2, r_arcmin, r_mpc, ghat, gcross = profiletools.shearprofile(galaxies3d.x_arcmin,
+                                                                                 galaxies3d.y_arcmin,
+                                                                                 galaxies3d.gamma1_inf,
+                                                                                 galaxies3d.gamma2_inf,
+                                                                                 galaxies3d.kappa_inf,
+                                                                                 galaxies3d.beta_s,
+                                                                                 centeroffsetx, centeroffsety, dL,
+                                                                                 single = self.singleprecision)
 
+        galaxies = galaxies3d.filter(keep)
+        galaxies.g1 = g1
+        galaxies.g2 = g2
+        galaxies.r_arcmin = r_arcmin
+        galaxies.r_mpc = r_mpc
+        galaxies.ghat = ghat
+        galaxies.gcross = gcross
+
+        return galaxies
+
+    ####
+
+    def binprofile(self, noisygalaxies):
+
+        profile = self.binner(noisygalaxies)
 
         clean = profile.sigma_ghat > 0
         cleanprofile = profile.filter(clean)
         cleanprofile.zcluster = noisygalaxies.zcluster
         cleanprofile.zlens = noisygalaxies.zlens
 
-        noisyprofile = self.binnoiser(cleanprofile)
+        return cleanprofile
 
+        
 
+#########
 
-        return noisyprofile
-        
+def reducedShear(galaxies3d):
+    '''Reduced shear for each galaxy, removing strong lensing arcs'''
 
-    
+    keep, g1, g2 = profiletools.reducedshear(galaxies3d.gamma1_inf,
+                                             galaxies3d.gamma2_inf,
+                                             galaxies3d.kappa_inf,
+                                             galaxies3d.beta_s)
 
+    galaxies_noarcs = galaxies3d.filter(keep)
+    galaxies_noarcs.g1 = g1
+    galaxies_noarcs.g2 = g2
 
+    return galaxies_noarcs
@@ -0,0 +1,256 @@
+##########################
+# Compiled stages for profilebuilder: reduced shear with the strong
+# lensing arc cut, and radii & tangential/cross shear about a center.
+# Each makes one pass over the galaxies and writes only its outputs.
+##########################
+
+# cython: profile=False
+
+import numpy as np
+cimport numpy as np
+cimport cython
+
+cdef extern from "math.h" nogil:
+    double sqrt(double)
+    double M_PI
+
+ctypedef fused real_out:
+    float
+    double
+
+#########################
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline bint _reduce(double gamma1_inf, double gamma2_inf, double kappa_inf, double beta_s,
+                         double thresh2, double *g1, double *g2) nogil:
+
+    # reduced shear for one galaxy; false for strong lensing arcs (and nans)
+
+    cdef double kappa = beta_s*kappa_inf
+
+    g1[0] = beta_s*gamma1_inf/(1 - kappa)
+    g2[0] = beta_s*gamma2_inf/(1 - kappa)
+
+    return g1[0]*g1[0] + g2[0]*g2[0] < thresh2
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline void _tangential(double delta_x, double delta_y, double arcmin2mpc,
+                             double g1, double g2, Py_ssize_t j,
+                             real_out[::1] r_arcmin, real_out[::1] r_mpc,
+                             real_out[::1] ghat, real_out[::1] gcross) nogil:
+
+    cdef double r2 = delta_x*delta_x + delta_y*delta_y
+    cdef double cos2phi = (delta_x*delta_x - delta_y*delta_y)/r2
+    cdef double sin2phi = 2*delta_x*delta_y/r2
+    cdef double r = sqrt(r2)
+
+    r_arcmin[j] = r
+    r_mpc[j] = r*arcmin2mpc
+    ghat[j] = -(g1*cos2phi + g2*sin2phi)
+    gcross[j] = -(g2*cos2phi - g1*sin2phi)
+
+#########################
+
+cdef inline np.ndarray _asdouble(x):
+
+    return np.ascontiguousarray(x, dtype=np.float64)
+
+def _outputs(Py_ssize_t ngals, single):
+
+    dtype = np.float32 if single else np.float64
+    return [np.empty(ngals, dtype=dtype) for i in range(4)]
+
+#########################
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def reducedshear(gamma1_inf, gamma2_inf, kappa_inf, beta_s, double arcthresh = 5.):
+    '''Reduced shear g = beta_s gamma_inf / (1 - beta_s kappa_inf), dropping
+    galaxies with |g| >= arcthresh. Returns (keep, g1, g2): the indices of
+    the kept galaxies, and their g1, g2.'''
+
+    cdef const double[::1] gamma1_v = _asdouble(gamma1_inf)
+    cdef const double[::1] gamma2_v = _asdouble(gamma2_inf)
+    cdef const double[::1] kappa_v = _asdouble(kappa_inf)
+    cdef const double[::1] beta_v = _asdouble(beta_s)
+
+    cdef Py_ssize_t ngals = gamma1_v.shape[0]
+    assert(gamma2_v.shape[0] == ngals and kappa_v.shape[0] == ngals and beta_v.shape[0] == ngals)
+
+    cdef np.ndarray[np.int64_t, ndim=1, mode='c'] keep = np.empty(ngals, dtype=np.int64)
+    cdef np.ndarray[np.double_t, ndim=1, mode='c'] g1 = np.empty(ngals, dtype=np.float64)
+    cdef np.ndarray[np.double_t, ndim=1, mode='c'] g2 = np.empty(ngals, dtype=np.float64)
+
+    cdef double thresh2 = arcthresh*arcthresh
+    cdef double rg1, rg2
+    cdef Py_ssize_t i, nkept = 0
+
+    with nogil:
+        for i in range(ngals):
+            if _reduce(gamma1_v[i], gamma2_v[i], kappa_v[i], beta_v[i], thresh2, &rg1, &rg2):
+                keep[nkept] = i
+                g1[nkept] = rg1
+                g2[nkept] = rg2
+                nkept += 1
+
+    return keep[:nkept], g1[:nkept], g2[:nkept]
+
+###
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tangentialshear(x_arcmin, y_arcmin, g1, g2,
+                    double centerx, double centery, double dL, single = False):
+    '''Radii about (centerx, centery) in arcmin and Mpc (dL is the angular
+    diameter distance), with tangential (ghat) and cross (gcross) shear.
+    Returns (r_arcmin, r_mpc, ghat, gcross), float32 if single.'''
+
+    cdef const double[::1] x_v = _asdouble(x_arcmin)
+    cdef const double[::1] y_v = _asdouble(y_arcmin)
+    cdef const double[::1] g1_v = _asdouble(g1)
+    cdef const double[::1] g2_v = _asdouble(g2)
+
+    cdef Py_ssize_t ngals = x_v.shape[0]
+    assert(y_v.shape[0] == ngals and g1_v.shape[0] == ngals and g2_v.shape[0] == ngals)
+
+    r_arcmin, r_mpc, ghat, gcross = _outputs(ngals, single)
+
+    if single:
+        _tangentialshear[float](x_v, y_v, g1_v, g2_v, centerx, centery, dL,
+                                r_arcmin, r_mpc, ghat, gcross)
+    else:
+        _tangentialshear[double](x_v, y_v, g1_v, g2_v, centerx, centery, dL,
+                                 r_arcmin, r_mpc, ghat, gcross)
+
+    return r_arcmin, r_mpc, ghat, gcross
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _tangentialshear(const double[::1] x_v, const double[::1] y_v,
+                           const double[::1] g1_v, const double[::1] g2_v,
+                           double centerx, double centery, double dL,
+                           real_out[::1] r_arcmin, real_out[::1] r_mpc,
+                           real_out[::1] ghat, real_out[::1] gcross):
+
+    cdef double arcmin2mpc = dL*M_PI/(180.*60)
+    cdef Py_ssize_t i
+
+    with nogil:
+        for i in range(x_v.shape[0]):
+            _tangential(x_v[i] - centerx, y_v[i] - centery, arcmin2mpc,
+                        g1_v[i], g2_v[i], i,
+                        r_arcmin, r_mpc, ghat, gcross)
+
+###
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def shearprofile(x_arcmin, y_arcmin, gamma1_inf, gamma2_inf, kappa_inf, beta_s,
+                 double centerx, double centery, double dL,
+                 double arcthresh = 5., single = False):
+    '''reducedshear and tangentialshear in a single pass, for pipelines
+    without shape noise in between.
+    Returns (keep, g1, g2, r_arcmin, r_mpc, ghat, gcross) for the kept galaxies.'''
+
+    cdef const double[::1] x_v = _asdouble(x_arcmin)
+    cdef const double[::1] y_v = _asdouble(y_arcmin)
+    cdef const double[::1] gamma1_v = _asdouble(gamma1_inf)
+    cdef const double[::1] gamma2_v = _asdouble(gamma2_inf)
+    cdef const double[::1] kappa_v = _asdouble(kappa_inf)
+    cdef const double[::1] beta_v = _asdouble(beta_s)
+
+    cdef Py_ssize_t ngals = x_v.shape[0]
+    assert(y_v.shape[0] == ngals and gamma1_v.shape[0] == ngals and gamma2_v.shape[0] == ngals)
+    assert(kappa_v.shape[0] == ngals and beta_v.shape[0] == ngals)
+
+    cdef np.ndarray[np.int64_t, ndim=1, mode='c'] keep = np.empty(ngals, dtype=np.int64)
+    cdef np.ndarray[np.double_t, ndim=1, mode='c'] g1 = np.empty(ngals, dtype=np.float64)
+    cdef np.ndarray[np.double_t, ndim=1, mode='c'] g2 = np.empty(ngals, dtype=np.float64)
+
+    r_arcmin, r_mpc, ghat, gcross = _outputs(ngals, single)
+
+    cdef Py_ssize_t nkept
+    if single:
+        nkept = _shearprofile[float](x_v, y_v, gamma1_v, gamma2_v, kappa_v, beta_v,
+                                     centerx, centery, dL, arcthresh, keep, g1, g2,
+                                     r_arcmin, r_mpc, ghat, gcross)
+    else:
+        nkept = _shearprofile[double](x_v, y_v, gamma1_v, gamma2_v, kappa_v, beta_v,
+                                      centerx, centery, dL, arcthresh, keep, g1, g2,
+                                      r_arcmin, r_mpc, ghat, gcross)
+
+    return (keep[:nkept], g1[:nkept], g2[:nkept],
+            r_arcmin[:nkept], r_mpc[:nkept], ghat[:nkept], gcross[:nkept])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _shearprofile(const double[::1] x_v, const double[::1] y_v,
+                              const double[::1] gamma1_v, const double[::1] gamma2_v,
+                              const double[::1] kappa_v, const double[::1] beta_v,
+                              double centerx, double centery, double dL, double arcthresh,
+                              np.int64_t[::1] keep, double[::1] g1, double[::1] g2,
+                              real_out[::1] r_arcmin, real_out[::1] r_mpc,
+                              real_out[::1] ghat, real_out[::1] gcross):
+
+    cdef double arcmin2mpc = dL*M_PI/(180.*60)
+    cdef double thresh2 = arcthresh*arcthresh
+    cdef double rg1, rg2
+    cdef Py_ssize_t i, nkept = 0
+
+    with nogil:
+        for i in range(x_v.shape[0]):
+            if _reduce(gamma1_v[i], gamma2_v[i], kappa_v[i], beta_v[i], thresh2, &rg1, &rg2):
+                keep[nkept] = i
+                g1[nkept] = rg1
+                g2[nkept] = rg2
+                _tangential(x_v[i] - centerx, y_v[i] - centery, arcmin2mpc,
+                            rg1, rg2, nkept,
+                            r_arcmin, r_mpc, ghat, gcross)
+                nkept += 1
+
+    return nkept
+
+###
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rotateshear(g1, g2, cos2phi, sin2phi, single = False):
+    '''Tangential (ghat) and cross (gcross) shear from precomputed
+    cos(2 phi), sin(2 phi) about the center, as in tangentialshear.
+    Returns (ghat, gcross), float32 if single.'''
+
+    cdef const double[::1] g1_v = _asdouble(g1)
+    cdef const double[::1] g2_v = _asdouble(g2)
+    cdef const double[::1] cos_v = _asdouble(cos2phi)
+    cdef const double[::1] sin_v = _asdouble(sin2phi)
+
+    cdef Py_ssize_t ngals = g1_v.shape[0]
+    assert(g2_v.shape[0] == ngals and cos_v.shape[0] == ngals and sin_v.shape[0] == ngals)
+
+    dtype = np.float32 if single else np.float64
+    ghat = np.empty(ngals, dtype=dtype)
+    gcross = np.empty(ngals, dtype=dtype)
+
+    if single:
+        _rotateshear[float](g1_v, g2_v, cos_v, sin_v, ghat, gcross)
+    else:
+        _rotateshear[double](g1_v, g2_v, cos_v, sin_v, ghat, gcross)
+
+    return ghat, gcross
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _rotateshear(const double[::1] g1_v, const double[::1] g2_v,
+                       const double[::1] cos_v, const double[::1] sin_v,
+                       real_out[::1] ghat, real_out[::1] gcross):
+
+    cdef Py_ssize_t i
+
+    with nogil:
+        for i in range(g1_v.shape[0]):
+            ghat[i] = -(g1_v[i]*cos_v[i] + g2_v[i]*sin_v[i])
+            gcross[i] = -(g2_v[i]*cos_v[i] - g1_v[i]*sin_v[i])
@@ -25,8 +25,6 @@ class CompositeParameter(mymc.Parameter):
 
         self.width = width*np.abs(self())
 
-        print self.name, self.width
-
     def get_value(self):
         return self.masterobj.value[self.index]
 
@@ -47,8 +45,6 @@ class WrapperParameter(mymc.Parameter):
 
         self.width = width*np.abs(self())
 
-        print self.name, self.width
-
     def get_value(self):
         return self.masterobj.value
 
@@ -96,7 +92,7 @@ class DerivedFunction(mymc.DerivedParameter):
         
 #################################
 
-def wrapModel(model):
+def wrapModel(model, verbose = False):
 
     parameters = []
     deterministics = []
@@ -140,14 +136,14 @@ def wrapModel(model):
     potentials = sorted(potentials, key = operator.attrgetter('__name__'))
     observed = sorted(observed, key = operator.attrgetter('__name__'))
 
-    print [x.__name__ for x in stochastics]
-    print [x.__name__ for x in potentials]
-    print [x.__name__ for x in observed]
+    if verbose:
+        print [(x.name, x.width) for x in parameters]
+        print [x.__name__ for x in stochastics]
+        print [x.__name__ for x in potentials]
+        print [x.__name__ for x in observed]
     
     all_logp = stochastics + potentials + observed
 
-    print [x.__name__ for x in all_logp]
-
     def posterior(thing):
         try:
             logp = reduce(lambda x,y: x + y.logp, all_logp, 0.)
@@ -175,6 +171,67 @@ def wrapModel(model):
 
 #################################
 
+class NativeParameter(mymc.Parameter):
+    def __init__(self, x, index, name, width = 0.1):
+        self.x = x
+        self.index = index
+        self.name = name
+        self.width = width*np.abs(self())
+
+    def get_value(self):
+        return self.x[self.index]
+
+    def set(self, value):
+        self.x[self.index] = value
+
+    value = property(get_value, set)
+
+#################################
+
+def wrapNative(model, ntries = 20):
+    '''Like wrapModel, for models that evaluate their posterior on a plain
+    float vector. model needs names, limits (for starting points), tracenames,
+    logpost(x), and derived(x) returning a dict of the tracenames plus
+    'posterior'.'''
+
+    x = np.zeros(len(model.names))
+
+    for i in range(ntries):
+        for j, (low, high) in enumerate(model.limits):
+            x[j] = np.random.uniform(low, high)
+        if np.isfinite(model.logpost(x)):
+            break
+    else:
+        raise pymc.ZeroProbability
+
+    parameters = [NativeParameter(x, i, name) for i, name in enumerate(model.names)]
+
+    def posterior(thing):
+        return model.logpost(x)
+
+    cache = {}
+    def derived(name):
+        key = tuple(x)
+        if cache.get('key') != key:
+            cache['key'] = key
+            cache['values'] = model.derived(x)
+        return cache['values'][name]
+
+    deterministics = [DerivedFunction(derived, name, name) for name in model.tracenames + ['posterior']
+                      if name not in model.names]
+
+    parameters = sorted(parameters, key = operator.attrgetter('name'))
+    deterministics = sorted(deterministics, key = operator.attrgetter('name'))
+
+    space = mymc.ParameterSpace(parameters, posterior)
+
+    trace = mymc.ParameterSpace(deterministics + parameters)
+
+    return space, trace
+
+
+#################################
+
 
 class MyMCRunner(object):
 
@@ -203,6 +260,9 @@ class MyMCRunner(object):
         bitsfile = '%s.bits.%d' % (options.outputFile, manager.mpi_rank)
         chainfile = '%s.chain.%d' % (options.outputFile, manager.mpi_rank)
 
+        # 'text' or 'npy' (see mymc.npyBackend)
+        chainformat = options.get('chainformat', 'text')
+
         writeHeader = True
         if options.restore is True:
 
@@ -217,9 +277,10 @@ class MyMCRunner(object):
             if os.path.exists(chainfile):
 
                 writeHeader = False
-                chain = load_chains.loadChains([chainfile])
+                chainformat = load_chains.chainFormat(chainfile)
+                lastrow = load_chains.loadLastRow(chainfile)
                 for param in space:
-                    param.set(chain[param.name][0,-1])
+                    param.set(lastrow[param.name])
 
 
                 
@@ -228,25 +289,32 @@ class MyMCRunner(object):
                     
         
 
-        manager.engine = mymc.Engine([updater], trace)
+        manager.engine = mymc.Engine([updater], trace, stopping = options.get('stopping'))
 
         if os.path.exists(chainfile) and writeHeader is True:
             os.remove(chainfile)
 
-        manager.chainfile = open(chainfile, 'a')
-        manager.textout = mymc.headerTextBackend(manager.chainfile, trace, writeHeader=writeHeader)
+        if chainformat == 'npy':
+            manager.chainout = mymc.npyBackend(chainfile, trace, append = not writeHeader)
+        else:
+            manager.chainfile = open(chainfile, 'a')
+            manager.chainout = manager.textout = mymc.headerTextBackend(manager.chainfile, trace, writeHeader=writeHeader)
 
 
 
 
         
-        backends = [manager.textout]
+        backends = [manager.chainout]
 
         manager.engine(options.nsamples, None, backends)
                                      
         with open(bitsfile, 'wb') as output:
             cPickle.dump(updater.saveBits(), output)
 
+        manager.metrics = manager.engine.monitor.metrics()
+        with open('%s.metrics.%d' % (options.outputFile, manager.mpi_rank), 'wb') as output:
+            cPickle.dump(manager.metrics, output)
+
 
     ############
 
@@ -280,7 +348,10 @@ class MyMCRunner(object):
 
     def finalize(self, manager):
 
-        manager.chainfile.close()
+        if 'chainfile' in manager:
+            manager.chainfile.close()
+        else:
+            manager.chainout.close()
 
 
 ######################################
@@ -300,7 +371,10 @@ class MyMCMemRunner(object):
             manager.mpi_rank = 0
 
 
-        space, trace = wrapModel(manager.model)
+        if manager.get('native', False):
+            space, trace = wrapNative(manager.model)
+        else:
+            space, trace = wrapModel(manager.model)
         
         step = mymc.Slice()
 
@@ -309,15 +383,17 @@ class MyMCMemRunner(object):
         else:
             updater = mymc.MultiDimRotationUpdater(space, step, options.adapt_every, options.adapt_after, parallel = parallel)
 
-        manager.engine = mymc.Engine([updater], trace)
+        manager.engine = mymc.Engine([updater], trace, stopping = options.get('stopping'))
 
-        manager.chain = mymc.dictBackend()
+        manager.chain = mymc.dictBackend(size = options.nsamples)
 
 
         
         backends = [manager.chain]
 
         manager.engine(options.nsamples, None, backends)
+
+        manager.metrics = manager.engine.monitor.metrics()
                                      
                     
 
@@ -2,10 +2,11 @@
 # Reads in BK11 files so that nfwfit.py can use them
 ######################
 
-import astropy.io.fits as pyfits, ldac
+import astropy.io.fits as pyfits
 import nfwutils
 import numpy as np
 import catalog
+import geometrycache
 
 class BK11SimReader(object):
 
@@ -22,78 +23,85 @@ class BK11SimReader(object):
         return BK11Sim(filebase)
 
 
-class BK11Sim(catalog.Catalog):
+#####
 
-    def __init__(self, filename):
+# Becker & Kravtsov maps are Ng x Ng pixels
+Ng = 512
 
-        super(BK11Sim, self).__init__()
+# the most recently computed grid, shared by all halos with the same box geometry & cosmology
+_gridcache = {}
 
+def bk11Grid(da, Dl):
+    '''Flattened x, y pixel centers in arcmin & Mpc, for pixel size da (arcmin).
+    x runs along the first axis of the maps. Read only.'''
 
-        sim = ldac.LDACCat(pyfits.open(filename)[1])
+    key = (da, Dl)
+    if key not in _gridcache:
+        _gridcache.clear()
 
-        boxlength = sim['BOXWIDTHCOMOVINGHINVMPC'] / nfwutils.global_cosmology.h
-        gridsize = np.sqrt(float(sim['A00'].shape[1]))
+        xcen = Ng/2.0
+        offsets = (np.arange(Ng) + 0.5 - xcen)*da
 
-        clusterz = float(sim['ZLENS'])
-        self.zcluster = clusterz
+        x_arcmin = np.repeat(offsets, Ng)
+        y_arcmin = np.tile(offsets, Ng)
+        x_mpc = (x_arcmin/60.)*(np.pi/180.)*Dl
+        y_mpc = (y_arcmin/60.)*(np.pi/180.)*Dl
 
-        ####becker angles
+        for x in [x_arcmin, y_arcmin, x_mpc, y_mpc]:
+            x.setflags(write = False)
 
-        Ng = 512
+        _gridcache[key] = (x_arcmin, y_arcmin, x_mpc, y_mpc)
 
-        dc_readout = nfwutils.global_cosmology.comovingdist(clusterz)+sim['BOXLENGTHCOMOVINGHINVMPC'][0]/(2.0*nfwutils.global_cosmology.h)
-        da = np.arctan2(sim['BOXWIDTHCOMOVINGHINVMPC'][0]/nfwutils.global_cosmology.h,dc_readout)/np.pi*180.0*60.0/Ng
+    return _gridcache[key]
 
-        xcen = Ng/2.0
-        ycen = Ng/2.0
+#####
 
-        radii_arcmin = np.zeros((Ng, Ng))
-        cosphi = np.zeros((Ng,Ng))
-        sinphi = np.zeros((Ng,Ng))
-        x_arcmin = np.zeros((Ng,Ng))
-        y_arcmin = np.zeros((Ng,Ng))
+class BK11Sim(catalog.Catalog):
 
-        for i in range(Ng):
-            for j in range(Ng):
-                xr = (i + 0.5 - xcen)*da
-                yr = (j + 0.5 - ycen)*da
-                r = np.sqrt(xr*xr + yr*yr)
-                radii_arcmin[i,j] = r
-                x_arcmin[i,j] = xr
-                y_arcmin[i,j] = yr
+    def __init__(self, filename):
 
-                cosphi[i,j] = xr/r
-                sinphi[i,j] = yr/r
+        super(BK11Sim, self).__init__()
 
+        #only the columns used are read from the memory mapped table
+        with pyfits.open(filename, memmap = True) as hdulist:
 
-        A00 = sim['A00'][0]
-        A11 = sim['A11'][0]
-        A10 = sim['A10'][0]
-        A01 = sim['A01'][0]
+            sim = hdulist[1].data
 
-        kappa = 0.5*(2- A00 - A11)
-        gamma1 = 0.5*(A11 - A00)
-        gamma2 = -0.5*(A01+A10)
+            clusterz = float(sim.field('ZLENS')[0])
+            zsource = float(sim.field('ZSOURCE')[0])
+            boxwidth = sim.field('BOXWIDTHCOMOVINGHINVMPC')[0]
+            boxlength = sim.field('BOXLENGTHCOMOVINGHINVMPC')[0]
 
+            A00 = sim.field('A00')[0]
+            A11 = sim.field('A11')[0]
+            A10 = sim.field('A10')[0]
+            A01 = sim.field('A01')[0]
 
-        self.x_arcmin = x_arcmin.flatten()
-        self.y_arcmin = y_arcmin.flatten()
+            kappa = 0.5*(2- A00 - A11)
+            gamma1 = 0.5*(A11 - A00)
+            gamma2 = -0.5*(A01+A10)
 
-        Dl = nfwutils.global_cosmology.angulardist(clusterz)
-        self.x_mpc = (self.x_arcmin/60.)*(np.pi/180.)*Dl
-        self.y_mpc = (self.y_arcmin/60.)*(np.pi/180.)*Dl
+            self.m500 = sim.field('M500C')[0]
+            self.m200 = sim.field('M200C')[0]
+            self.c200 = sim.field('C200C')[0]
 
+        self.zcluster = clusterz
 
-        redshifts = np.ones(len(self.x_arcmin))*float(sim['ZSOURCE'])
-        beta_s = nfwutils.global_cosmology.beta_s(redshifts, clusterz)
+        ####becker angles
+
+        dc_readout = nfwutils.global_cosmology.comovingdist(clusterz)+boxlength/(2.0*nfwutils.global_cosmology.h)
+        da = np.arctan2(boxwidth/nfwutils.global_cosmology.h,dc_readout)/np.pi*180.0*60.0/Ng
 
-        self.gamma1_inf = gamma1.flatten()/beta_s
-        self.gamma2_inf = gamma2.flatten()/beta_s
-        self.kappa_inf  = kappa.flatten()/beta_s
+        Dl = nfwutils.global_cosmology.angulardist(clusterz)
 
+        self.x_arcmin, self.y_arcmin, self.x_mpc, self.y_mpc = bk11Grid(da, Dl)
 
-        self.m500 = sim['M500C'][0]
-        self.m200 = sim['M200C'][0]
-        self.c200 = sim['C200C'][0]
+        #identifies the pixel grid, for sharing its geometry between sims
+        self.gridid = geometrycache.contentId('bk11', Ng, float(da))
 
+        #same source redshift for every pixel
+        beta_s = nfwutils.global_cosmology.beta_s([zsource], clusterz)[0]
 
+        self.gamma1_inf = gamma1.astype(np.float64)/beta_s
+        self.gamma2_inf = gamma2.astype(np.float64)/beta_s
+        self.kappa_inf  = kappa.astype(np.float64)/beta_s
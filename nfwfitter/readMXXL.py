@@ -8,6 +8,7 @@ import binaryutils
 
 import nfwutils
 import catalog
+import geometrycache
 
 
 #######################
@@ -26,7 +27,6 @@ class MXXLBinary(object):
 
         #The files are binary (little endian). As pseudo-C struct, the file looks like:
         with open(self.filename, 'rb') as input:
-            input = open(self.filename, 'rb')
 
             #double lower_bound[2];                          // lower bound of area represented by plane (in this case in comoving Mpc/h)
             #NOTE: For "mass_map", units of Mpc/h
@@ -52,11 +52,40 @@ class MXXLBinary(object):
             #int    N_pixels[2];                             // number of pixels in each dimension (should both be 1024 in this case)
             self.npixels = binaryutils.readArray(input, 'i', (2,))
 
-            #float  mass_density[N_pixels[0] * N_pixels[1]]; // surface mass density (in simulation units, i.e. 10^10 M_solar/h per comoving (Mpc/h)^2)
-            self.data = binaryutils.readArray(input, 'f', self.npixels)
+            self.dataoffset = input.tell()
+
+        #float  mass_density[N_pixels[0] * N_pixels[1]]; // surface mass density (in simulation units, i.e. 10^10 M_solar/h per comoving (Mpc/h)^2)
+        #memory mapped, float32; nothing is read until the data is touched
+        self.data = binaryutils.memmapArray(self.filename, 'f', self.npixels, self.dataoffset)
+
+    ####
+
+    def gridkey(self):
+
+        return (tuple(self.lower_bound), tuple(self.upper_bound), tuple(self.npixels), self.redshift)
+
+    def sameGrid(self, other):
+
+        return self.gridkey() == other.gridkey()
+
+    ####
+
+    # the most recently computed grid, shared by all maps with the same geometry & cosmology
+    _gridcache = {}
 
     def grid(self):
 
+        dL = nfwutils.global_cosmology.angulardist(self.redshift)
+
+        key = (self.gridkey(), dL)
+        if key not in MXXLBinary._gridcache:
+            MXXLBinary._gridcache.clear()
+            MXXLBinary._gridcache[key] = self._computeGrid(dL)
+
+        return MXXLBinary._gridcache[key]
+
+    def _computeGrid(self, dL):
+
         gridDelta = (self.upper_bound - self.lower_bound)/(self.npixels)  # grid delta in arcsec
 
         X2,X1 = np.meshgrid(np.arange(self.npixels[1]), np.arange(self.npixels[0]))
@@ -64,10 +93,13 @@ class MXXLBinary(object):
         deltaX1_arcmin = (self.lower_bound[0] + (X1 + 0.5)*gridDelta[0])/60.
         deltaX2_arcmin = (self.lower_bound[1] + (X2 + 0.5)*gridDelta[1])/60.
 
-        dL = nfwutils.global_cosmology.angulardist(self.redshift)
-
         deltaX1_mpc = (deltaX1_arcmin * dL * np.pi)/(180.*60)
         deltaX2_mpc = (deltaX2_arcmin * dL * np.pi)/(180.*60)
+
+        #shared between sims, so protect against in-place modification
+        for x in [deltaX1_mpc, deltaX2_mpc, deltaX1_arcmin, deltaX2_arcmin]:
+            x.setflags(write = False)
+
         return (deltaX1_mpc, deltaX2_mpc), (deltaX1_arcmin, deltaX2_arcmin)
         
         
@@ -129,12 +161,17 @@ class MXXLSim(catalog.Catalog):
         gamma2 = MXXLBinary(gamma2file)
 
 
+        assert(kappa.sameGrid(gamma1) and kappa.sameGrid(gamma2))
+
         self.zcluster = kappa.redshift
 
+        #identifies the pixel grid, for sharing its geometry between sims
+        self.gridid = geometrycache.contentId('mxxl', *kappa.gridkey())
+
 
         delta_mpc, delta_arcmin = kappa.grid()
-        delta_mpc = [x.flatten() for x in delta_mpc]
-        delta_arcmin = [x.flatten() for x in delta_arcmin]
+        delta_mpc = [x.ravel() for x in delta_mpc]
+        delta_arcmin = [x.ravel() for x in delta_arcmin]
 
 
         self.x_mpc = delta_mpc[0]
@@ -144,12 +181,12 @@ class MXXLSim(catalog.Catalog):
 
 
 
-        beta_inf = nfwutils.global_cosmology.beta([1e6], self.zcluster)
+        beta_inf = np.float32(nfwutils.global_cosmology.beta([1e6], self.zcluster)[0])
 
-        # Three components that I can plot
-        self.gamma1_inf = beta_inf*gamma1.data.flatten() # Shear wrt x axis
-        self.gamma2_inf = beta_inf*gamma2.data.flatten() # Shear wrt 45 deg
-        self.kappa_inf = beta_inf*kappa.data.flatten()
+        # Three components that I can plot; kept in float32, one copy each
+        self.gamma1_inf = beta_inf*gamma1.data.ravel() # Shear wrt x axis
+        self.gamma2_inf = beta_inf*gamma2.data.ravel() # Shear wrt 45 deg
+        self.kappa_inf = beta_inf*kappa.data.ravel()
 
     def reshape_components(self) :
         import numpy as np
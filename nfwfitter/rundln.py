@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 ###########################
-# Run dln fit for one mass bin of one noise sim
+# Run dln fit for one mass bin of one noise sim, or all bins
+# of one noise sim on a process pool
 ###########################
 
-import sys, re
+import sys, re, traceback
+import multiprocessing
 import random
 import deconvolvedlognorm as dln
 import nfwfit
@@ -230,59 +232,56 @@ def defineMassEdges(simtype, delta):
 
     
 
-def run(simtype, chaindir, outfile, delta, modelname, massbin=0, sigmapriorfile = None):
-    '''
-    simtype: something like mxxl41, 
-    chaindir: output from nfwfit
-    outfile: output of the map step, 
-    delta: overdensity (e.g. 200)
-    modelname: function name of model, e.g. buildMCMCModel
-    massbin: the index of the massbin that we are running (bins are defined above), depends on mass range, simtype, and overdensity 
-
-    Note - pdftype: either 'pdf' or 'mcmc' --> format of output of map step determined in config file
+def loadConfig(chaindir):
+    '''Read the chain directory's config and set the global cosmology from it.'''
 
-    '''
     config = simutils.readConfiguration('%s/config.py' % chaindir)
     simreader = config['simreader']
     nfwutils.global_cosmology.set_cosmology(simreader.getCosmology())
+
+    return config
+
+###
+
+def updateHaloStore(simtype, chaindir, delta, config):
+    '''Bring the posterior store of chaindir up to date.
+    Returns the store directory and the keywords for queryPosteriorStore.
+    Note - pdftype: either 'pdf' or 'mcmc' --> format of output of map step determined in config file
+    '''
+
+    simreader = config['simreader']
     model = config['model']
 
     pdftype = config['fitter'].output_type
-    
-    if massbin == -1:
-        selector = takeAllMasses(simtype, delta)[0]
-    else:
-        selectors = defineMassEdges(simtype, delta)
-        selector = selectors[massbin]
 
-    isPDF = False
+    nfwutils.global_cosmology.set_cosmology(simreader.getCosmology())
 
     if pdftype == 'pdf':
-        isPDF = True
-        halos = dln.loadPosteriors(chaindir, simtype, simreader, delta, selector,
-                                   reader = dln.PDFReader, model = model)
+        storedir = dln.updatePosteriorStore(chaindir, simtype, delta, dln.PDFReader, model = model)
+        querykwds = {}
     elif pdftype == 'mcmc':
-        halos = dln.loadPosteriors(chaindir, simtype, simreader, delta, selector,
-                                   reader = dln.MCMCReader,
-                                   cprior = 100.)
-        
-        
+        storedir = dln.updatePosteriorStore(chaindir, simtype, delta, dln.MCMCReader)
+        querykwds = dict(cprior = 100.)
 
-    if len(halos) < 10:
-        sys.exit(0)
+    return storedir, querykwds
+
+def loadHalos(simtype, chaindir, delta, selector, config):
+
+    storedir, querykwds = updateHaloStore(simtype, chaindir, delta, config)
+
+    return dln.queryPosteriorStore(storedir, selector, **querykwds)
+
+###
+
+def fitBin(halos, massrange, outfile, modelname, sigmapriors = None, tempoutputdir = './debug/'):
+    '''Sample the dln model for the halos of one mass bin.
+    massrange: (masslow, masshigh) of the bin, written to outfile.massrange'''
 
     if len(halos) > 1000:
         # Should be sufficient - some mass bins have ~7000.
         print 'Down sampling'
         halos = random.sample(halos, 1000)
 
-    sigmapriors = None
-    if sigmapriorfile is not None:
-        print 'Using Sigma Priors!'
-        sigmapriors = cPickle.load(open(sigmaprior, 'rb'))[massbin]
-
-
-
     success = False
     for i in range(20):
         # Occasionally, the pymc initialization is so far off that the
@@ -311,13 +310,122 @@ def run(simtype, chaindir, outfile, delta, modelname, massbin=0, sigmapriorfile
         
 
     with open('%s.massrange' % outfile, 'w') as output:
-        output.write('%f\n%f\n' % (selector.masslow, selector.masshigh))
+        output.write('%f\n%f\n' % massrange)
 
         # Note: This output corresponds to one data point/errorbar
         # point on the bias plot.
     # dln.memsample(model, num_samples, out)
     #dln.memsample(model, 10000, outputFile = outfile)
-    dln.sample(model, outfile+'.debug', 1000, tempoutputdir='./debug/', singlecore=True)
+    dln.sample(model, outfile+'.debug', 1000, tempoutputdir=tempoutputdir, singlecore=True)
+
+#########
+
+def run(simtype, chaindir, outfile, delta, modelname, massbin=0, sigmapriorfile = None):
+    '''
+    simtype: something like mxxl41, 
+    chaindir: output from nfwfit
+    outfile: output of the map step, 
+    delta: overdensity (e.g. 200)
+    modelname: function name of model, e.g. buildMCMCModel
+    massbin: the index of the massbin that we are running (bins are defined above), depends on mass range, simtype, and overdensity 
+
+    '''
+    config = loadConfig(chaindir)
+    
+    if massbin == -1:
+        selector = takeAllMasses(simtype, delta)[0]
+    else:
+        selectors = defineMassEdges(simtype, delta)
+        selector = selectors[massbin]
+
+    halos = loadHalos(simtype, chaindir, delta, selector, config)
+
+    if len(halos) < 10:
+        sys.exit(0)
+
+    sigmapriors = None
+    if sigmapriorfile is not None:
+        print 'Using Sigma Priors!'
+        sigmapriors = cPickle.load(open(sigmapriorfile, 'rb'))[massbin]
+
+    fitBin(halos, (selector.masslow, selector.masshigh), outfile, modelname, sigmapriors)
+
+#########
+
+def initWorker():
+
+    # forked workers share the parent's random state; each bin needs its own
+    random.seed()
+    np.random.seed()
+
+def _fitBinJob(args):
+
+    outfile = args[2]
+    try:
+        fitBin(*args)
+        return outfile, True
+    except Exception:
+        traceback.print_exc()
+        return outfile, False
+
+def runAllBins(simtype, chaindir, outbase, delta, modelname, massbins = None,
+               sigmapriorfile = None, nprocs = None):
+    '''Run every mass bin of defineMassEdges (or those listed in massbins)
+    for one chain directory. The config, cosmology and posterior store are
+    loaded once; the bins are then sampled on a pool of nprocs processes.
+    Bin i writes to outbase.i, as a run() with massbin=i would.
+    Returns a list of (outfile, succeeded).'''
+
+    config = loadConfig(chaindir)
+
+    selectors = defineMassEdges(simtype, delta)
+    if massbins is None:
+        massbins = range(len(selectors))
+
+    allsigmapriors = None
+    if sigmapriorfile is not None:
+        print 'Using Sigma Priors!'
+        allsigmapriors = cPickle.load(open(sigmapriorfile, 'rb'))
+
+    storedir, querykwds = updateHaloStore(simtype, chaindir, delta, config)
+
+    jobs = []
+    for massbin in massbins:
+        selector = selectors[massbin]
+        outfile = '%s.%d' % (outbase, massbin)
+
+        halos = dln.queryPosteriorStore(storedir, selector, **querykwds)
+        if len(halos) < 10:
+            print 'Skipping %s: %d halos' % (outfile, len(halos))
+            continue
+
+        sigmapriors = None
+        if allsigmapriors is not None:
+            sigmapriors = allsigmapriors[massbin]
+
+        #each bin gets its own temporary output directory, so concurrent
+        # samplers do not pick up each other's chains
+        jobs.append((halos, (selector.masslow, selector.masshigh), outfile, modelname, sigmapriors, None))
+
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    nprocs = min(nprocs, len(jobs))
+
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs, initializer = initWorker)
+        try:
+            results = pool.map(_fitBinJob, jobs, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_fitBinJob, jobs)
+
+    for outfile, succeeded in results:
+        if not succeeded:
+            print 'Failed: %s' % outfile
+
+    return results
 
 
 
@@ -332,7 +440,7 @@ if __name__ == '__main__':
     delta=int(sys.argv[4])
     modelname=sys.argv[5]
     if len(sys.argv) > 6:
-        massbin=int(sys.argv[6])
+        massbin=sys.argv[6]
     if len(sys.argv) > 7:
         sigmaprior = sys.argv[7]
     print 'Called with:', dict(modelname=modelname, simtype=simtype, chaindir=chaindir, 
@@ -340,6 +448,10 @@ if __name__ == '__main__':
                                massbin=massbin,
                                sigmapriorfile = sigmaprior)
 
+    if massbin == 'all':
+        #outfile is the base name; bin i goes to outfile.i
+        results = runAllBins(simtype, chaindir, outfile, delta, modelname, sigmapriorfile = sigmaprior)
+        sys.exit(not all([succeeded for outfile, succeeded in results]))
     
-    run(simtype, chaindir, outfile, delta, modelname, massbin, sigmaprior)
+    run(simtype, chaindir, outfile, delta, modelname, int(massbin), sigmaprior)
         
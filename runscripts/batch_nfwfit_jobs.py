@@ -64,15 +64,44 @@ queue {nrunners}
 
 #############
 
+def batchNFWFitJobsPooled(jobs, outputdir, nnodes=4, nworkers=32, timeout=None, batch_header = midway_batch_header):
+    '''One script per node, each running its share of the jobs on a pool of 
+    nworkers processes with nfwfitter/parallel_nfwfit.py. timeout is per job, in seconds.'''
+    if not os.path.exists(outputdir):
+        os.mkdir(outputdir)
+
+    timeoutarg = ''
+    if timeout is not None:
+        timeoutarg = ' -t {}'.format(timeout)
+
+    for currunner in range(nnodes):
+        curjobs = jobs[currunner::nnodes]
+
+        joblist = '{}/nfwfitpool_{}.jobs'.format(outputdir, currunner)
+        with open(joblist, 'w') as output:
+            for job in curjobs:
+                output.write('{}\n'.format(job))
+
+        with open('{}/nfwfitpool_{}.sh'.format(outputdir, currunner), 'w') as output:
+            output.write(batch_header.format(jobdir = outputdir, jobname = 'poolnfwfit', runner=currunner, time='48:00:00'))
+            output.write('python nfwfitter/parallel_nfwfit.py -n {nworkers}{timeoutarg} -l {joblist}\n'.format(nworkers = nworkers,
+                                                                                                             timeoutarg = timeoutarg,
+                                                                                                             joblist = joblist))
 
-def buildDLNArgsets(chainbase, configs, simtype, delta, massmodel, outdir):
+
+#############
+
+
+def buildDLNArgsets(chainbase, configs, simtype, delta, massmodel, outdir, allbins = False):
     '''chainbase : where the MCMC chains are stored
     configs : list from text file like run25mxxl54
     simtype : e.g. mxxlsnap54
     delta : 200 or 500 in critical
     massmodel : function name of model, e.g. buildMCMCModel_massconcentration
     outdir : where the output goes  
-    Note - the length of argsets is the number of mass bins * the number of configurations
+    allbins : one job per configuration, running every mass bin on a process pool
+    Note - the length of argsets is the number of mass bins * the number of configurations,
+    or the number of configurations with allbins
     '''
     #number of bins
 
@@ -84,15 +113,20 @@ def buildDLNArgsets(chainbase, configs, simtype, delta, massmodel, outdir):
     argsets = []
     for config in configs:
         chaindir = '{}/{}'.format(chainbase, config)
+        workdir = '{outdir}/{config}'.format(outdir = outdir, config = config)
+        if not os.path.exists(workdir):
+            os.mkdir(workdir)
+        outbase = '{workdir}/rundln{simtype}.{massmodel}.{delta}'.format(workdir = workdir,
+                                                                        simtype = simtype,
+                                                                        massmodel = massmodel,
+                                                                        delta = delta)
+        if allbins:
+            #rundln appends the bin number
+            argsets.append([simtype, chaindir, outbase, delta, massmodel, 'all'])
+            continue
+
         for massbin in range(nbins):
-            workdir = '{outdir}/{config}'.format(outdir = outdir, config = config)
-            if not os.path.exists(workdir):
-                os.mkdir(workdir)
-            outfile = '{workdir}/rundln{simtype}.{massmodel}.{delta}.{massbin}'.format(workdir = workdir,
-                                                                                       simtype = simtype,
-                                                                                       massmodel = massmodel,
-                                                                                       delta = delta,
-                                                                                       massbin = massbin)
+            outfile = '{outbase}.{massbin}'.format(outbase = outbase, massbin = massbin)
             argsets.append([simtype, chaindir, outfile, delta, massmodel, massbin])
 
     return argsets
@@ -1,9 +1,43 @@
 from setuptools import setup, find_packages, Extension
 from Cython.Build import cythonize
 import numpy
+import os, shutil, tempfile
+import distutils.ccompiler, distutils.sysconfig, distutils.errors
+
+def hasOpenMP():
+    '''Whether the C compiler builds and links an OpenMP program with -fopenmp.
+    NFWFITTER_OPENMP=0 or 1 skips the check.'''
+
+    if 'NFWFITTER_OPENMP' in os.environ:
+        return os.environ['NFWFITTER_OPENMP'] not in ['', '0']
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, 'openmp.c')
+        with open(source, 'w') as output:
+            output.write('#include <omp.h>\nint main(void) { return omp_get_max_threads() < 1; }\n')
+
+        compiler = distutils.ccompiler.new_compiler()
+        distutils.sysconfig.customize_compiler(compiler)
+        try:
+            objects = compiler.compile([source], output_dir = tmpdir, extra_postargs = ['-fopenmp'])
+            compiler.link_executable(objects, 'openmp', output_dir = tmpdir, extra_postargs = ['-fopenmp'])
+        except (distutils.errors.CompileError, distutils.errors.LinkError):
+            return False
+        return True
+    finally:
+        shutil.rmtree(tmpdir)
+
+#without OpenMP, the prange loops in nfwmodeltools run serially
+openmpflags = ['-fopenmp'] if hasOpenMP() else []
 
 extensions = [
     Extension("nfwfitter.nfwmodeltools", ["nfwfitter/nfwmodeltools.pyx"],
+              include_dirs = [numpy.get_include()],
+              extra_compile_args = openmpflags,
+              extra_link_args = openmpflags
+              ),
+    Extension("nfwfitter.profiletools", ["nfwfitter/profiletools.pyx"],
               include_dirs = [numpy.get_include()]
               ),
     Extension("nfwfitter.stats", ["nfwfitter/stats.pyx"],